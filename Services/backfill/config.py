@@ -0,0 +1,49 @@
+from typing import List, Literal, Optional
+
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+
+class Config(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_file='settings.env', env_file_encoding='utf-8'
+    )
+    pairs: List[str]
+    # replay the trade cache of the trades service, or download from the REST API
+    trades_source: Literal['archive', 'rest']
+    last_n_days: Optional[int] = None
+    trades_cache_dir: Optional[str] = None
+    trades_cache_max_bytes: Optional[int] = 2_000_000_000
+    rest_requests_per_second: Optional[float] = 1.0
+    rest_burst: Optional[int] = 1
+    rest_slices_per_pair: Optional[int] = 1
+    # same settings as the candles and ta services of a streaming run
+    candle_seconds: int
+    emit_incomplete_candles: Optional[bool] = False
+    max_candles_in_state: int
+    indicator_engine: Literal['incremental', 'talib'] = 'incremental'
+    # the feature store, or a csv file for local runs
+    output_sink: Literal['hopsworks', 'csv'] = 'hopsworks'
+    output_csv_path: Optional[str] = 'ta.csv'
+    sink_batch_size: Optional[int] = 10_000
+    feature_group_name: Optional[str] = None
+    feature_group_version: Optional[int] = None
+    feature_group_primary_key: Optional[List[str]] = None
+    feature_group_event_time: Optional[str] = None
+    feature_group_materialization_interval_minutes: Optional[int] = 15
+    # parity check against the topics of a streaming run
+    kafka_broker_address: Optional[str] = None
+    parity_trades_topic: Optional[str] = None
+    parity_ta_topic: Optional[str] = None
+    parity_idle_timeout_sec: Optional[float] = 10.0
+    parity_rel_tol: Optional[float] = 1e-9
+    # the ta code logs every candle at debug level, which would slow the run down
+    log_level: Optional[str] = 'INFO'
+
+
+class HopsworksCredentials(BaseSettings):
+    model_config = SettingsConfigDict(env_file='credentials.env')
+    hopsworks_api_key: str
+    hopsworks_project_name: str
+
+
+config = Config()
@@ -0,0 +1,169 @@
+"""
+Checks that the in-process pipeline gives exactly what the streaming pipeline gave.
+
+Reads back the trades topic and the ta topic of a finished streaming run, feeds the
+trades of every pair through `InProcessPipeline` with the same settings, and
+compares the output with the ta topic message by message. Exits with 1 on any
+difference, so it can gate a release.
+
+    make parity    # after a streaming run, with PARITY_*_TOPIC pointing at it
+"""
+
+import math
+import sys
+import time
+import uuid
+from collections import defaultdict
+from typing import Any, Dict, List
+
+from loguru import logger
+from pipeline import InProcessPipeline
+from quixstreams import Application
+from quixstreams.models.serializers import SerializationContext
+from services import load_module
+
+wire_format = load_module('candles', 'wire_format')
+
+
+def read_topic(
+    kafka_broker_address: str, topic: str, idle_timeout_sec: float
+) -> Dict[str, List[dict]]:
+    """
+    Reads a whole topic from the beginning, until no message arrived for
+    `idle_timeout_sec`
+
+    Returns:
+        Dict[str, List[dict]]: the messages of every key in order
+    """
+    app = Application(
+        broker_address=kafka_broker_address,
+        # a fresh group every time, so the topic is always read from the start
+        consumer_group=f'backfill-parity-{uuid.uuid4()}',
+        auto_offset_reset='earliest',
+    )
+    deserializer = wire_format.WireDeserializer()
+    ctx = SerializationContext(topic=topic, field='value')
+
+    messages = defaultdict(list)
+    n_messages = 0
+    with app.get_consumer() as consumer:
+        consumer.subscribe([topic])
+        last_message_at = time.monotonic()
+        while time.monotonic() - last_message_at < idle_timeout_sec:
+            msg = consumer.poll(timeout=1.0)
+            if msg is None:
+                continue
+            if msg.error():
+                raise RuntimeError(f'Failed to read {topic}: {msg.error()}')
+
+            messages[msg.key().decode()].append(deserializer(msg.value(), ctx))
+            n_messages += 1
+            last_message_at = time.monotonic()
+
+    logger.info(f'Read {n_messages} messages of {len(messages)} keys from {topic}')
+    return messages
+
+
+def compare(expected: dict, actual: dict, rel_tol: float) -> List[str]:
+    """
+    Returns the fields that differ between two messages
+    """
+    differences = []
+    for field in sorted(set(expected) | set(actual)):
+        a, b = expected.get(field), actual.get(field)
+        if not _equal(a, b, rel_tol):
+            differences.append(f'{field}: streaming {a!r}, in-process {b!r}')
+    return differences
+
+
+def _equal(a: Any, b: Any, rel_tol: float) -> bool:
+    if isinstance(a, float) and isinstance(b, float):
+        return math.isclose(a, b, rel_tol=rel_tol) or (math.isnan(a) and math.isnan(b))
+    return a == b
+
+
+def check_parity(
+    trades_by_key: Dict[str, List[dict]],
+    ta_by_key: Dict[str, List[dict]],
+    candle_seconds: int,
+    emit_incomplete_candles: bool,
+    max_candles_in_state: int,
+    indicator_engine: str = 'incremental',
+    rel_tol: float = 1e-9,
+    max_reported: int = 10,
+) -> int:
+    """
+    Runs the trades of every key through the in-process pipeline and compares the
+    result with the ta messages of the same key
+
+    Returns:
+        int: the number of messages that differ or are missing on either side
+    """
+    n_mismatches = 0
+    n_compared = 0
+    for key in sorted(set(trades_by_key) | set(ta_by_key)):
+        pipeline = InProcessPipeline(
+            candle_seconds=candle_seconds,
+            emit_incomplete_candles=emit_incomplete_candles,
+            max_candles_in_state=max_candles_in_state,
+            indicator_engine=indicator_engine,
+        )
+        actual = []
+        for trade in trades_by_key.get(key, []):
+            actual.extend(pipeline.process(trade))
+
+        # the ta service only keeps the candles of its own size
+        expected = [
+            message
+            for message in ta_by_key.get(key, [])
+            if message['candle_seconds'] == candle_seconds
+        ]
+
+        if len(expected) != len(actual):
+            n_mismatches += abs(len(expected) - len(actual))
+            logger.error(
+                f'{key}: {len(expected)} streaming messages, {len(actual)} in-process'
+            )
+
+        for i, (a, b) in enumerate(zip(expected, actual)):
+            n_compared += 1
+            differences = compare(a, b, rel_tol)
+            if differences:
+                n_mismatches += 1
+                if n_mismatches <= max_reported:
+                    logger.error(f'{key} message {i}: {"; ".join(differences)}')
+
+    logger.info(f'Compared {n_compared} messages, {n_mismatches} mismatches')
+    return n_mismatches
+
+
+if __name__ == '__main__':
+    from config import config
+
+    logger.remove()
+    logger.add(sys.stderr, level=config.log_level)
+
+    if not (config.parity_trades_topic and config.parity_ta_topic):
+        raise ValueError('Set PARITY_TRADES_TOPIC and PARITY_TA_TOPIC')
+
+    trades_by_key = read_topic(
+        config.kafka_broker_address,
+        config.parity_trades_topic,
+        config.parity_idle_timeout_sec,
+    )
+    ta_by_key = read_topic(
+        config.kafka_broker_address,
+        config.parity_ta_topic,
+        config.parity_idle_timeout_sec,
+    )
+
+    n_mismatches = check_parity(
+        trades_by_key,
+        ta_by_key,
+        candle_seconds=config.candle_seconds,
+        emit_incomplete_candles=config.emit_incomplete_candles,
+        max_candles_in_state=config.max_candles_in_state,
+        indicator_engine=config.indicator_engine,
+        rel_tol=config.parity_rel_tol,
+    )
+    sys.exit(1 if n_mismatches else 0)
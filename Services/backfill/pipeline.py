@@ -0,0 +1,185 @@
+import math
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from services import load_module
+
+# the exact functions the streaming candles and ta services run
+candles = load_module('candles', 'run')
+ta_indicators = load_module('ta', 'technical_indicators')
+ta_incremental = load_module('ta', 'incremental')
+
+
+class TumblingWindows:
+    """
+    Tumbling window reduce of the candles service, without Kafka and RocksDB.
+
+    Follows what quixstreams does for `tumbling_window(...).reduce(...)` with no
+    grace period: every key keeps its own windows and its latest timestamp, a trade
+    falling in a window that has already closed for its key is dropped, and a window
+    closes once a trade of the same key lands `duration_ms` after its start.
+    """
+
+    def __init__(
+        self,
+        duration_ms: int,
+        reducer: Callable[[Any, Any], Any],
+        initializer: Callable[[Any], Any],
+    ):
+        self.duration_ms = duration_ms
+        self.reducer = reducer
+        self.initializer = initializer
+
+        # open windows by their start, and the latest timestamp, of every key
+        self._windows: Dict[Any, Dict[int, Any]] = {}
+        self._latest_timestamp_ms: Dict[Any, int] = {}
+        self.late_messages = 0
+
+    def process(
+        self, key: Any, value: Any, timestamp_ms: int
+    ) -> Tuple[List[dict], List[dict]]:
+        """
+        Adds the value to its window
+
+        Returns:
+            Tuple[List[dict], List[dict]]: the updated windows, what `current()`
+            emits, and the windows that closed, what `final()` emits, in the
+            {'start', 'end', 'value'} format of quixstreams
+        """
+        windows = self._windows.setdefault(key, {})
+        latest_timestamp_ms = max(timestamp_ms, self._latest_timestamp_ms.get(key, 0))
+        max_expired_start = latest_timestamp_ms - self.duration_ms
+
+        start = timestamp_ms - timestamp_ms % self.duration_ms
+        end = start + self.duration_ms
+
+        updated = []
+        if start <= max_expired_start:
+            self.late_messages += 1
+        else:
+            current = windows.get(start)
+            aggregated = (
+                self.initializer(value)
+                if current is None
+                else self.reducer(current, value)
+            )
+            windows[start] = aggregated
+            self._latest_timestamp_ms[key] = latest_timestamp_ms
+            updated.append({'start': start, 'end': end, 'value': aggregated})
+
+        expired = []
+        for expired_start in sorted(s for s in windows if s <= max_expired_start):
+            expired.append(
+                {
+                    'start': expired_start,
+                    'end': expired_start + self.duration_ms,
+                    'value': windows.pop(expired_start),
+                }
+            )
+
+        return updated, expired
+
+
+class DictState:
+    """
+    In memory stand-in for the quixstreams `State` of one key
+    """
+
+    def __init__(self):
+        self._values: Dict[str, Any] = {}
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self._values.get(key, default)
+
+    def set(self, key: str, value: Any):
+        self._values[key] = value
+
+
+class InProcessPipeline:
+    """
+    Runs trades through the candles and ta services in one process.
+
+    Every trade goes through the same steps and the same functions as in the
+    streaming pipeline, only the Kafka topics in between are gone:
+
+        trade -> tumbling window reduce (init_candle / update_candle)
+              -> flattened candle
+              -> ta/technical_indicators.compute_indicators, or
+                 ta/incremental.IncrementalIndicators
+
+    Per key the output is the exact sequence of messages the ta service would push
+    to its output topic, with the missing indicators as None the way they arrive
+    downstream.
+    """
+
+    def __init__(
+        self,
+        candle_seconds: int,
+        emit_incomplete_candles: bool,
+        max_candles_in_state: int,
+        indicator_engine: str = 'incremental',
+    ):
+        """
+        Args:
+            candle_seconds (int): size of the candles in seconds
+            emit_incomplete_candles (bool): emit every update of the current candle,
+                or only the candles that are closed
+            max_candles_in_state (int): number of candles the indicators look at
+            indicator_engine (str): 'incremental' or 'talib', like the ta service
+        """
+        self.candle_seconds = candle_seconds
+        self.emit_incomplete_candles = emit_incomplete_candles
+        self.max_candles_in_state = max_candles_in_state
+        self.indicator_engine = indicator_engine
+        self._incremental = ta_incremental.IncrementalIndicators(max_candles_in_state)
+
+        self.windows = TumblingWindows(
+            duration_ms=candle_seconds * 1000,
+            reducer=candles.update_candle,
+            initializer=candles.init_candle,
+        )
+        self._ta_states: Dict[str, DictState] = {}
+
+        self.trades_processed = 0
+        self.candles_processed = 0
+
+    def process(self, trade: dict) -> List[dict]:
+        """
+        Processes one trade
+
+        Args:
+            trade (dict): trade with at least the pair, price, volume and
+                timestamp_ms fields
+
+        Returns:
+            List[dict]: the candles with their indicators, in order
+        """
+        self.trades_processed += 1
+        updated, expired = self.windows.process(
+            trade['pair'], trade, trade['timestamp_ms']
+        )
+        windows = updated if self.emit_incomplete_candles else expired
+        return [self._ta(self._flatten(window)) for window in windows]
+
+    def _flatten(self, window: dict) -> dict:
+        return candles.expand_candle(window, self.candle_seconds)
+
+    def _ta(self, candle: dict) -> dict:
+        self.candles_processed += 1
+        state = self._ta_states.get(candle['pair'])
+        if state is None:
+            state = self._ta_states[candle['pair']] = DictState()
+
+        if self.indicator_engine == 'incremental':
+            message = self._incremental.update(candle, state)
+        else:
+            message = ta_indicators.compute_indicators(
+                candle, state, self.max_candles_in_state
+            )
+        return {key: _nan_to_none(value) for key, value in message.items()}
+
+
+def _nan_to_none(value: Any) -> Optional[Any]:
+    # both wire formats turn the NaN of a short history into null
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value
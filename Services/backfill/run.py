@@ -0,0 +1,196 @@
+import sys
+import time
+from typing import List
+
+from loguru import logger
+from pipeline import InProcessPipeline
+from quixstreams.sinks.base import BatchingSink, SinkBackpressureError
+from services import import_trades_package
+
+import_trades_package()
+
+from kraken_api.base import TradesAPI  # noqa: E402
+
+
+def main(
+    trades_api: TradesAPI,
+    output_sink: BatchingSink,
+    candle_seconds: int,
+    emit_incomplete_candles: bool,
+    max_candles_in_state: int,
+    indicator_engine: str = 'incremental',
+    sink_batch_size: int = 10_000,
+    stats_interval_sec: float = 10.0,
+):
+    """
+    Historical backfill without Kafka:
+    1. reads the historical trades
+    2. turns them into candles and indicators in process, with the code of the
+       candles and ta services
+    3. writes the indicators straight to the sink
+
+    Live runs keep going through Kafka, this only replaces the historical pipeline.
+
+    Args:
+        trades_api (TradesAPI): where the historical trades come from
+        output_sink (BatchingSink): where the indicators go, e.g. the feature store
+        candle_seconds (int): size of the candles in seconds
+        emit_incomplete_candles (bool): emit every update of the current candle, or
+            only the candles that are closed
+        max_candles_in_state (int): number of candles the indicators look at
+        indicator_engine (str): 'incremental' or 'talib', like the ta service
+        sink_batch_size (int): number of messages written to the sink at once
+        stats_interval_sec (float): how often to log the throughput
+    """
+    logger.info('starting in-process backfill!')
+
+    pipeline = InProcessPipeline(
+        candle_seconds=candle_seconds,
+        emit_incomplete_candles=emit_incomplete_candles,
+        max_candles_in_state=max_candles_in_state,
+        indicator_engine=indicator_engine,
+    )
+
+    started_at = time.monotonic()
+    logged_at = started_at
+    messages_written = 0
+    batch: List[dict] = []
+
+    while not trades_api.is_done():
+        for trade in trades_api.get_trades():
+            batch.extend(
+                pipeline.process(
+                    {
+                        'pair': trade.pair,
+                        'price': trade.price,
+                        'volume': trade.volume,
+                        'timestamp_ms': trade.timestamp_ms,
+                    }
+                )
+            )
+
+        if len(batch) >= sink_batch_size:
+            write_batch(output_sink, batch)
+            messages_written += len(batch)
+            batch = []
+
+        if time.monotonic() - logged_at >= stats_interval_sec:
+            log_throughput(pipeline, messages_written, started_at)
+            logged_at = time.monotonic()
+
+    if batch:
+        write_batch(output_sink, batch)
+        messages_written += len(batch)
+
+    log_throughput(pipeline, messages_written, started_at)
+    if pipeline.windows.late_messages:
+        logger.warning(
+            f'Dropped {pipeline.windows.late_messages} trades of already closed candles'
+        )
+
+
+def write_batch(sink: BatchingSink, batch: List[dict], topic: str = 'backfill'):
+    """
+    Writes the messages to the sink, waiting and retrying whenever it pushes back
+    """
+    while True:
+        for offset, message in enumerate(batch):
+            sink.add(
+                value=message,
+                key=message['pair'],
+                timestamp=message['timestamp_ms'],
+                headers=[],
+                topic=topic,
+                partition=0,
+                offset=offset,
+            )
+        try:
+            sink.flush(topic=topic, partition=0)
+            return
+        except SinkBackpressureError as e:
+            logger.warning(f'Sink is busy, retrying in {e.retry_after}s')
+            time.sleep(e.retry_after)
+
+
+def log_throughput(
+    pipeline: InProcessPipeline, messages_written: int, started_at: float
+):
+    elapsed_sec = max(time.monotonic() - started_at, 1e-9)
+    logger.info(
+        f'Processed {pipeline.trades_processed} trades into '
+        f'{pipeline.candles_processed} candles in {elapsed_sec:.1f}s: '
+        f'{pipeline.trades_processed / elapsed_sec:,.0f} trades/s, '
+        f'{pipeline.candles_processed / elapsed_sec:,.0f} candles/s, '
+        f'{messages_written} messages written'
+    )
+
+
+if __name__ == '__main__':
+    from config import config
+    from kraken_api.replay import ReplayTradesAPI
+    from kraken_api.rest_async import KrakenRestAPIAsync
+    from kraken_api.trade_cache import TradeCache
+
+    logger.remove()
+    logger.add(sys.stderr, level=config.log_level)
+
+    trades_cache = None
+    if config.trades_cache_dir:
+        trades_cache = TradeCache(
+            cache_dir=config.trades_cache_dir,
+            max_bytes=config.trades_cache_max_bytes,
+        )
+
+    if config.trades_source == 'archive':
+        if trades_cache is None:
+            raise ValueError('Backfilling from the archive needs TRADES_CACHE_DIR')
+        since_timestamp_ns = None
+        if config.last_n_days:
+            since_timestamp_ns = time.time_ns() - config.last_n_days * 86_400 * 10**9
+        trades_api = ReplayTradesAPI(
+            trades_cache, config.pairs, since_timestamp_ns=since_timestamp_ns
+        )
+    else:
+        trades_api = KrakenRestAPIAsync(
+            config.pairs,
+            last_n_days=config.last_n_days,
+            requests_per_second=config.rest_requests_per_second,
+            burst=config.rest_burst,
+            slices_per_pair=config.rest_slices_per_pair,
+            cache=trades_cache,
+        )
+
+    if config.output_sink == 'csv':
+        from quixstreams.sinks.core.csv import CSVSink
+
+        output_sink = CSVSink(path=config.output_csv_path)
+    else:
+        from config import HopsworksCredentials
+        from services import load_module
+
+        hopsworks_credentials = HopsworksCredentials()
+        sink = load_module('to-feature-store', 'sink')
+        output_sink = sink.HopsworksFeatureStoreSink(
+            api_key=hopsworks_credentials.hopsworks_api_key,
+            project_name=hopsworks_credentials.hopsworks_project_name,
+            feature_group_name=config.feature_group_name,
+            feature_group_version=config.feature_group_version,
+            feature_group_primary_key=config.feature_group_primary_key,
+            feature_group_event_time=config.feature_group_event_time,
+            feature_group_materialization_interval_minutes=config.feature_group_materialization_interval_minutes,
+        )
+
+    # the cache only saves the segments it read on close
+    try:
+        main(
+            trades_api=trades_api,
+            output_sink=output_sink,
+            candle_seconds=config.candle_seconds,
+            emit_incomplete_candles=config.emit_incomplete_candles,
+            max_candles_in_state=config.max_candles_in_state,
+            indicator_engine=config.indicator_engine,
+            sink_batch_size=config.sink_batch_size,
+        )
+    finally:
+        if trades_cache is not None:
+            trades_cache.close()
@@ -0,0 +1,48 @@
+import importlib.util
+import os
+import sys
+from pathlib import Path
+from types import ModuleType
+
+# the other services live next to this one, in the repo and in the docker image
+SERVICES_DIR = Path(os.environ.get('SERVICES_DIR', Path(__file__).parent.parent))
+
+
+def load_module(service: str, module: str) -> ModuleType:
+    """
+    Loads a module of another service from its file, so the backfill runs exactly
+    the code the streaming services run.
+
+    Every service has its own `run` and `config` modules, so the module is
+    registered under a name prefixed with the service, and the service directory
+    is only appended to the import path for the modules it imports itself.
+
+    Args:
+        service (str): the directory of the service, e.g. 'candles'
+        module (str): the module in it, e.g. 'run'
+
+    Returns:
+        ModuleType: the loaded module
+    """
+    name = f'{service.replace("-", "_")}_{module}'
+    if name in sys.modules:
+        return sys.modules[name]
+
+    service_dir = SERVICES_DIR / service
+    if str(service_dir) not in sys.path:
+        sys.path.append(str(service_dir))
+
+    spec = importlib.util.spec_from_file_location(name, service_dir / f'{module}.py')
+    loaded = importlib.util.module_from_spec(spec)
+    sys.modules[name] = loaded
+    spec.loader.exec_module(loaded)
+    return loaded
+
+
+def import_trades_package():
+    """
+    Makes the `kraken_api` package of the trades service importable
+    """
+    trades_dir = str(SERVICES_DIR / 'trades')
+    if trades_dir not in sys.path:
+        sys.path.append(trades_dir)
@@ -0,0 +1,22 @@
+import os
+
+import pytest
+from confluent_kafka import KafkaException
+from confluent_kafka.admin import AdminClient
+
+# the redpanda of the docker compose setup, like the settings files
+KAFKA_BROKER_ADDRESS = os.environ.get('KAFKA_BROKER_ADDRESS', 'localhost:19092')
+
+
+@pytest.fixture(scope='session')
+def kafka_broker_address() -> str:
+    """
+    The broker for the tests running the service end to end, which are skipped
+    without one
+    """
+    admin = AdminClient({'bootstrap.servers': KAFKA_BROKER_ADDRESS})
+    try:
+        admin.list_topics(timeout=5)
+    except KafkaException:
+        pytest.skip(f'No Kafka broker at {KAFKA_BROKER_ADDRESS}')
+    return KAFKA_BROKER_ADDRESS
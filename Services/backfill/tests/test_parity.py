@@ -0,0 +1,146 @@
+"""
+The in-process pipeline against the streaming one: the same trades through
+`InProcessPipeline`, and through a streaming dataframe with the windows and the
+state store of quixstreams running the functions of the candles and ta services.
+The streaming side runs against a broker, the tests are skipped without one.
+"""
+
+import multiprocessing
+import random
+from datetime import timedelta
+from typing import List
+
+import pytest
+from broker import consume, create_topics, produce
+from pipeline import InProcessPipeline, candles, ta_incremental, ta_indicators
+from quixstreams import Application
+
+CANDLE_SECONDS = 60
+MAX_CANDLES_IN_STATE = 60
+
+
+def make_trades(n_trades: int = 20_000, seed: int = 42) -> List[dict]:
+    """
+    Trades of a few pairs over a few hours, a quiet stretch without trades, and some
+    trades late by up to a bit more than a candle, like the ones sent again after a
+    reconnect
+    """
+    rng = random.Random(seed)
+    prices = {'BTC/USD': 90_000.0, 'ETH/EUR': 3_500.0, 'SOL/USD': 200.0}
+    timestamp_ms = 1_731_150_000_000
+    trades = []
+    for i in range(n_trades):
+        timestamp_ms += rng.randint(0, 1_500)
+        if i == n_trades // 2:
+            timestamp_ms += 15 * 60_000
+        pair = rng.choice(list(prices))
+        prices[pair] *= 1 + rng.gauss(0, 5e-4)
+        late_ms = rng.randint(0, 70_000) if rng.random() < 0.02 else 0
+        trades.append(
+            {
+                'pair': pair,
+                'price': prices[pair],
+                'volume': rng.random(),
+                'timestamp_ms': timestamp_ms - late_ms,
+            }
+        )
+    return trades
+
+
+def run_streaming(
+    kafka_broker_address: str,
+    trades_topic: str,
+    ta_topic: str,
+    emit_incomplete_candles: bool,
+    indicator_engine: str,
+    state_dir: str,
+):
+    """
+    The candles and ta steps in one streaming dataframe, from the trades topic to
+    the ta topic
+    """
+    app = Application(
+        broker_address=kafka_broker_address,
+        consumer_group=f'{ta_topic}-streaming',
+        auto_offset_reset='earliest',
+        state_dir=state_dir,
+    )
+    input_topic = app.topic(
+        trades_topic,
+        value_deserializer='json',
+        timestamp_extractor=lambda value, *_: value['timestamp_ms'],
+    )
+    output_topic = app.topic(ta_topic, value_serializer='json')
+
+    # the candles service
+    sdf = app.dataframe(input_topic)
+    sdf = sdf.tumbling_window(timedelta(seconds=CANDLE_SECONDS)).reduce(
+        reducer=candles.update_candle, initializer=candles.init_candle
+    )
+    sdf = sdf.current() if emit_incomplete_candles else sdf.final()
+    sdf = sdf.apply(lambda window: candles.expand_candle(window, CANDLE_SECONDS))
+
+    # the ta service
+    if indicator_engine == 'incremental':
+        update = ta_incremental.IncrementalIndicators(MAX_CANDLES_IN_STATE).update
+    else:
+
+        def update(candle, state):
+            return ta_indicators.compute_indicators(candle, state, MAX_CANDLES_IN_STATE)
+
+    sdf = sdf.apply(update, stateful=True)
+    sdf = sdf.to_topic(output_topic)
+
+    app.run()
+
+
+@pytest.mark.parametrize('emit_incomplete_candles', [False, True])
+@pytest.mark.parametrize('indicator_engine', ['incremental', 'talib'])
+def test_in_process_pipeline_matches_streaming(
+    kafka_broker_address, emit_incomplete_candles, indicator_engine, tmp_path
+):
+    trades = make_trades()
+
+    pipeline = InProcessPipeline(
+        candle_seconds=CANDLE_SECONDS,
+        emit_incomplete_candles=emit_incomplete_candles,
+        max_candles_in_state=MAX_CANDLES_IN_STATE,
+        indicator_engine=indicator_engine,
+    )
+    in_process = [message for t in trades for message in pipeline.process(dict(t))]
+    # the late trades are dropped by both
+    assert pipeline.windows.late_messages > 0
+
+    # a single partition, so the messages of every pair keep the order of the
+    # trades like they do in process
+    trades_topic, ta_topic = create_topics(kafka_broker_address, 'trades', 'ta')
+    produce(
+        kafka_broker_address, trades_topic, [(trade['pair'], trade) for trade in trades]
+    )
+    streaming_service = multiprocessing.get_context('spawn').Process(
+        target=run_streaming,
+        args=(
+            kafka_broker_address,
+            trades_topic,
+            ta_topic,
+            emit_incomplete_candles,
+            indicator_engine,
+            str(tmp_path),
+        ),
+        daemon=True,
+    )
+    streaming_service.start()
+    try:
+        streaming = consume(
+            kafka_broker_address,
+            ta_topic,
+            lambda messages: len(messages) >= len(in_process),
+            timeout_sec=300,
+        )
+    finally:
+        streaming_service.terminate()
+        streaming_service.join()
+
+    assert len(in_process) == len(streaming)
+    for i, (a, b) in enumerate(zip(streaming, in_process)):
+        assert a == b, f'message {i} differs'
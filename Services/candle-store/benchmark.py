@@ -0,0 +1,136 @@
+"""
+Benchmarks of the candle store: appends per second from the candles topic, and the
+latency of the queries of a reader on a store with a year of one minute
+candles. That the queries return the candles appended is checked by the tests,
+`make test`.
+
+    uv run python benchmark.py
+"""
+
+import os
+import random
+import tempfile
+import time
+from typing import Dict, List
+
+import numpy as np
+from store import CandleStore
+
+PAIR = 'BTC/USD'
+CANDLE_SECONDS = 60
+# a year of one minute candles
+N_WINDOWS = 525_600
+DAY_MS = 24 * 60 * 60 * 1000
+
+
+def make_candles(n_windows: int, updates_per_window: int, seed: int = 42) -> List[dict]:
+    """
+    Synthetic one minute candles of a pair, every window updated several times
+    like the candles service does with the candle in progress
+    """
+    rng = random.Random(seed)
+    candles = []
+    price = 100_000.0
+    for window in range(n_windows):
+        window_start_ms = 1_700_000_000_000 + window * CANDLE_SECONDS * 1000
+        open_ = high = low = price
+        volume = 0.0
+        for _ in range(updates_per_window):
+            price *= 1 + rng.gauss(0, 1e-4)
+            high, low = max(high, price), min(low, price)
+            volume += rng.random()
+            candles.append(
+                {
+                    'pair': PAIR,
+                    'open': open_,
+                    'high': high,
+                    'low': low,
+                    'close': price,
+                    'volume': volume,
+                    'window_start_ms': window_start_ms,
+                    'window_end_ms': window_start_ms + CANDLE_SECONDS * 1000,
+                    'candle_seconds': CANDLE_SECONDS,
+                }
+            )
+    return candles
+
+
+def last_of_windows(candles: List[dict]) -> List[dict]:
+    """
+    The last candle of every window, what the store keeps
+    """
+    windows: Dict[int, dict] = {}
+    for candle in candles:
+        windows[candle['window_start_ms']] = candle
+    return list(windows.values())
+
+
+def append_all(store: CandleStore, candles: List[dict], flush_every: int = 1_000):
+    """
+    Appends the candles, flushing every flush_every candles like the sink does on
+    every checkpoint
+    """
+    for i, candle in enumerate(candles, 1):
+        store.append(candle)
+        if i % flush_every == 0:
+            store.flush()
+    store.flush()
+
+
+def latency_us(query, n_runs: int = 2_000) -> tuple:
+    """
+    Median and 99th percentile of the query in microseconds
+    """
+    elapsed = []
+    for _ in range(n_runs):
+        start = time.perf_counter_ns()
+        query()
+        elapsed.append(time.perf_counter_ns() - start)
+    p50, p99 = np.percentile(elapsed, [50, 99]) / 1000
+    return p50, p99
+
+
+if __name__ == '__main__':
+    root = tempfile.mkdtemp()
+    candles = make_candles(N_WINDOWS, updates_per_window=4)
+    expected = last_of_windows(candles)
+
+    writer = CandleStore(root, readonly=False)
+    start = time.perf_counter()
+    append_all(writer, candles)
+    elapsed = time.perf_counter() - start
+    print(
+        f'appended {len(candles):,} candles of {len(expected):,} windows: '
+        f'{len(candles) / elapsed:,.0f} candles/s'
+    )
+
+    # a reader of its own, like a notebook next to the service
+    reader = CandleStore(root)
+    last_ms = expected[-1]['window_start_ms']
+    queries = {
+        'last 60': lambda: reader.last(PAIR, CANDLE_SECONDS, 60),
+        'last 1000': lambda: reader.last(PAIR, CANDLE_SECONDS, 1_000),
+        'range 1 day': lambda: reader.range(
+            PAIR, CANDLE_SECONDS, last_ms - DAY_MS, last_ms
+        ),
+        'range 1 week': lambda: reader.range(
+            PAIR, CANDLE_SECONDS, last_ms - 7 * DAY_MS, last_ms
+        ),
+        'range 1 week, sum': lambda: reader.range(
+            PAIR, CANDLE_SECONDS, last_ms - 7 * DAY_MS, last_ms
+        )['volume'].sum(),
+    }
+    print(f'\n{"query":>20} {"p50 µs":>10} {"p99 µs":>10}')
+    for name, query in queries.items():
+        p50, p99 = latency_us(query)
+        print(f'{name:>20} {p50:>10.1f} {p99:>10.1f}')
+
+    size_mb = (
+        sum(
+            os.path.getsize(os.path.join(dirpath, f))
+            for dirpath, _, files in os.walk(root)
+            for f in files
+        )
+        / 2**20
+    )
+    print(f'\n{len(expected):,} candles in {size_mb:.1f} MB on disk')
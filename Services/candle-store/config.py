@@ -0,0 +1,20 @@
+from typing import Literal
+
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+
+class Config(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_file='settings.env', env_file_encoding='utf-8'
+    )
+    kafka_broker_address: str
+    kafka_input_topic: str
+    kafka_consumer_group: str
+    data_source: Literal['live', 'historical']
+    # directory of the store, one sub directory per pair and candle size
+    store_dir: str
+    # number of candles the column files grow by
+    chunk_rows: int = 65_536
+
+
+config = Config()
@@ -0,0 +1,64 @@
+from typing import Literal
+
+from loguru import logger
+from quixstreams import Application
+from sink import CandleStoreSink
+from store import CandleStore
+from wire_format import WireDeserializer
+
+
+def main(
+    kafka_broker_address: str,
+    kafka_input_topic: str,
+    kafka_consumer_group: str,
+    data_source: Literal['live', 'historical'],
+    store_dir: str,
+    chunk_rows: int = 65_536,
+):
+    """
+    1. reads the candles from the kafka topic
+    2. appends them to the candle store, by pair and candle size
+
+    Args:
+        kafka_broker_address (str): kafka broker address
+        kafka_input_topic (str): topic to read candles from
+        kafka_consumer_group (str): kafka consumer group
+        data_source (Literal['live', 'historical']): data source
+        store_dir (str): directory of the store
+        chunk_rows (int): number of candles the column files grow by
+    """
+    logger.info('starting candle-store service!')
+
+    store = CandleStore(store_dir, readonly=False, chunk_rows=chunk_rows)
+    logger.info(f'{len(store.partitions())} pairs and candle sizes in {store_dir}')
+
+    # initialize the quixstreams application
+    app = Application(
+        broker_address=kafka_broker_address,
+        consumer_group=kafka_consumer_group,
+        auto_offset_reset='latest' if data_source == 'live' else 'earliest',
+    )
+
+    # reads both json and binary messages
+    input_topic = app.topic(
+        name=kafka_input_topic,
+        value_deserializer=WireDeserializer(),
+    )
+
+    sdf = app.dataframe(input_topic)
+    sdf.sink(CandleStoreSink(store))
+
+    app.run()
+
+
+if __name__ == '__main__':
+    from config import config
+
+    main(
+        kafka_broker_address=config.kafka_broker_address,
+        kafka_input_topic=config.kafka_input_topic,
+        kafka_consumer_group=config.kafka_consumer_group,
+        data_source=config.data_source,
+        store_dir=config.store_dir,
+        chunk_rows=config.chunk_rows,
+    )
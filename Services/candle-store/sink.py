@@ -0,0 +1,23 @@
+from loguru import logger
+from quixstreams.sinks.base import BatchingSink, SinkBatch
+from store import CandleStore
+
+
+class CandleStoreSink(BatchingSink):
+    """
+    Appends the candles to the candle store, flushed before the offsets of the
+    candles are committed
+    """
+
+    def __init__(self, store: CandleStore):
+        super().__init__()
+        self.store = store
+        self.candles_stored = 0
+
+    def write(self, batch: SinkBatch):
+        for item in batch:
+            if self.store.append(item.value):
+                self.candles_stored += 1
+            else:
+                logger.debug(f'Dropping a candle older than the store: {item.value}')
+        self.store.flush()
@@ -0,0 +1,311 @@
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import quote, unquote
+
+import numpy as np
+
+# the columns of the candles, every one a file of its own in the partition
+COLUMNS = {
+    'window_start_ms': np.dtype('<i8'),
+    'open': np.dtype('<f8'),
+    'high': np.dtype('<f8'),
+    'low': np.dtype('<f8'),
+    'close': np.dtype('<f8'),
+    'volume': np.dtype('<f8'),
+}
+
+# a rewrite of the last candle taking longer is one the writer died in
+STALE_REWRITE_SEC = 0.1
+# longest a query sleeps between two looks at a rewrite in progress
+MAX_REWRITE_BACKOFF_SEC = 0.001
+
+
+class CandleStore:
+    """
+    Append-only store of the candles of every pair and timeframe on local disk: one
+    directory per pair and candle size, with a memory-mapped file per column, so
+    the last candles or a time range of a pair are a binary search and a slice of
+    the files, without a copy and without Kafka.
+
+    A candle of the same window as the last one of its pair and timeframe replaces
+    it, like the updates of the candle in progress do, and a candle of an earlier
+    window is dropped. The store only grows at the end, and replaying the candles
+    topic over it changes nothing.
+
+    One process writes, any number of processes read. The number of candles of a
+    partition goes to its `length` file on `flush()`, after the columns, so the
+    readers never see the candles appended since, and after a crash the candles
+    past it are written over.
+
+    The last candle of a partition is the exception, it is rewritten in place by
+    the updates of the candle in progress, and the readers see every update as
+    soon as it is written, before `flush()`. The writer bumps a sequence number in
+    the `seq` file around the rewrite, and the queries copy the candles out of the
+    files, copying again if the sequence moved under them, so a query never mixes
+    two versions of a candle and what it returns never changes afterwards.
+
+    A rewrite still in progress after STALE_REWRITE_SEC is taken for one the writer
+    died in, and the query returns the last candle as it is, possibly half
+    rewritten. The next writer rewrites it when it replays the topic.
+    """
+
+    def __init__(self, root: str, readonly: bool = True, chunk_rows: int = 65_536):
+        """
+        Args:
+            root (str): directory of the store
+            readonly (bool): open the store to read it, only the writer sets False
+            chunk_rows (int): number of candles the column files grow by
+        """
+        self.root = root
+        self.readonly = readonly
+        self.chunk_rows = chunk_rows
+        self._partitions: Dict[Tuple[str, int], _Partition] = {}
+
+    def append(self, candle: dict) -> bool:
+        """
+        Adds the candle at the end of its pair and timeframe, or replaces the last
+        one if it is the same window
+
+        Returns:
+            bool: False if the candle is of a window before the last one, and so
+                not stored
+        """
+        partition = self._partition(candle['pair'], candle['candle_seconds'])
+        return partition.append(candle)
+
+    def flush(self):
+        """
+        Writes the candles appended since the last flush to disk and makes them
+        visible to the readers
+        """
+        for partition in self._partitions.values():
+            partition.flush()
+
+    def range(
+        self,
+        pair: str,
+        candle_seconds: int,
+        start_ms: Optional[int] = None,
+        end_ms: Optional[int] = None,
+    ) -> Dict[str, np.ndarray]:
+        """
+        The candles of the windows starting in [start_ms, end_ms), oldest first
+
+        Returns:
+            Dict[str, np.ndarray]: one array per column of COLUMNS
+        """
+        partition = self._partition(pair, candle_seconds)
+        if partition is None:
+            return _empty()
+        return partition.range(start_ms, end_ms)
+
+    def last(self, pair: str, candle_seconds: int, n: int) -> Dict[str, np.ndarray]:
+        """
+        The last n candles, oldest first, fewer if the store does not have that
+        many
+
+        Returns:
+            Dict[str, np.ndarray]: one array per column of COLUMNS
+        """
+        partition = self._partition(pair, candle_seconds)
+        if partition is None:
+            return _empty()
+        return partition.last(n)
+
+    def partitions(self) -> List[Tuple[str, int]]:
+        """
+        The pairs and candle sizes in the store
+        """
+        return sorted(
+            (unquote(pair_dir), int(seconds))
+            for pair_dir in _subdirs(self.root)
+            for seconds in _subdirs(os.path.join(self.root, pair_dir))
+        )
+
+    def _partition(self, pair: str, candle_seconds: int) -> Optional['_Partition']:
+        key = (pair, candle_seconds)
+        partition = self._partitions.get(key)
+        if partition is None:
+            path = os.path.join(self.root, quote(pair, safe=''), str(candle_seconds))
+            # a reader looks again on the next query
+            if self.readonly and not os.path.exists(path):
+                return None
+            partition = _Partition(path, self.readonly, self.chunk_rows)
+            self._partitions[key] = partition
+        return partition
+
+
+class _Partition:
+    """
+    The candles of a pair and timeframe, as column files sized in chunks of rows
+    """
+
+    def __init__(self, path: str, readonly: bool, chunk_rows: int):
+        self.path = path
+        self.readonly = readonly
+        self.chunk_rows = chunk_rows
+        if not readonly:
+            os.makedirs(path, exist_ok=True)
+        self.length = self._read_length()
+        self._dirty = False
+        self._map(self.length)
+        self._map_seq()
+
+    def append(self, candle: dict) -> bool:
+        window_start_ms = candle['window_start_ms']
+        row = self.length
+        if row:
+            last_window_start_ms = self._window_start_ms[row - 1]
+            if window_start_ms < last_window_start_ms:
+                return False
+            if window_start_ms == last_window_start_ms:
+                row -= 1
+
+        if row >= self.capacity:
+            self._map(row + 1)
+        if row < self.length:
+            # odd while the candle is half written, see _rows
+            self._seq[0] += 1
+            for name, column in self._columns.items():
+                column[row] = candle[name]
+            self._seq[0] += 1
+        else:
+            for name, column in self._columns.items():
+                column[row] = candle[name]
+        self.length = max(self.length, row + 1)
+        self._dirty = True
+        return True
+
+    def flush(self):
+        if not self._dirty:
+            return
+        for column in self._columns.values():
+            column.flush()
+        # the new length once the columns are on disk, in one rename
+        with open(os.path.join(self.path, 'length.tmp'), 'wb') as f:
+            f.write(self.length.to_bytes(8, 'little'))
+        os.replace(
+            os.path.join(self.path, 'length.tmp'), os.path.join(self.path, 'length')
+        )
+        self._dirty = False
+
+    def range(self, start_ms: Optional[int], end_ms: Optional[int]) -> dict:
+        self._refresh()
+        window_start_ms = self._window_start_ms[: self.length]
+        start = 0 if start_ms is None else window_start_ms.searchsorted(start_ms)
+        end = self.length if end_ms is None else window_start_ms.searchsorted(end_ms)
+        return self._rows(start, end)
+
+    def last(self, n: int) -> dict:
+        self._refresh()
+        return self._rows(max(self.length - n, 0), self.length)
+
+    def _rows(self, start: int, end: int) -> dict:
+        # only the last candle changes under the readers, copy again until no
+        # rewrite of it started or ended during the copy
+        started_at = time.monotonic()
+        backoff_sec = 0.0
+        while True:
+            seq = self._seq[0]
+            rows = {
+                name: column[start:end].copy() for name, column in self._views.items()
+            }
+            if self._seq[0] == seq and (
+                seq % 2 == 0 or time.monotonic() - started_at > STALE_REWRITE_SEC
+            ):
+                return rows
+            if seq % 2:
+                # a rewrite is in progress, let the writer finish it rather than
+                # taking the core from it
+                time.sleep(backoff_sec)
+                backoff_sec = min(
+                    max(backoff_sec * 2, 0.00001), MAX_REWRITE_BACKOFF_SEC
+                )
+
+    def _refresh(self):
+        # the writer is the one that knows
+        if self.readonly:
+            self.length = self._read_length()
+            if self.length > self.capacity:
+                self._map(self.length)
+            if not self._seq_mapped:
+                self._map_seq()
+
+    def _map_seq(self):
+        path = os.path.join(self.path, 'seq')
+        if not self.readonly and _file_size(path) < 8:
+            with open(path, 'wb') as f:
+                f.write(bytes(8))
+        if _file_size(path) < 8:
+            # the writer has not created it yet, there is no rewrite to race with
+            self._seq = np.zeros(1, np.int64)
+            self._seq_mapped = False
+            return
+        mode = 'r' if self.readonly else 'r+'
+        # a plain array over the map, its items are faster to get and set
+        self._seq = np.memmap(path, np.dtype('<i8'), mode=mode, shape=(1,)).view(
+            np.ndarray
+        )
+        self._seq_mapped = True
+        if not self.readonly and self._seq[0] % 2:
+            # the last writer died rewriting the last candle, the replay of the
+            # topic writes it again
+            self._seq[0] += 1
+
+    def _read_length(self) -> int:
+        try:
+            with open(os.path.join(self.path, 'length'), 'rb') as f:
+                return int.from_bytes(f.read(), 'little')
+        except FileNotFoundError:
+            return 0
+
+    def _map(self, n_rows: int):
+        """
+        Maps the column files, the writer growing them to hold n_rows first
+        """
+        capacity = -(-n_rows // self.chunk_rows) * self.chunk_rows
+        columns = {}
+        for name, dtype in COLUMNS.items():
+            path = os.path.join(self.path, f'{name}.bin')
+            if not self.readonly and _file_size(path) < capacity * dtype.itemsize:
+                with open(path, 'ab') as f:
+                    f.truncate(capacity * dtype.itemsize)
+            size = _file_size(path) // dtype.itemsize
+            if size:
+                mode = 'r' if self.readonly else 'r+'
+                columns[name] = np.memmap(path, dtype, mode=mode, shape=(size,))
+            else:
+                columns[name] = np.empty(0, dtype)
+
+        self._columns = columns
+        self.capacity = min(len(column) for column in columns.values())
+        self._window_start_ms = columns['window_start_ms']
+        # what the queries copy from, plain arrays the readers can not write to
+        self._views = {}
+        for name, column in columns.items():
+            view = column.view(np.ndarray)
+            view.flags.writeable = False
+            self._views[name] = view
+
+
+def _subdirs(path: str) -> List[str]:
+    """
+    The directories in path, none if it does not exist
+    """
+    if not os.path.isdir(path):
+        return []
+    return [
+        name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name))
+    ]
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+def _empty() -> Dict[str, np.ndarray]:
+    return {name: np.empty(0, dtype) for name, dtype in COLUMNS.items()}
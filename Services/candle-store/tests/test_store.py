@@ -0,0 +1,161 @@
+"""
+The queries of the store against the candles kept in lists, a replay of the topic
+and a writer dying before its flush, and a reader racing the rewrites of the candle
+in progress, or waiting on one the writer died in.
+"""
+
+import multiprocessing
+import os
+import time
+from typing import Dict, List
+
+import numpy as np
+import pytest
+import store
+from benchmark import (
+    CANDLE_SECONDS,
+    DAY_MS,
+    PAIR,
+    append_all,
+    last_of_windows,
+    make_candles,
+)
+from store import COLUMNS, CandleStore
+
+# a week of one minute candles
+N_WINDOWS = 10_080
+
+
+def assert_candles(columns: Dict[str, np.ndarray], expected: List[dict]):
+    for name in COLUMNS:
+        values = np.array([candle[name] for candle in expected], COLUMNS[name])
+        np.testing.assert_array_equal(columns[name], values, err_msg=name)
+
+
+@pytest.fixture
+def candles() -> List[dict]:
+    return make_candles(N_WINDOWS, updates_per_window=4)
+
+
+@pytest.fixture
+def root(tmp_path, candles) -> str:
+    """
+    A store with the candles appended, by a writer that is gone
+    """
+    append_all(CandleStore(str(tmp_path), readonly=False), candles)
+    return str(tmp_path)
+
+
+def test_queries_match_the_candles_kept_in_lists(root, candles):
+    expected = last_of_windows(candles)
+    reader = CandleStore(root)
+
+    assert_candles(reader.range(PAIR, CANDLE_SECONDS), expected)
+    assert_candles(reader.last(PAIR, CANDLE_SECONDS, 1_000), expected[-1_000:])
+    assert_candles(reader.last(PAIR, CANDLE_SECONDS, 10 * N_WINDOWS), expected)
+    start_ms = expected[5_000]['window_start_ms']
+    assert_candles(
+        reader.range(PAIR, CANDLE_SECONDS, start_ms, start_ms + DAY_MS),
+        expected[5_000 : 5_000 + 1_440],
+    )
+    assert_candles(reader.range('ETH/USD', CANDLE_SECONDS), [])
+    assert reader.partitions() == [(PAIR, CANDLE_SECONDS)]
+
+
+def test_stale_candles_and_a_replay_change_nothing(root, candles):
+    expected = last_of_windows(candles)
+    reader = CandleStore(root)
+
+    writer = CandleStore(root, readonly=False)
+    assert not writer.append(expected[0])
+    append_all(writer, candles[-1_000:])
+
+    assert_candles(reader.range(PAIR, CANDLE_SECONDS), expected)
+
+
+def test_writer_dying_before_its_flush_is_written_over(root, candles):
+    expected = last_of_windows(candles)
+    more = make_candles(N_WINDOWS + 100, updates_per_window=1, seed=7)[N_WINDOWS:]
+    reader = CandleStore(root)
+
+    crashed = CandleStore(root, readonly=False)
+    for candle in more[:50]:
+        crashed.append(candle)
+    # the readers stay at the last flush
+    assert_candles(reader.last(PAIR, CANDLE_SECONDS, 10), expected[-10:])
+
+    append_all(CandleStore(root, readonly=False), more)
+    assert_candles(reader.range(PAIR, CANDLE_SECONDS), expected + more)
+
+
+def test_partitions_skip_what_is_not_a_directory(root):
+    open(os.path.join(root, '.DS_Store'), 'w').close()
+    open(os.path.join(root, 'BTC%2FUSD', 'notes.txt'), 'w').close()
+
+    assert CandleStore(root).partitions() == [(PAIR, CANDLE_SECONDS)]
+
+
+def rewrite_last(root: str, n_updates: int):
+    """
+    Writer process updating the candle in progress over and over, every update with
+    all its prices and its volume set to the same number
+    """
+    writer = CandleStore(root, readonly=False)
+    for i in range(n_updates):
+        writer.append(
+            {
+                'pair': PAIR,
+                'candle_seconds': CANDLE_SECONDS,
+                'window_start_ms': 0,
+                **{
+                    name: float(i)
+                    for name in ('open', 'high', 'low', 'close', 'volume')
+                },
+            }
+        )
+    writer.flush()
+
+
+def test_queries_never_see_half_of_an_update(tmp_path):
+    root = str(tmp_path)
+    rewrite_last(root, 1)
+
+    reader = CandleStore(root)
+    writer = multiprocessing.get_context('spawn').Process(
+        target=rewrite_last, args=(root, 200_000)
+    )
+    writer.start()
+    n_queries = 0
+    while writer.is_alive():
+        candle = reader.last(PAIR, CANDLE_SECONDS, 1)
+        values = {
+            candle[name][0] for name in ('open', 'high', 'low', 'close', 'volume')
+        }
+        assert len(values) == 1, f'a query mixed the updates {values}'
+        n_queries += 1
+    writer.join()
+
+    assert writer.exitcode == 0
+    assert n_queries > 0
+
+
+def test_rewrite_the_writer_died_in_is_returned_as_it_is(root, candles, monkeypatch):
+    # the writer died between the two bumps of the sequence number
+    with open(os.path.join(root, 'BTC%2FUSD', str(CANDLE_SECONDS), 'seq'), 'wb') as f:
+        f.write((1).to_bytes(8, 'little'))
+    sleeps = []
+    monkeypatch.setattr(store.time, 'sleep', sleeps.append)
+
+    started_at = time.monotonic()
+    last = CandleStore(root).last(PAIR, CANDLE_SECONDS, 1)
+
+    assert time.monotonic() - started_at >= store.STALE_REWRITE_SEC
+    assert_candles(last, last_of_windows(candles)[-1:])
+    # the query backed off instead of spinning
+    assert sleeps and max(sleeps) == store.MAX_REWRITE_BACKOFF_SEC
+
+    # the next writer finishes the rewrite, and the queries stop waiting
+    CandleStore(root, readonly=False).append(candles[-1])
+    sleeps.clear()
+    CandleStore(root).last(PAIR, CANDLE_SECONDS, 1)
+    assert sleeps == []
@@ -0,0 +1,215 @@
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+# pair ids are packed above the timestamps to take a running max per pair in one go,
+# timestamps in ms stay below 2**42 until the year 2109
+_PAIR_SHIFT = 42
+
+
+class BatchCandleBuilder:
+    """
+    Builds the candles of a whole chunk of trades at once with numpy, for historical
+    runs where the trades of many windows are already in the topic.
+
+    Gives the same candles as the streaming `tumbling_window(...).reduce(
+    update_candle, init_candle).final()` path of run.py, field by field:
+    - a trade is dropped as late when its window starts `candle_seconds` or more
+      before the latest timestamp seen for its pair
+    - open and close are the first and last trades in arrival order, timestamp_ms is
+      the timestamp of the last trade, and the volume is summed in arrival order
+    - a window is emitted once a trade of the same pair lands in a later window, so
+      the last window of every pair stays open until the next chunk
+
+    The open windows and the latest timestamps are kept between chunks in memory.
+    """
+
+    def __init__(self, candle_seconds: int):
+        """
+        Args:
+            candle_seconds (int): size of the candles in seconds
+        """
+        self.candle_seconds = candle_seconds
+        self.duration_ms = candle_seconds * 1000
+
+        self._pair_ids: Dict[str, int] = {}
+        self._pairs: List[str] = []
+        # latest timestamp of every pair id, -1 before its first trade
+        self._latest_ms = np.full(0, -1, dtype=np.int64)
+        # window start, open, high, low, close, volume and timestamp_ms of the open
+        # window of every pair id that has one
+        self._open_windows: Dict[
+            int, Tuple[int, float, float, float, float, float, int]
+        ] = {}
+
+        self.trades_processed = 0
+        self.late_trades = 0
+
+    def add(
+        self,
+        pairs: Sequence[str],
+        price: Sequence[float],
+        volume: Sequence[float],
+        timestamp_ms: Sequence[int],
+    ) -> List[dict]:
+        """
+        Adds a chunk of trades, in the order they were consumed
+
+        Args:
+            pairs (Sequence[str]): the pair of every trade
+            price (Sequence[float]): the price of every trade
+            volume (Sequence[float]): the volume of every trade
+            timestamp_ms (Sequence[int]): the timestamp of every trade
+
+        Returns:
+            List[dict]: the candles this chunk closed, in the format of the candles
+            topic, ordered by window and then by pair
+        """
+        n_trades = len(pairs)
+        self.trades_processed += n_trades
+        if n_trades == 0:
+            return []
+
+        pair_id = np.fromiter(
+            (self._pair_id(pair) for pair in pairs), dtype=np.int64, count=n_trades
+        )
+        price = np.asarray(price, dtype=np.float64)
+        volume = np.asarray(volume, dtype=np.float64)
+        timestamp_ms = np.asarray(timestamp_ms, dtype=np.int64)
+
+        # the open window of a pair goes in front of its trades as one more row, its
+        # open, high, low and close columns holding the aggregates so far
+        carried = [i for i in np.unique(pair_id).tolist() if i in self._open_windows]
+        open_ = high = low = close = price
+        if carried:
+            rows = np.array(
+                [self._open_windows.pop(i) for i in carried], dtype=np.float64
+            )
+            pair_id = np.concatenate([np.array(carried, dtype=np.int64), pair_id])
+            timestamp_ms = np.concatenate([rows[:, 6].astype(np.int64), timestamp_ms])
+            open_, high, low, close, volume = (
+                np.concatenate([rows[:, j], column])
+                for j, column in zip(range(1, 6), (price, price, price, price, volume))
+            )
+            window_start = np.concatenate(
+                [
+                    rows[:, 0].astype(np.int64),
+                    timestamp_ms[len(carried) :]
+                    - timestamp_ms[len(carried) :] % self.duration_ms,
+                ]
+            )
+        else:
+            window_start = timestamp_ms - timestamp_ms % self.duration_ms
+
+        # group the rows by pair, keeping the arrival order within every pair
+        order = np.argsort(pair_id, kind='stable')
+        pair_id = pair_id[order]
+        timestamp_ms = timestamp_ms[order]
+        window_start = window_start[order]
+        open_, high, low, close, volume = (
+            column[order] for column in (open_, high, low, close, volume)
+        )
+
+        # latest timestamp per pair as of every row, including the earlier chunks
+        shifted = pair_id << _PAIR_SHIFT
+        latest_ms = np.maximum.accumulate(timestamp_ms + shifted) - shifted
+        latest_ms = np.maximum(latest_ms, self._latest_ms[pair_id])
+
+        on_time = window_start > latest_ms - self.duration_ms
+        # the open windows carried over are never late
+        self.late_trades += int(len(on_time) - np.count_nonzero(on_time))
+
+        last_of_pair = np.flatnonzero(np.r_[pair_id[1:] != pair_id[:-1], True])
+        self._latest_ms[pair_id[last_of_pair]] = latest_ms[last_of_pair]
+
+        pair_id = pair_id[on_time]
+        timestamp_ms = timestamp_ms[on_time]
+        window_start = window_start[on_time]
+        open_, high, low, close, volume = (
+            column[on_time] for column in (open_, high, low, close, volume)
+        )
+
+        # without the late trades the windows of a pair only move forward, so every
+        # window is one contiguous run of rows
+        n_rows = len(pair_id)
+        if n_rows == 0:
+            return []
+        starts = np.flatnonzero(
+            np.r_[
+                True,
+                (pair_id[1:] != pair_id[:-1]) | (window_start[1:] != window_start[:-1]),
+            ]
+        )
+        ends = np.r_[starts[1:], n_rows] - 1
+
+        candles = (
+            pair_id[starts],
+            window_start[starts],
+            open_[starts],
+            np.maximum.reduceat(high, starts),
+            np.minimum.reduceat(low, starts),
+            close[ends],
+            _sum_in_order(volume, starts, ends),
+            timestamp_ms[ends],
+        )
+
+        # the last window of every pair is still open
+        is_open = np.r_[candles[0][1:] != candles[0][:-1], True]
+        for i, start, o, h, lo, c, v, ts in zip(
+            *(column[is_open].tolist() for column in candles)
+        ):
+            self._open_windows[i] = (start, o, h, lo, c, v, ts)
+
+        closed = [column[~is_open] for column in candles]
+        by_window = np.lexsort((closed[0], closed[1]))
+        return [
+            {
+                'pair': self._pairs[i],
+                'timestamp_ms': ts,
+                'open': o,
+                'high': h,
+                'low': lo,
+                'close': c,
+                'volume': v,
+                'window_start_ms': start,
+                'window_end_ms': start + self.duration_ms,
+                'candle_seconds': self.candle_seconds,
+            }
+            for i, start, o, h, lo, c, v, ts in zip(
+                *(column[by_window].tolist() for column in closed)
+            )
+        ]
+
+    def _pair_id(self, pair: str) -> int:
+        pair_id = self._pair_ids.get(pair)
+        if pair_id is None:
+            pair_id = self._pair_ids[pair] = len(self._pairs)
+            self._pairs.append(pair)
+            self._latest_ms = np.append(self._latest_ms, -1)
+        return pair_id
+
+
+def _sum_in_order(
+    values: np.ndarray, starts: np.ndarray, ends: np.ndarray
+) -> np.ndarray:
+    """
+    Sums the runs values[start:end + 1] one value after the other, like the streaming
+    reducer does. np.add.reduceat sums pairwise, which rounds differently.
+
+    Walks all the runs in step, so it takes as many numpy calls as the longest run
+    has values.
+    """
+    lengths = ends - starts + 1
+    by_length = np.argsort(-lengths, kind='stable')
+    sorted_starts = starts[by_length]
+    sorted_lengths = lengths[by_length]
+
+    sums = values[sorted_starts].copy()
+    for k in range(1, int(sorted_lengths[0])):
+        # the runs longer than k are a prefix of the runs sorted by length
+        n_active = np.searchsorted(-sorted_lengths, -k, side='left')
+        sums[:n_active] += values[sorted_starts[:n_active] + k]
+
+    result = np.empty_like(sums)
+    result[by_length] = sums
+    return result
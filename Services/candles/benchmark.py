@@ -0,0 +1,239 @@
+"""
+Benchmarks of the candles service hot path, single threaded so the numbers read as
+trades per second per core. That the paths give the same candles is checked by the
+tests, `make test`.
+
+    uv run python benchmark.py
+"""
+
+import random
+import time
+from functools import partial
+from typing import Callable, Dict, List, Tuple
+
+from batch_candles import BatchCandleBuilder
+from coalesce import CandleCoalescer
+from quixstreams.utils.json import dumps, loads
+from run import expand_candle, init_candle, update_candle
+
+N_TRADES = 500_000
+CANDLE_SECONDS = 60
+PAIRS = ['BTC/USD', 'BTC/EUR', 'ETH/USD', 'ETH/EUR', 'SOL/USD', 'XRP/USD']
+
+
+def make_trades(n: int, seed: int = 42) -> List[dict]:
+    """
+    Synthetic trades of a few pairs interleaved, mostly in time order with some late
+    ones, like a historical trades topic
+    """
+    rng = random.Random(seed)
+    timestamp_ms = {pair: 1731155565415 for pair in PAIRS}
+    price = {pair: 100.0 * (i + 1) for i, pair in enumerate(PAIRS)}
+    trades = []
+    for _ in range(n):
+        pair = rng.choice(PAIRS)
+        timestamp_ms[pair] += rng.choice((1, 20, 300, 2_000, 15_000))
+        price[pair] *= 1 + rng.gauss(0, 0.0005)
+        trades.append(
+            {
+                'pair': pair,
+                'price': price[pair],
+                'volume': rng.random() * 10 ** rng.randint(-4, 1),
+                # one trade in a hundred arrives a couple of minutes late
+                'timestamp_ms': timestamp_ms[pair]
+                - (120_000 if rng.random() < 0.01 else 0),
+            }
+        )
+    return trades
+
+
+def streaming_candles(
+    trades: List[dict], emit_incomplete_candles: bool = False
+) -> List[dict]:
+    """
+    The candles of the streaming path: init_candle / update_candle applied the way
+    the quixstreams tumbling window does, per pair. Either the final candles, or
+    every update like `current()`.
+    """
+    duration_ms = CANDLE_SECONDS * 1000
+    windows: Dict[str, Dict[int, dict]] = {}
+    latest_ms: Dict[str, int] = {}
+    candles = []
+    for trade in trades:
+        pair = trade['pair']
+        open_windows = windows.setdefault(pair, {})
+        latest = max(trade['timestamp_ms'], latest_ms.get(pair, 0))
+        max_expired_start = latest - duration_ms
+
+        start = trade['timestamp_ms'] - trade['timestamp_ms'] % duration_ms
+        if start > max_expired_start:
+            candle = open_windows.get(start)
+            open_windows[start] = (
+                init_candle(trade) if candle is None else update_candle(candle, trade)
+            )
+            latest_ms[pair] = latest
+            if emit_incomplete_candles:
+                candles.append(_flatten(open_windows[start], start))
+
+        for expired_start in sorted(s for s in open_windows if s <= max_expired_start):
+            candle = open_windows.pop(expired_start)
+            if not emit_incomplete_candles:
+                candles.append(_flatten(candle, expired_start))
+    return candles
+
+
+def _flatten(candle: list, window_start_ms: int) -> dict:
+    window = {
+        'start': window_start_ms,
+        'end': window_start_ms + CANDLE_SECONDS * 1000,
+        'value': candle,
+    }
+    return expand_candle(window, CANDLE_SECONDS)
+
+
+def dict_init_candle(trade: dict) -> dict:
+    """
+    The candle in progress as a dict, the way the window state kept it before it
+    was packed into a list, to compare against
+    """
+    return {
+        'open': trade['price'],
+        'high': trade['price'],
+        'low': trade['price'],
+        'close': trade['price'],
+        'volume': trade['volume'],
+        'timestamp_ms': trade['timestamp_ms'],
+        'pair': trade['pair'],
+    }
+
+
+def dict_update_candle(candle: dict, trade: dict) -> dict:
+    candle['high'] = max(candle['high'], trade['price'])
+    candle['low'] = min(candle['low'], trade['price'])
+    candle['close'] = trade['price']
+    candle['volume'] += trade['volume']
+    candle['timestamp_ms'] = trade['timestamp_ms']
+    candle['pair'] = trade['pair']
+    return candle
+
+
+def reducer_cost(
+    trades: List[dict], initializer: Callable, reducer: Callable
+) -> Tuple[float, float]:
+    """
+    Per trade cost of the window reduce as the state store sees it: the candle of
+    the window is loaded, updated and dumped again with the JSON of the state store
+    for every trade
+
+    Returns:
+        Tuple[float, float]: µs per trade, and bytes of the stored candle per window
+    """
+    duration_ms = CANDLE_SECONDS * 1000
+    windows: Dict[tuple, bytes] = {}
+    start = time.perf_counter()
+    for trade in trades:
+        key = (trade['pair'], trade['timestamp_ms'] // duration_ms)
+        stored = windows.get(key)
+        candle = initializer(trade) if stored is None else reducer(loads(stored), trade)
+        windows[key] = dumps(candle)
+    elapsed = time.perf_counter() - start
+    n_bytes = sum(len(stored) for stored in windows.values()) / len(windows)
+    return elapsed / len(trades) * 1e6, n_bytes
+
+
+def batch_candles(trades: List[dict], chunk_size: int) -> List[dict]:
+    builder = BatchCandleBuilder(CANDLE_SECONDS)
+    candles = []
+    for i in range(0, len(trades), chunk_size):
+        chunk = trades[i : i + chunk_size]
+        candles.extend(
+            builder.add(
+                [trade['pair'] for trade in chunk],
+                [trade['price'] for trade in chunk],
+                [trade['volume'] for trade in chunk],
+                [trade['timestamp_ms'] for trade in chunk],
+            )
+        )
+    return candles
+
+
+def coalesce(
+    updates: List[dict], min_interval_ms: int, min_change: float
+) -> Tuple[CandleCoalescer, List[dict]]:
+    """
+    Runs the incomplete candles through the coalescer
+
+    Returns:
+        Tuple[CandleCoalescer, List[dict]]: the coalescer, and the updates it let
+        through
+    """
+    coalescer = CandleCoalescer(min_interval_ms=min_interval_ms, min_change=min_change)
+    windows: Dict[str, list] = {}
+    emitted = []
+    for candle in updates:
+        candles, windows[candle['pair']] = coalescer.update_window(
+            candle, windows.get(candle['pair'])
+        )
+        emitted.extend(candles)
+    return coalescer, emitted
+
+
+def by_pair(candles: List[dict]) -> Dict[str, List[dict]]:
+    """
+    The candles of every pair in order, the only order Kafka keeps
+    """
+    result: Dict[str, List[dict]] = {}
+    for candle in candles:
+        result.setdefault(candle['pair'], []).append(candle)
+    return result
+
+
+def measure(
+    name: str, build: Callable[[List[dict]], List[dict]], trades: List[dict]
+) -> List[dict]:
+    start = time.perf_counter()
+    candles = build(trades)
+    elapsed = time.perf_counter() - start
+    print(
+        f'{name:>22}: {len(trades) / elapsed:>12,.0f} trades/s per core, '
+        f'{len(candles)} candles'
+    )
+    return candles
+
+
+if __name__ == '__main__':
+    trades = make_trades(N_TRADES)
+
+    measure('streaming reducer', streaming_candles, trades)
+    for chunk_size in (1_000, 10_000, 100_000):
+        measure(
+            f'batch, {chunk_size:,} trades',
+            partial(batch_candles, chunk_size=chunk_size),
+            trades,
+        )
+
+    print()
+    for name, initializer, reducer in (
+        ('dict state', dict_init_candle, dict_update_candle),
+        ('packed state', init_candle, update_candle),
+    ):
+        us_per_trade, n_bytes = reducer_cost(trades, initializer, reducer)
+        print(
+            f'{name:>22}: {us_per_trade:.2f} µs per trade with the state round '
+            f'trip, {n_bytes:.0f} bytes per window'
+        )
+
+    updates = streaming_candles(trades, emit_incomplete_candles=True)
+    print(f'\n{len(updates):,} incomplete candle updates')
+    for min_interval_ms, min_change in (
+        (1_000, 0.0),
+        (5_000, 0.0),
+        (0, 0.0005),
+        (5_000, 0.001),
+    ):
+        coalescer, _ = coalesce(updates, min_interval_ms, min_change)
+        print(
+            f'{min_interval_ms:>6} ms, {min_change:>7.2%} change: '
+            f'{coalescer.emitted:>8,} emitted, {coalescer.suppressed:>8,} suppressed '
+            f'({coalescer.suppressed / len(updates):.0%})'
+        )
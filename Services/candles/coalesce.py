@@ -0,0 +1,135 @@
+import time
+from typing import List, Optional, Tuple
+
+from loguru import logger
+from quixstreams import State
+
+# the fields of the last update that went out the next updates are compared to
+DUE_FIELDS = ('timestamp_ms', 'open', 'high', 'low', 'close')
+
+
+class CandleCoalescer:
+    """
+    Thins out the updates of the candles in progress, which `current()` emits once
+    per trade.
+
+    An update goes out when the candle moved at least `min_change` (relative) in
+    open, high, low or close since the last update that went out, or when
+    `min_interval_ms` of trade time passed since then. The first update of every
+    window always goes out.
+
+    The final version of a window goes out too, but only once the next window of
+    the pair opens: the last update of a window is held back, and emitted right
+    before the first update of the next window if it was not emitted already. In
+    live runs the ticks of the wall-clock watermark open the next window on time
+    (WINDOW_CLOSE_DELAY_MS, see watermark.py). Without them the final candle of a
+    quiet pair waits for its next trade, so the service refuses a policy without
+    the watermark in live runs. In historical runs the last window of every pair
+    stays held back, like it stays open with `final()`.
+
+    Time is the timestamp of the trades, so replays coalesce exactly like live runs.
+
+    The state of a pair is rewritten on every update, so it only keeps the window
+    start and the `DUE_FIELDS` of the last update that went out, and the values of
+    the update held back.
+    """
+
+    def __init__(
+        self,
+        min_interval_ms: int = 0,
+        min_change: float = 0.0,
+        stats_interval_sec: float = 60.0,
+    ):
+        """
+        Args:
+            min_interval_ms (int): emit an update at most this often, 0 to not
+                limit by time
+            min_change (float): emit an update whenever open, high, low or close
+                moved this much relative to the last update that went out, 0 to not
+                emit on changes
+            stats_interval_sec (float): how often to log the suppressed updates
+        """
+        self.min_interval_ms = min_interval_ms
+        self.min_change = min_change
+        self.stats_interval_sec = stats_interval_sec
+
+        self.emitted = 0
+        self.suppressed = 0
+        self._logged_at = time.monotonic()
+
+    def update(self, candle: dict, state: State) -> List[dict]:
+        """
+        Stateful apply of the streaming dataframe, with one state per pair
+
+        Returns:
+            List[dict]: the candles to emit, none, one, or the final version of the
+            previous window followed by this one
+        """
+        candles, window = self.update_window(candle, state.get('coalesce'))
+        state.set('coalesce', window)
+
+        if time.monotonic() - self._logged_at >= self.stats_interval_sec:
+            self.log_stats()
+        return candles
+
+    def update_window(
+        self, candle: dict, window: Optional[list]
+    ) -> Tuple[List[dict], list]:
+        """
+        Same as `update()` on the coalescing state of a pair
+
+        Args:
+            candle (dict): the update of the candle in progress
+            window (Optional[list]): the coalescing state of the pair, None for a
+                new pair
+
+        Returns:
+            Tuple[List[dict], list]: the candles to emit, and the new state
+        """
+        candles = []
+        if window is None or window[0] != candle['window_start_ms']:
+            # the held back update was the final version of the previous window,
+            # every update has the fields of the candle in the same order
+            if window is not None and window[-1] is not None:
+                candles.append(dict(zip(candle, window[-1])))
+                self.suppressed -= 1
+            candles.append(candle)
+        elif self._is_due(candle, window[1:-1]):
+            candles.append(candle)
+
+        if candles and candles[-1] is candle:
+            window = [
+                candle['window_start_ms'],
+                *(candle[field] for field in DUE_FIELDS),
+                None,
+            ]
+        else:
+            window[-1] = list(candle.values())
+            self.suppressed += 1
+
+        self.emitted += len(candles)
+        return candles, window
+
+    def log_stats(self):
+        total = max(self.emitted + self.suppressed, 1)
+        logger.info(
+            f'Emitted {self.emitted} candle updates, suppressed {self.suppressed} '
+            f'({self.suppressed / total:.0%})'
+        )
+        self._logged_at = time.monotonic()
+
+    def _is_due(self, candle: dict, last_emitted: list) -> bool:
+        # last_emitted has the DUE_FIELDS of the last update that went out
+        if (
+            self.min_interval_ms
+            and candle['timestamp_ms'] - last_emitted[0] >= self.min_interval_ms
+        ):
+            return True
+
+        if self.min_change:
+            for field, last in zip(DUE_FIELDS[1:], last_emitted[1:]):
+                if abs(candle[field] - last) >= self.min_change * abs(last):
+                    return True
+
+        # with no policy set every update goes out
+        return not (self.min_interval_ms or self.min_change)
@@ -1,4 +1,4 @@
-from typing import Literal, Optional
+from typing import List, Literal, Optional
 
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
@@ -11,9 +11,30 @@ class Config(BaseSettings):
     kafka_input_topic: str
     kafka_output_topic: str
     kafka_consumer_group: str
+    # partitions of the candles topic when this service creates it, the ta workers
+    # share them, one partition by default
+    kafka_output_topic_partitions: Optional[int] = None
     candle_seconds: int
     emit_incomplete_candles: Optional[bool] = True
+    # thin out the incomplete candles: an update at most every interval of trade
+    # time, or when the OHLC moved this much relative, plus the final one once the
+    # next window opens, live runs need WINDOW_CLOSE_DELAY_MS for that
+    incomplete_candles_min_interval_ms: Optional[int] = 0
+    incomplete_candles_min_change: Optional[float] = 0.0
+    # higher timeframes rolled up from the candle_seconds candles in the same pass,
+    # e.g. [300, 900, 3600]
+    rollup_candle_seconds: Optional[List[int]] = []
     data_source: Literal['live', 'historical']
+    # live runs close the windows on wall-clock time this long after they end, and
+    # emit zero-volume candles for the windows without trades. Unset, a window only
+    # closes when a later trade of its pair comes in.
+    window_close_delay_ms: Optional[int] = None
+    # encoding of the candles, binary is smaller and json easier to debug
+    wire_format: Literal['json', 'binary'] = 'json'
+    # historical runs of final candles can build the candles of whole chunks of
+    # trades at once with numpy instead of one trade at a time
+    batch_candles: Optional[bool] = False
+    batch_max_trades: Optional[int] = 100_000
 
 
 config = Config()
@@ -0,0 +1,129 @@
+from typing import Dict, List, Optional
+
+from quixstreams import State
+
+
+class CandleRollup:
+    """
+    Rolls the base candles up into candles of higher timeframes, so a single candles
+    service consumes the trades once and emits every timeframe.
+
+    Every timeframe keeps the base candles of its current window folded into one
+    candle, plus the latest version of the base candle in progress. With final base
+    candles a rolled up candle is emitted once, as soon as its window is complete,
+    or when the first base candle of a later window shows up if the last base
+    windows had no trades. With incomplete base candles every update of the base
+    candle also updates the rolled up candles in progress.
+    """
+
+    def __init__(
+        self,
+        candle_seconds: int,
+        rollup_candle_seconds: List[int],
+        emit_incomplete_candles: bool,
+    ):
+        """
+        Args:
+            candle_seconds (int): size of the base candles in seconds
+            rollup_candle_seconds (List[int]): the sizes to roll the base candles up
+                into, each a multiple of candle_seconds
+            emit_incomplete_candles (bool): the base candles are every update of the
+                current candle rather than only the closed ones
+        """
+        for seconds in rollup_candle_seconds:
+            if seconds <= candle_seconds or seconds % candle_seconds:
+                raise ValueError(
+                    f'Cannot roll {candle_seconds}s candles up into {seconds}s ones, '
+                    f'it must be a larger multiple'
+                )
+
+        self.candle_seconds = candle_seconds
+        self.rollup_candle_seconds = sorted(rollup_candle_seconds)
+        self.emit_incomplete_candles = emit_incomplete_candles
+
+    def update(self, candle: dict, state: State) -> List[dict]:
+        """
+        Stateful apply of the streaming dataframe, with one state per pair
+
+        Returns:
+            List[dict]: the base candle followed by the rolled up candles it updated
+            or closed
+        """
+        windows = state.get('rollup', default={})
+        candles = self.update_windows(candle, windows)
+        state.set('rollup', windows)
+        return candles
+
+    def update_windows(self, candle: dict, windows: Dict[str, dict]) -> List[dict]:
+        """
+        Same as `update()` on the rolled up windows of a pair as a plain dict
+        """
+        candles = [candle]
+        for seconds in self.rollup_candle_seconds:
+            duration_ms = seconds * 1000
+            start_ms = (
+                candle['window_start_ms'] - candle['window_start_ms'] % duration_ms
+            )
+
+            # state keys are strings, so the timeframes are too
+            window = windows.get(str(seconds))
+            if window is not None and window['window_start_ms'] != start_ms:
+                # a later window started while this one still had a candle pending,
+                # its last base windows had no trades
+                if not self.emit_incomplete_candles:
+                    candles.append(self._rolled_up(window, seconds))
+                window = None
+
+            if window is None:
+                window = {'window_start_ms': start_ms, 'folded': None, 'last': None}
+            elif window['last']['window_start_ms'] != candle['window_start_ms']:
+                # the base candle in progress is complete, fold it in
+                window['folded'] = _merge(window['folded'], window['last'])
+            window['last'] = candle
+
+            is_complete = candle['window_end_ms'] == start_ms + duration_ms
+            if self.emit_incomplete_candles:
+                candles.append(self._rolled_up(window, seconds))
+                windows[str(seconds)] = window
+            elif is_complete:
+                candles.append(self._rolled_up(window, seconds))
+                windows.pop(str(seconds), None)
+            else:
+                windows[str(seconds)] = window
+
+        return candles
+
+    def _rolled_up(self, window: dict, seconds: int) -> dict:
+        merged = _merge(window['folded'], window['last'])
+        return {
+            'pair': merged['pair'],
+            'timestamp_ms': merged['timestamp_ms'],
+            'open': merged['open'],
+            'high': merged['high'],
+            'low': merged['low'],
+            'close': merged['close'],
+            'volume': merged['volume'],
+            'window_start_ms': window['window_start_ms'],
+            'window_end_ms': window['window_start_ms'] + seconds * 1000,
+            'candle_seconds': seconds,
+        }
+
+
+def _merge(first: Optional[dict], second: dict) -> dict:
+    """
+    Merges two consecutive candles of the same pair into one
+    """
+    if first is None:
+        return second
+    return {
+        'pair': second['pair'],
+        'timestamp_ms': second['timestamp_ms'],
+        'open': first['open'],
+        'high': max(first['high'], second['high']),
+        'low': min(first['low'], second['low']),
+        'close': second['close'],
+        'volume': first['volume'] + second['volume'],
+        'window_start_ms': first['window_start_ms'],
+        'window_end_ms': second['window_end_ms'],
+        'candle_seconds': second['candle_seconds'],
+    }
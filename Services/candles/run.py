@@ -1,9 +1,21 @@
+import time
+from collections import defaultdict
 from datetime import timedelta
 from typing import Any, List, Literal, Optional, Tuple
 
+from batch_candles import BatchCandleBuilder
+from coalesce import CandleCoalescer
 from loguru import logger
 from quixstreams import Application
-from quixstreams.models import TimestampType
+from quixstreams.models import (
+    SerializationContext,
+    TimestampType,
+    Topic,
+    TopicConfig,
+)
+from rollup import CandleRollup
+from watermark import WallClockWatermark
+from wire_format import CANDLE_SCHEMA, WireDeserializer, WireFormat, get_serializer
 
 
 def custom_ts_extractor(
@@ -20,7 +32,13 @@ def custom_ts_extractor(
     return value['timestamp_ms']
 
 
-def init_candle(trade: dict) -> dict:
+# the candle in progress is a list of these fields in the window state, which is
+# written to the state store on every trade, so without the key names
+CANDLE_STATE_FIELDS = ('open', 'high', 'low', 'close', 'volume', 'timestamp_ms', 'pair')
+OPEN, HIGH, LOW, CLOSE, VOLUME, TIMESTAMP_MS, PAIR = range(len(CANDLE_STATE_FIELDS))
+
+
+def init_candle(trade: dict) -> list:
     """
     Initialize the candle with the first trade
 
@@ -28,39 +46,83 @@ def init_candle(trade: dict) -> dict:
         trade (dict): trade to initialize the candle with
 
     Returns:
-        dict: initialized candle
+        list: initialized candle, packed like CANDLE_STATE_FIELDS
     """
-    return {
-        'open': trade['price'],
-        'high': trade['price'],
-        'low': trade['price'],
-        'close': trade['price'],
-        'volume': trade['volume'],
-        'timestamp_ms': trade['timestamp_ms'],
-        'pair': trade['pair'],  # Add this to track the pair
-    }
+    price = trade['price']
+    return [
+        price,
+        price,
+        price,
+        price,
+        trade['volume'],
+        trade['timestamp_ms'],
+        trade['pair'],
+    ]
 
 
-def update_candle(candle: dict, trade: dict) -> dict:
+def update_candle(candle: list, trade: dict) -> list:
     """
     Update the candle with the new trade
 
+    Zero-volume trades are the ticks of the wall-clock watermark, see watermark.py.
+    They don't touch a candle that has trades, and the first real trade replaces a
+    candle that only has ticks.
+
     Args:
-        candle (dict): candle to update
+        candle (list): candle to update, packed like CANDLE_STATE_FIELDS
         trade (dict): trade to update the candle with
 
     Returns:
-        dict: updated candle
+        list: updated candle
     """
-    candle['high'] = max(candle['high'], trade['price'])
-    candle['low'] = min(candle['low'], trade['price'])
-    candle['close'] = trade['price']
-    candle['volume'] += trade['volume']
-    candle['timestamp_ms'] = trade['timestamp_ms']
-    candle['pair'] = trade['pair']
+    if isinstance(candle, dict):
+        # a window of the state written before the candles were packed
+        candle = [candle[field] for field in CANDLE_STATE_FIELDS]
+
+    if trade['volume'] == 0:
+        return candle
+    if candle[VOLUME] == 0:
+        return init_candle(trade)
+
+    price = trade['price']
+    if price > candle[HIGH]:
+        candle[HIGH] = price
+    elif price < candle[LOW]:
+        candle[LOW] = price
+    candle[CLOSE] = price
+    candle[VOLUME] += trade['volume']
+    candle[TIMESTAMP_MS] = trade['timestamp_ms']
     return candle
 
 
+def expand_candle(window: dict, candle_seconds: int) -> dict:
+    """
+    The message of the candles topic for a window of the tumbling window
+
+    Args:
+        window (dict): the window, with its start, end and packed candle as value
+        candle_seconds (int): size of the candles in seconds
+
+    Returns:
+        dict: the candle with its window
+    """
+    candle = window['value']
+    if isinstance(candle, dict):
+        candle = [candle[field] for field in CANDLE_STATE_FIELDS]
+    return {
+        'pair': candle[PAIR],
+        'timestamp_ms': candle[TIMESTAMP_MS],
+        'open': candle[OPEN],
+        'high': candle[HIGH],
+        'low': candle[LOW],
+        'close': candle[CLOSE],
+        'volume': candle[VOLUME],
+        'window_start_ms': window['start'],
+        'window_end_ms': window['end'],
+        'candle_seconds': candle_seconds,
+    }
+
+
 def main(
     kafka_broker_address: str,
     kafka_input_topic: str,
@@ -69,11 +131,20 @@ def main(
     candle_seconds: int,
     emit_incomplete_candles: bool,
     data_source: Literal['live', 'historical'],
+    wire_format: WireFormat = 'json',
+    batch_candles: bool = False,
+    batch_max_trades: int = 100_000,
+    rollup_candle_seconds: Optional[List[int]] = None,
+    incomplete_candles_min_interval_ms: int = 0,
+    incomplete_candles_min_change: float = 0.0,
+    window_close_delay_ms: Optional[int] = None,
+    kafka_output_topic_partitions: Optional[int] = None,
 ):
     """
     1. ingests trades from the kafka topic
     2. processes trades and generates candles using tumbling window
-    3. pushes candles to the kafka topic
+    3. rolls the candles up into the higher timeframes, if any
+    4. pushes candles to the kafka topic
 
     Args:
         kafka_broker_address (str): kafka broker address
@@ -83,6 +154,23 @@ def main(
         candles_seconds (int): size of the candles in seconds
         emit_incomplete_candles (bool): Emit incomplete candles or just the final one
         data_source (Literal['live', 'historical']): Data source
+        wire_format (WireFormat): encode the candles as 'json' or 'binary'
+        batch_candles (bool): build the candles of whole chunks of trades at once,
+            only for historical runs of final candles
+        batch_max_trades (int): maximum number of trades per chunk
+        rollup_candle_seconds (Optional[List[int]]): higher timeframes to emit as
+            well, each a multiple of candle_seconds
+        incomplete_candles_min_interval_ms (int): emit the updates of a candle in
+            progress at most this often, in trade time
+        incomplete_candles_min_change (float): or whenever its OHLC moved this much,
+            relative. With neither set every update is emitted. The final version
+            of a candle goes out when the next window opens, so live runs with
+            either set need window_close_delay_ms.
+        window_close_delay_ms (Optional[int]): in live runs, close the windows on
+            wall-clock time this long after they end, and fill the windows without
+            trades with zero-volume candles. None to only close them on later trades.
+        kafka_output_topic_partitions (Optional[int]): partitions of the candles
+            topic when this service creates it, one per ta worker at most
 
     Returns:
         None
@@ -90,6 +178,16 @@ def main(
 
     logger.info('starting candles service!')
 
+    coalesce = emit_incomplete_candles and (
+        incomplete_candles_min_interval_ms or incomplete_candles_min_change
+    )
+    if coalesce and data_source == 'live' and window_close_delay_ms is None:
+        raise ValueError(
+            'Coalescing the incomplete candles holds back the final version of a '
+            'candle until the next window of its pair opens, set '
+            'WINDOW_CLOSE_DELAY_MS so the watermark opens it on time'
+        )
+
     # initialize the quixstreams application
     app = Application(
         broker_address=kafka_broker_address,
@@ -100,16 +198,49 @@ def main(
     # Define a topic where the trades will be read
     input_topic = app.topic(
         name=kafka_input_topic,
-        value_deserializer='json',
+        value_deserializer=WireDeserializer(),
         timestamp_extractor=custom_ts_extractor,
     )
 
-    # Define a topic where the candles will be pushed
-    output_topic = app.topic(name=kafka_output_topic, value_serializer='json')
+    # Define a topic where the candles will be pushed. The ta workers share its
+    # partitions, a topic that exists already keeps the partitions it has.
+    output_topic = app.topic(
+        name=kafka_output_topic,
+        value_serializer=get_serializer(wire_format, CANDLE_SCHEMA),
+        config=TopicConfig(
+            num_partitions=kafka_output_topic_partitions, replication_factor=1
+        )
+        if kafka_output_topic_partitions
+        else None,
+    )
+
+    rollup = None
+    if rollup_candle_seconds:
+        rollup = CandleRollup(
+            candle_seconds, rollup_candle_seconds, emit_incomplete_candles
+        )
+
+    if batch_candles:
+        if data_source != 'historical' or emit_incomplete_candles:
+            raise ValueError(
+                'Batch candles are only for historical runs of final candles'
+            )
+        run_batches(
+            app, input_topic, output_topic, candle_seconds, batch_max_trades, rollup
+        )
+        return
 
     # create a streaming dataframe from the input topic
     sdf = app.dataframe(topic=input_topic)
 
+    if data_source == 'live' and window_close_delay_ms is not None:
+        watermark = WallClockWatermark(candle_seconds, window_close_delay_ms)
+        # the trades are regrouped by pair into an internal topic of this service,
+        # the watermark puts its ticks there so the trades topic only holds trades
+        sdf = sdf.group_by('pair')
+        sdf = sdf.update(watermark.observe)
+        watermark.start(app, sdf.topic)
+
     # start defining the transformation, for our candles service is stateful transformation using windowed aggregation
     # quixstreams documentation https://quix.io/docs/quix-streams/windowing.html#updating-window-definitions
 
@@ -123,35 +254,21 @@ def main(
     else:
         sdf = sdf.final()
 
-    # extract open, high, low, close, volume and timestamp_ms, pair from dataframe, because it is nested json and we want to flatten
-    sdf['open'] = sdf['value']['open']
-    sdf['high'] = sdf['value']['high']
-    sdf['low'] = sdf['value']['low']
-    sdf['close'] = sdf['value']['close']
-    sdf['volume'] = sdf['value']['volume']
-    sdf['timestamp_ms'] = sdf['value']['timestamp_ms']
-    sdf['pair'] = sdf['value']['pair']
-
-    # extract window start and end timestamps
-    sdf['window_start_ms'] = sdf['start']
-    sdf['window_end_ms'] = sdf['end']
-
-    # keep only the columns we need
-    sdf = sdf[
-        [
-            'pair',
-            'timestamp_ms',
-            'open',
-            'high',
-            'low',
-            'close',
-            'volume',
-            'window_start_ms',
-            'window_end_ms',
-        ]
-    ]
+    # unpack the candle and its window into the flat message of the candles topic
+    sdf = sdf.apply(lambda window: expand_candle(window, candle_seconds))
 
-    sdf['candle_seconds'] = candle_seconds
+    # only let through the updates of the candles in progress that matter, and the
+    # final version of every candle
+    if coalesce:
+        coalescer = CandleCoalescer(
+            min_interval_ms=incomplete_candles_min_interval_ms,
+            min_change=incomplete_candles_min_change,
+        )
+        sdf = sdf.apply(coalescer.update, stateful=True, expand=True)
+
+    # one message per timeframe, each tagged with its candle_seconds
+    if rollup is not None:
+        sdf = sdf.apply(rollup.update, stateful=True, expand=True)
 
     sdf = sdf.update(lambda value: logger.info(f'Candle: {value}'))
     sdf = sdf.to_topic(topic=output_topic)
@@ -159,6 +276,107 @@ def main(
     app.run()
 
 
+def run_batches(
+    app: Application,
+    input_topic: Topic,
+    output_topic: Topic,
+    candle_seconds: int,
+    batch_max_trades: int,
+    rollup: Optional[CandleRollup] = None,
+    stats_interval_sec: float = 10.0,
+):
+    """
+    Historical alternative to the streaming dataframe: consumes the trades in chunks
+    and builds their candles with array operations, instead of one trade at a time
+    through the window state store.
+
+    The output is the same as the `final()` path. The open windows live in memory
+    only, so after a restart the first candle of every pair misses the trades
+    consumed before it. Historical runs start from a fresh consumer group anyway.
+
+    Args:
+        app (Application): the quixstreams application
+        input_topic (Topic): topic to read trades from
+        output_topic (Topic): topic to push candles to
+        candle_seconds (int): size of the candles in seconds
+        batch_max_trades (int): maximum number of trades per chunk
+        rollup (Optional[CandleRollup]): rolls the candles up into higher timeframes
+        stats_interval_sec (float): how often to log the throughput
+    """
+    builder = BatchCandleBuilder(candle_seconds)
+    deserializer = WireDeserializer()
+    ctx = SerializationContext(topic=input_topic.name, field='value')
+    # the candles keep the message key of their trades
+    keys = {}
+    # the rolled up windows of every pair
+    rollup_windows = defaultdict(dict)
+
+    started_at = time.monotonic()
+    logged_at = started_at
+    n_candles = 0
+
+    with (
+        app.get_consumer(auto_commit_enable=False) as consumer,
+        app.get_producer() as producer,
+    ):
+        consumer.subscribe([input_topic.name])
+
+        while True:
+            messages = []
+            while len(messages) < batch_max_trades:
+                msg = consumer.poll(timeout=0.1 if messages else 1.0)
+                if msg is None:
+                    break
+                if msg.error():
+                    raise RuntimeError(f'Failed to consume trades: {msg.error()}')
+                messages.append(msg)
+
+            if not messages:
+                continue
+
+            trades = [deserializer(msg.value(), ctx) for msg in messages]
+            for msg, trade in zip(messages, trades):
+                keys[trade['pair']] = msg.key()
+
+            candles = builder.add(
+                [trade['pair'] for trade in trades],
+                [trade['price'] for trade in trades],
+                [trade['volume'] for trade in trades],
+                [trade['timestamp_ms'] for trade in trades],
+            )
+            if rollup is not None:
+                candles = [
+                    rolled_up
+                    for candle in candles
+                    for rolled_up in rollup.update_windows(
+                        candle, rollup_windows[candle['pair']]
+                    )
+                ]
+
+            for candle in candles:
+                # like final(), the candle is timestamped with its window start
+                producer.produce(
+                    topic=output_topic.name,
+                    key=keys[candle['pair']],
+                    value=output_topic.serialize(value=candle).value,
+                    timestamp=candle['window_start_ms'],
+                )
+
+            # the candles are in the topic before the trades are marked as consumed
+            producer.flush()
+            consumer.commit(asynchronous=False)
+            n_candles += len(candles)
+
+            if time.monotonic() - logged_at >= stats_interval_sec:
+                elapsed_sec = time.monotonic() - started_at
+                logger.info(
+                    f'{builder.trades_processed / elapsed_sec:,.0f} trades/s, '
+                    f'{builder.trades_processed} trades into {n_candles} candles, '
+                    f'{builder.late_trades} late trades dropped'
+                )
+                logged_at = time.monotonic()
+
+
 if __name__ == '__main__':
     from config import config
 
@@ -170,4 +388,12 @@ if __name__ == '__main__':
         candle_seconds=config.candle_seconds,
         emit_incomplete_candles=config.emit_incomplete_candles,
         data_source=config.data_source,
+        wire_format=config.wire_format,
+        batch_candles=config.batch_candles,
+        batch_max_trades=config.batch_max_trades,
+        rollup_candle_seconds=config.rollup_candle_seconds,
+        incomplete_candles_min_interval_ms=config.incomplete_candles_min_interval_ms,
+        incomplete_candles_min_change=config.incomplete_candles_min_change,
+        window_close_delay_ms=config.window_close_delay_ms,
+        kafka_output_topic_partitions=config.kafka_output_topic_partitions,
     )
@@ -0,0 +1,83 @@
+"""
+Helpers of the tests that run the service against a broker
+"""
+
+import time
+import uuid
+from typing import Callable, List, Tuple
+
+from confluent_kafka import Consumer, Producer
+from confluent_kafka.admin import AdminClient, NewTopic
+from quixstreams.utils.json import dumps, loads
+
+
+def create_topics(
+    kafka_broker_address: str, *prefixes: str, num_partitions: int = 1
+) -> List[str]:
+    """
+    Creates a fresh topic for every prefix, so the tests never share one
+
+    Returns:
+        List[str]: the names of the topics
+    """
+    names = [f'{prefix}-{uuid.uuid4().hex[:8]}' for prefix in prefixes]
+    admin = AdminClient({'bootstrap.servers': kafka_broker_address})
+    futures = admin.create_topics(
+        [NewTopic(name, num_partitions=num_partitions) for name in names]
+    )
+    for future in futures.values():
+        future.result(timeout=10)
+    return names
+
+
+def produce(kafka_broker_address: str, topic: str, messages: List[Tuple[str, dict]]):
+    """
+    Produces the (key, value) messages as JSON and waits for them to be delivered
+    """
+    producer = Producer({'bootstrap.servers': kafka_broker_address})
+    for key, value in messages:
+        producer.produce(topic, key=key.encode(), value=dumps(value))
+    producer.flush(10)
+
+
+def consume(
+    kafka_broker_address: str,
+    topic: str,
+    done: Callable[[List[dict]], bool],
+    timeout_sec: float,
+    on_poll: Callable[[], None] = lambda: None,
+) -> List[dict]:
+    """
+    Reads the topic from the start until `done` holds for the messages read, or
+    the timeout
+
+    Args:
+        kafka_broker_address (str): the broker
+        topic (str): topic to read
+        done (Callable[[List[dict]], bool]): whether enough messages were read
+        timeout_sec (float): how long to wait for them
+        on_poll (Callable[[], None]): called before every poll
+
+    Returns:
+        List[dict]: the values read
+    """
+    consumer = Consumer(
+        {
+            'bootstrap.servers': kafka_broker_address,
+            'group.id': f'test-{uuid.uuid4()}',
+            'auto.offset.reset': 'earliest',
+        }
+    )
+    consumer.subscribe([topic])
+    messages = []
+    deadline = time.monotonic() + timeout_sec
+    try:
+        while not done(messages) and time.monotonic() < deadline:
+            on_poll()
+            msg = consumer.poll(timeout=0.2)
+            if msg is None or msg.error():
+                continue
+            messages.append(loads(msg.value()))
+    finally:
+        consumer.close()
+    return messages
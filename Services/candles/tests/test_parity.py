@@ -0,0 +1,199 @@
+"""
+The candles of every path against the streaming reducer: the batch builder, the
+rolled up timeframes and the coalesced updates, and the service itself running the
+quixstreams `tumbling_window().reduce().final()` pipeline against a broker.
+"""
+
+import multiprocessing
+from typing import Dict, List, Optional
+
+import pytest
+from benchmark import (
+    CANDLE_SECONDS,
+    batch_candles,
+    by_pair,
+    coalesce,
+    make_trades,
+    streaming_candles,
+)
+from broker import consume, create_topics, produce
+from rollup import CandleRollup
+from run import main
+
+N_TRADES = 50_000
+# spread over the pairs, the service still closes a few hundred windows
+N_SERVICE_TRADES = 5_000
+COALESCING_POLICIES = [(1_000, 0.0), (5_000, 0.0), (0, 0.0005), (5_000, 0.001)]
+
+
+@pytest.fixture(scope='module')
+def trades() -> List[dict]:
+    return make_trades(N_TRADES)
+
+
+def rolled_up(
+    candles: List[dict], rollup_candle_seconds: List[int], emit_incomplete: bool
+) -> List[dict]:
+    rollup = CandleRollup(CANDLE_SECONDS, rollup_candle_seconds, emit_incomplete)
+    windows: Dict[str, dict] = {}
+    return [
+        rolled
+        for candle in candles
+        for rolled in rollup.update_windows(
+            candle, windows.setdefault(candle['pair'], {})
+        )
+    ]
+
+
+def final_versions(updates: List[dict]) -> Dict[tuple, dict]:
+    """
+    The last update of every window but the one still open of each pair
+    """
+    last = {}
+    for candle in updates:
+        last[candle['pair'], candle['window_start_ms']] = candle
+    still_open = {}
+    for pair, window_start_ms in last:
+        still_open[pair] = max(window_start_ms, still_open.get(pair, 0))
+    return {key: candle for key, candle in last.items() if key[1] != still_open[key[0]]}
+
+
+@pytest.mark.parametrize('chunk_size', [1_000, 10_000, 100_000])
+def test_batch_candles_match_the_streaming_reducer(trades, chunk_size):
+    expected = by_pair(streaming_candles(trades))
+
+    assert by_pair(batch_candles(trades, chunk_size)) == expected
+
+
+def test_rolled_up_updates_end_in_the_rolled_up_final_candles(trades):
+    final = rolled_up(streaming_candles(trades), [300, 900], emit_incomplete=False)
+    updates = rolled_up(
+        streaming_candles(trades, emit_incomplete_candles=True),
+        [300, 900],
+        emit_incomplete=True,
+    )
+
+    for seconds in (300, 900):
+        closed = [c for c in final if c['candle_seconds'] == seconds]
+        last_updates = final_versions(
+            [c for c in updates if c['candle_seconds'] == seconds]
+        )
+        assert closed
+        for candle in closed:
+            assert last_updates[candle['pair'], candle['window_start_ms']] == candle
+
+
+@pytest.mark.parametrize('min_interval_ms, min_change', COALESCING_POLICIES)
+def test_coalescing_emits_the_final_version_of_every_window(
+    trades, min_interval_ms, min_change
+):
+    updates = streaming_candles(trades, emit_incomplete_candles=True)
+    coalescer, emitted = coalesce(updates, min_interval_ms, min_change)
+
+    assert coalescer.suppressed > 0
+    assert coalescer.emitted + coalescer.suppressed == len(updates)
+    # the updates that went out are the ones of the reducer, in its order
+    for pair, candles in by_pair(emitted).items():
+        remaining = iter(by_pair(updates)[pair])
+        assert all(candle in remaining for candle in candles)
+
+    last_emitted = {}
+    for candle in emitted:
+        last_emitted[candle['pair'], candle['window_start_ms']] = candle
+    for key, candle in final_versions(updates).items():
+        assert last_emitted[key] == candle, f'final version of {key} not emitted'
+
+
+def test_coalescing_without_a_policy_emits_every_update(trades):
+    updates = streaming_candles(trades[:5_000], emit_incomplete_candles=True)
+    coalescer, emitted = coalesce(updates, min_interval_ms=0, min_change=0.0)
+
+    assert emitted == updates
+    assert coalescer.suppressed == 0
+
+
+def run_service(
+    kafka_broker_address: str,
+    trades: List[dict],
+    n_candles: int,
+    **service_kwargs,
+) -> List[dict]:
+    """
+    Runs the service on the trades, as a historical run from a fresh topic, until it
+    emitted `n_candles` candles
+
+    Returns:
+        List[dict]: the candles emitted
+    """
+    trades_topic, candles_topic = create_topics(
+        kafka_broker_address, 'trades', 'candles'
+    )
+    produce(
+        kafka_broker_address, trades_topic, [(trade['pair'], trade) for trade in trades]
+    )
+    service = multiprocessing.get_context('spawn').Process(
+        target=main,
+        kwargs={
+            'kafka_broker_address': kafka_broker_address,
+            'kafka_input_topic': trades_topic,
+            'kafka_output_topic': candles_topic,
+            'kafka_consumer_group': f'{candles_topic}-service',
+            'candle_seconds': CANDLE_SECONDS,
+            'data_source': 'historical',
+            **service_kwargs,
+        },
+        daemon=True,
+    )
+    service.start()
+    try:
+        return consume(
+            kafka_broker_address,
+            candles_topic,
+            lambda candles: len(candles) >= n_candles,
+            timeout_sec=120,
+        )
+    finally:
+        service.terminate()
+        service.join()
+
+
+@pytest.mark.parametrize('batch', [False, True], ids=['streaming', 'batch'])
+@pytest.mark.parametrize('rollup_candle_seconds', [None, [300]], ids=['base', 'rollup'])
+def test_service_candles_match_the_streaming_reducer(
+    kafka_broker_address, batch: bool, rollup_candle_seconds: Optional[List[int]]
+):
+    trades = make_trades(N_SERVICE_TRADES)
+    expected = streaming_candles(trades)
+    if rollup_candle_seconds:
+        expected = rolled_up(expected, rollup_candle_seconds, emit_incomplete=False)
+
+    candles = run_service(
+        kafka_broker_address,
+        trades,
+        len(expected),
+        emit_incomplete_candles=False,
+        batch_candles=batch,
+        rollup_candle_seconds=rollup_candle_seconds,
+    )
+
+    assert by_pair(candles) == by_pair(expected)
+
+
+def test_service_coalesces_the_updates_of_the_streaming_reducer(kafka_broker_address):
+    trades = make_trades(N_SERVICE_TRADES)
+    _, expected = coalesce(
+        streaming_candles(trades, emit_incomplete_candles=True),
+        min_interval_ms=5_000,
+        min_change=0.001,
+    )
+
+    candles = run_service(
+        kafka_broker_address,
+        trades,
+        len(expected),
+        emit_incomplete_candles=True,
+        incomplete_candles_min_interval_ms=5_000,
+        incomplete_candles_min_change=0.001,
+    )
+
+    assert by_pair(candles) == by_pair(expected)
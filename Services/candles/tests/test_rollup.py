@@ -0,0 +1,81 @@
+"""
+The 1 minute candles rolled up into 5 minute ones against the 5 minute candles
+built directly from the trades.
+"""
+
+from typing import Dict, List
+
+import pytest
+from batch_candles import BatchCandleBuilder
+from benchmark import make_trades
+from rollup import CandleRollup
+
+
+def built(trades: List[dict], candle_seconds: int) -> List[dict]:
+    builder = BatchCandleBuilder(candle_seconds)
+    return builder.add(
+        [trade['pair'] for trade in trades],
+        [trade['price'] for trade in trades],
+        [trade['volume'] for trade in trades],
+        [trade['timestamp_ms'] for trade in trades],
+    )
+
+
+def rolled_up(candles: List[dict], seconds: int) -> Dict[tuple, dict]:
+    rollup = CandleRollup(60, [seconds], emit_incomplete_candles=False)
+    windows: Dict[str, dict] = {}
+    return {
+        (candle['pair'], candle['window_start_ms']): candle
+        for base in candles
+        for candle in rollup.update_windows(base, windows.setdefault(base['pair'], {}))
+        if candle['candle_seconds'] == seconds
+    }
+
+
+def in_time_order() -> List[dict]:
+    return sorted(make_trades(20_000), key=lambda trade: trade['timestamp_ms'])
+
+
+def with_a_gap() -> List[dict]:
+    # an hour and a bit without trades, the 5 minute window before it ends on
+    # empty minutes
+    trades = in_time_order()
+    half = len(trades) // 2
+    return trades[:half] + [
+        {**trade, 'timestamp_ms': trade['timestamp_ms'] + 3_617_000}
+        for trade in trades[half:]
+    ]
+
+
+@pytest.mark.parametrize('trades', [in_time_order(), with_a_gap()])
+def test_rolled_up_candles_match_the_candles_built_at_5_minutes(trades):
+    expected = {
+        (candle['pair'], candle['window_start_ms']): candle
+        for candle in built(trades, 300)
+    }
+
+    rolled = rolled_up(built(trades, 60), 300)
+
+    assert rolled.keys() == expected.keys()
+    for key, candle in expected.items():
+        # the volume of the minutes is summed before the minutes are, which rounds
+        # differently
+        assert rolled[key] == {**candle, 'volume': pytest.approx(candle['volume'])}
+
+
+def test_late_trade_is_dropped_by_the_1_minute_window():
+    trades = [
+        {'pair': 'BTC/USD', 'price': 100.0, 'volume': 1.0, 'timestamp_ms': 0},
+        {'pair': 'BTC/USD', 'price': 101.0, 'volume': 1.0, 'timestamp_ms': 150_000},
+        # two minutes late, still in the open 5 minute window
+        {'pair': 'BTC/USD', 'price': 90.0, 'volume': 1.0, 'timestamp_ms': 30_000},
+        {'pair': 'BTC/USD', 'price': 102.0, 'volume': 1.0, 'timestamp_ms': 310_000},
+        # closes the first minute of the next 5 minutes, and the 5 minutes before
+        {'pair': 'BTC/USD', 'price': 103.0, 'volume': 1.0, 'timestamp_ms': 370_000},
+    ]
+
+    [direct] = built(trades, 300)
+    [rolled] = rolled_up(built(trades, 60), 300).values()
+
+    assert (direct['low'], direct['volume']) == (90.0, 3.0)
+    assert (rolled['low'], rolled['volume']) == (100.0, 2.0)
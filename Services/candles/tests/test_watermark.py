@@ -0,0 +1,134 @@
+"""
+The wall-clock watermark: when it ticks the windows of a pair closed, that it stops
+once the partition of the pair went to another instance, and the live service
+closing the window of a pair without later trades.
+"""
+
+import multiprocessing
+import time
+
+from broker import consume, create_topics, produce
+from run import init_candle, main, update_candle
+from watermark import WallClockWatermark
+
+
+def trade(price: float, timestamp_ms: int, volume: float = 1.0) -> dict:
+    return {
+        'pair': 'XRP/USD',
+        'price': price,
+        'volume': volume,
+        'timestamp_ms': timestamp_ms,
+    }
+
+
+def tick(price: float, timestamp_ms: int) -> dict:
+    return {**trade(price, timestamp_ms, volume=0.0), 'trade_id': None}
+
+
+def test_windows_close_on_wall_clock_time():
+    watermark = WallClockWatermark(candle_seconds=60, close_delay_ms=2_000)
+    watermark.observe(trade(100.0, 1_000))
+    watermark.observe(trade(101.0, 59_000))
+
+    # nothing until the delay after the end of the window has passed
+    assert watermark.ticks(now_ms=61_999) == {}
+    assert watermark.ticks(now_ms=62_000) == {'XRP/USD': [tick(101.0, 60_000)]}
+
+    # the tick opens the next window as a candle at the last close, which the
+    # first trade of the window replaces
+    candle = init_candle(tick(101.0, 60_000))
+    assert candle[:5] == [101.0, 101.0, 101.0, 101.0, 0.0]
+    candle = update_candle(candle, trade(102.0, 61_000, volume=0.5))
+    assert candle[:5] == [102.0, 102.0, 102.0, 102.0, 0.5]
+    # and ticks don't touch a candle with trades
+    assert update_candle(list(candle), tick(101.0, 61_500)) == candle
+
+
+def test_windows_without_trades_are_ticked_once_the_tick_comes_back():
+    watermark = WallClockWatermark(candle_seconds=60, close_delay_ms=2_000)
+    watermark.observe(trade(100.0, 1_000))
+    assert watermark.ticks(now_ms=62_000) == {'XRP/USD': [tick(100.0, 60_000)]}
+
+    watermark.observe(tick(100.0, 60_000))
+    # the windows that ended meanwhile all get their tick
+    assert watermark.ticks(now_ms=182_000) == {
+        'XRP/USD': [tick(100.0, 120_000), tick(100.0, 180_000)]
+    }
+
+
+def test_pair_of_a_revoked_partition_stops_ticking():
+    watermark = WallClockWatermark(candle_seconds=60, close_delay_ms=2_000)
+    watermark.observe(trade(100.0, 1_000))
+    assert watermark.ticks(now_ms=62_000) == {'XRP/USD': [tick(100.0, 60_000)]}
+
+    # the partition of the pair went to another instance, which gets the tick, so
+    # it never comes back here
+    assert watermark.ticks(now_ms=122_000) == {}
+    assert watermark.ticks(now_ms=600_000) == {}
+
+    # until the partition comes back with a trade of the pair
+    watermark.observe(trade(103.0, 600_500))
+    assert watermark.ticks(now_ms=662_000) == {'XRP/USD': [tick(103.0, 660_000)]}
+
+
+def test_live_service_closes_windows_on_wall_clock_time(kafka_broker_address):
+    trades_topic, candles_topic = create_topics(
+        kafka_broker_address, 'trades', 'candles', num_partitions=2
+    )
+    service = multiprocessing.get_context('spawn').Process(
+        target=main,
+        kwargs={
+            'kafka_broker_address': kafka_broker_address,
+            'kafka_input_topic': trades_topic,
+            'kafka_output_topic': candles_topic,
+            'kafka_consumer_group': f'{candles_topic}-service',
+            'candle_seconds': 1,
+            'emit_incomplete_candles': False,
+            'data_source': 'live',
+            'window_close_delay_ms': 200,
+        },
+        daemon=True,
+    )
+    service.start()
+    try:
+        # the service reads from the latest offset, so the trades of a busy pair go
+        # in until its first candle comes out
+        def busy_trade():
+            now_ms = time.time_ns() // 1_000_000
+            produce(
+                kafka_broker_address,
+                trades_topic,
+                [('BTC/USD', {**trade(90_000.0, now_ms), 'pair': 'BTC/USD'})],
+            )
+
+        consume(
+            kafka_broker_address,
+            candles_topic,
+            lambda candles: len(candles) > 0,
+            timeout_sec=60,
+            on_poll=busy_trade,
+        )
+
+        # then a single trade of a thin pair, and no later one
+        traded_at_ms = time.time_ns() // 1_000_000
+        produce(
+            kafka_broker_address, trades_topic, [('XRP/USD', trade(0.5, traded_at_ms))]
+        )
+        candles = consume(
+            kafka_broker_address,
+            candles_topic,
+            lambda candles: sum(c['pair'] == 'XRP/USD' for c in candles) >= 2,
+            timeout_sec=15,
+        )
+    finally:
+        service.terminate()
+        service.join()
+
+    thin = [candle for candle in candles if candle['pair'] == 'XRP/USD']
+    assert len(thin) >= 2, 'the window of the thin pair was not closed'
+    assert thin[0]['window_start_ms'] == traded_at_ms - traded_at_ms % 1000
+    assert thin[0]['volume'] == 1.0
+    # the next window had no trade, it is forward filled at the last price
+    assert thin[1]['window_start_ms'] == thin[0]['window_end_ms']
+    assert thin[1]['volume'] == 0.0
+    assert thin[1]['close'] == 0.5
@@ -0,0 +1,157 @@
+import threading
+import time
+from typing import Dict, List, Optional
+
+from loguru import logger
+from quixstreams import Application
+from quixstreams.models import Topic
+
+
+class WallClockWatermark:
+    """
+    Closes the candle windows of live runs on wall-clock time.
+
+    The tumbling window of a pair only closes when a later trade of that pair comes
+    in, so for thin pairs the final candle can show up minutes late, and a window
+    without trades gives no candle at all. To bound that, a background thread puts a
+    tick into the stream for every pair whose current window ended `close_delay_ms`
+    ago without a later trade: a zero-volume trade at the last price, timestamped
+    with the start of the next window.
+
+    The tick moves the window of its pair forward like any trade, so the window that
+    ended is emitted, and trades of it arriving after the tick are dropped as late.
+    The tick also opens the next window as a zero-volume candle at the last close,
+    which `update_candle` replaces with the first real trade if one comes in. A
+    window that stays empty is emitted as that forward-filled candle, so downstream
+    the candles of every pair are a dense series.
+
+    The ticks never go to the trades topic. The service regroups the trades by pair
+    into an internal topic of its own (`group_by`), the windows read that topic and
+    the ticks are produced into it, keyed by pair like the trades.
+
+    A pair gets its next tick only once the previous one came back through the
+    stream, or a trade of the pair did. When the partition of the pair moves to
+    another instance, the tick goes to that instance, never comes back here, and
+    the pair is no longer ticked from this one.
+    """
+
+    def __init__(
+        self,
+        candle_seconds: int,
+        close_delay_ms: int,
+        check_interval_sec: float = 1.0,
+    ):
+        """
+        Args:
+            candle_seconds (int): size of the candles in seconds
+            close_delay_ms (int): how long after its end a window waits for late
+                trades before it is closed
+            check_interval_sec (float): how often to look for windows to close
+        """
+        self.duration_ms = candle_seconds * 1000
+        self.close_delay_ms = close_delay_ms
+        self.check_interval_sec = check_interval_sec
+
+        self._lock = threading.Lock()
+        # last price, latest timestamp and whether a tick is on its way back, of
+        # every pair seen
+        self._pairs: Dict[str, dict] = {}
+
+        self.ticks_sent = 0
+
+    def observe(self, value: dict):
+        """
+        Update of the streaming dataframe, before the window. Sees the trades and
+        the ticks alike.
+        """
+        with self._lock:
+            pair = self._pairs.get(value['pair'])
+            if pair is None:
+                self._pairs[value['pair']] = {
+                    'price': value['price'],
+                    'latest_ms': value['timestamp_ms'],
+                    'tick_pending': False,
+                }
+                return
+
+            # the last price is the close of the latest window, the trades of
+            # earlier windows don't move it
+            latest_start_ms = pair['latest_ms'] - pair['latest_ms'] % self.duration_ms
+            if value['timestamp_ms'] >= latest_start_ms:
+                pair['price'] = value['price']
+            pair['latest_ms'] = max(pair['latest_ms'], value['timestamp_ms'])
+            # the pair is still ours
+            pair['tick_pending'] = False
+
+    def ticks(self, now_ms: Optional[int] = None) -> Dict[str, List[dict]]:
+        """
+        The ticks due at `now_ms`, one per window to close, of the pairs whose
+        last tick came back
+
+        Returns:
+            Dict[str, List[dict]]: the ticks of every pair, as trades
+        """
+        if now_ms is None:
+            now_ms = time.time_ns() // 1_000_000
+
+        ticks = {}
+        with self._lock:
+            for pair_name, pair in self._pairs.items():
+                if pair['tick_pending']:
+                    continue
+
+                next_start_ms = (
+                    pair['latest_ms'] - pair['latest_ms'] % self.duration_ms
+                ) + self.duration_ms
+                while next_start_ms + self.close_delay_ms <= now_ms:
+                    ticks.setdefault(pair_name, []).append(
+                        {
+                            'pair': pair_name,
+                            'price': pair['price'],
+                            'volume': 0.0,
+                            'timestamp_ms': next_start_ms,
+                            'trade_id': None,
+                        }
+                    )
+                    # don't tick the same window again before the tick comes back
+                    pair['latest_ms'] = next_start_ms
+                    pair['tick_pending'] = True
+                    next_start_ms += self.duration_ms
+        return ticks
+
+    def start(self, app: Application, topic: Topic) -> threading.Thread:
+        """
+        Starts the thread that produces the ticks into the internal topic the
+        windows read
+        """
+        thread = threading.Thread(
+            target=self._run, args=(app, topic), name='watermark', daemon=True
+        )
+        thread.start()
+        logger.info(
+            f'Closing candle windows {self.close_delay_ms}ms after they end, '
+            f'on wall-clock time'
+        )
+        return thread
+
+    def _run(self, app: Application, topic: Topic):
+        with app.get_producer() as producer:
+            while True:
+                time.sleep(self.check_interval_sec)
+                ticks = self.ticks()
+                for pair, trades in ticks.items():
+                    for trade in trades:
+                        # serialized like the trades regrouped into the topic, so
+                        # the tick lands in the partition of its pair
+                        msg = topic.serialize(
+                            key=pair, value=trade, timestamp_ms=trade['timestamp_ms']
+                        )
+                        producer.produce(
+                            topic=topic.name,
+                            key=msg.key,
+                            value=msg.value,
+                            timestamp=msg.timestamp,
+                        )
+                        self.ticks_sent += 1
+                if ticks:
+                    producer.flush()
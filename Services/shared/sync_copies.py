@@ -0,0 +1,52 @@
+"""
+Copies the shared modules into the services that use them. Every service is built
+from its own directory, so it gets a copy of its own instead of a dependency.
+
+    python Services/shared/sync_copies.py          # after editing a shared module
+    python Services/shared/sync_copies.py --check  # fails if a copy differs
+"""
+
+import sys
+from pathlib import Path
+from typing import List
+
+SHARED_DIR = Path(__file__).parent
+SERVICES_DIR = SHARED_DIR.parent
+
+# the shared modules and the services with a copy of them
+COPIES = {
+    'wire_format.py': ['trades', 'candles', 'ta', 'to-feature-store', 'candle-store'],
+}
+
+
+def stale_copies() -> List[Path]:
+    """
+    The copies that differ from their shared module
+    """
+    stale = []
+    for module, services in COPIES.items():
+        source = (SHARED_DIR / module).read_bytes()
+        for service in services:
+            copy = SERVICES_DIR / service / module
+            if not copy.exists() or copy.read_bytes() != source:
+                stale.append(copy)
+    return stale
+
+
+def sync():
+    """
+    Overwrites every copy with its shared module
+    """
+    for module, services in COPIES.items():
+        source = (SHARED_DIR / module).read_bytes()
+        for service in services:
+            (SERVICES_DIR / service / module).write_bytes(source)
+
+
+if __name__ == '__main__':
+    if '--check' in sys.argv[1:]:
+        stale = stale_copies()
+        for copy in stale:
+            print(f'{copy} differs from its shared module, run sync_copies.py')
+        sys.exit(1 if stale else 0)
+    sync()
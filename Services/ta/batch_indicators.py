@@ -0,0 +1,186 @@
+from typing import Dict, List, Optional
+
+import numpy as np
+from registry import (
+    BAR_FIELDS,
+    CLOSE,
+    CLOSE_SQ,
+    GAIN,
+    HIGH,
+    LOSS,
+    LOW,
+    MF_NEG,
+    MF_POS,
+    MINUS_DM,
+    PLUS_DM,
+    TR,
+    TYPICAL_PRICE,
+    VOLUME,
+    IndicatorRegistry,
+    sum_rows,
+)
+
+
+class BatchIndicators:
+    """
+    Computes the indicators of a whole chunk of candles at once with numpy, for
+    historical runs where the candles of many windows are already in the topic.
+
+    Gives the same messages as `IncrementalIndicators`, and so as the talib path,
+    candle by candle, with the same NaN during the warm-up of every pair. As there,
+    a candle of the same window as the one before it is an update of the candle in
+    progress: it is computed on top of the closed windows, and the last version of
+    a window is the one that counts once the next window starts.
+
+    Every indicator only depends on the last `registry.history` closed bars and the
+    candle itself, so the candles of a pair are laid out as one column each of those bars,
+    and every indicator is computed for all the columns at once, adding the bars up
+    in the same order as the incremental sums when they are resynced. The results
+    match the streaming path to about 1e-12 relative, the bands of flat markets to
+    1e-7.
+
+    The last bars of every pair are kept between chunks in memory.
+    """
+
+    def __init__(
+        self, max_candles_in_state: int, registry: Optional[IndicatorRegistry] = None
+    ):
+        """
+        Args:
+            max_candles_in_state (int): number of candles the talib path looks at,
+                an indicator needing more than that stays NaN like it does there
+            registry (Optional[IndicatorRegistry]): the indicators to compute, the
+                ones of technical_indicators.py if not given
+        """
+        self.max_candles_in_state = max_candles_in_state
+        self.registry = registry or IndicatorRegistry()
+        self.history = self.registry.history
+        # the closed bars, their number and the candle in progress of every pair
+        self._pairs: Dict[str, dict] = {}
+        self.candles_processed = 0
+
+    def add(self, candles: List[dict]) -> List[dict]:
+        """
+        Adds a chunk of candles, in the order they were consumed
+
+        Returns:
+            List[dict]: the candles with their indicators, in the same order
+        """
+        positions: Dict[str, List[int]] = {}
+        for i, candle in enumerate(candles):
+            positions.setdefault(candle['pair'], []).append(i)
+
+        messages = [None] * len(candles)
+        for pair, pair_positions in positions.items():
+            pair_candles = [candles[i] for i in pair_positions]
+            for i, message in zip(pair_positions, self._add_pair(pair, pair_candles)):
+                messages[i] = message
+
+        self.candles_processed += len(candles)
+        return messages
+
+    def _add_pair(self, pair: str, candles: List[dict]) -> List[dict]:
+        history = self.history
+        state = self._pairs.setdefault(
+            pair, {'window_start_ms': None, 'n_bars': 0, 'bars': [], 'pending': None}
+        )
+        # the bars kept from before, then the windows closing in this chunk
+        n_kept = len(state['bars'])
+        closed = [bar[HIGH : VOLUME + 1] for bar in state['bars']]
+        pending = state['pending']
+        window_start_ms = state['window_start_ms']
+
+        # the number of closed bars before every candle
+        n_closed = np.empty(len(candles), dtype=np.int64)
+        for j, candle in enumerate(candles):
+            if candle['window_start_ms'] != window_start_ms:
+                if pending is not None:
+                    closed.append(pending)
+                window_start_ms = candle['window_start_ms']
+            pending = [candle['high'], candle['low'], candle['close'], candle['volume']]
+            n_closed[j] = len(closed)
+
+        # the closed bars, the ones kept as they were and the new ones derived from
+        # the bar before them, with `history` empty bars in front
+        bars = np.zeros((len(BAR_FIELDS), history + len(closed)))
+        if n_kept:
+            bars[:, history : history + n_kept] = np.array(state['bars']).T
+        if len(closed) > n_kept:
+            raw = np.array(closed[n_kept:]).T
+            # the fields the next bar derives from go in first
+            bars[HIGH : VOLUME + 1, history + n_kept :] = raw
+            bars[TYPICAL_PRICE, history + n_kept :] = (raw[0] + raw[1] + raw[2]) / 3.0
+            previous = bars[:, history + n_kept - 1 : -1]
+            has_previous = state['n_bars'] + np.arange(raw.shape[1]) > 0
+            bars[:, history + n_kept :] = _derive(raw, previous, has_previous)
+
+        # the candles themselves, derived from the last closed bar before them
+        raw = np.array(
+            [[c['high'], c['low'], c['close'], c['volume']] for c in candles]
+        ).T
+        previous = bars[:, history - 1 + n_closed]
+        n_bars_before = state['n_bars'] - n_kept + n_closed
+        own = _derive(raw, previous, n_bars_before > 0)
+
+        # column j holds the `history` closed bars before candle j, then candle j
+        rows = n_closed[None, :] + np.arange(history)[:, None]
+        window = np.concatenate([bars[:, rows], own[:, None, :]], axis=1)
+        sums = [sum_rows(window, field, n, lag) for field, n, lag in self.registry.sums]
+        values = self.registry.compute_batch(
+            window, sums, np.minimum(n_bars_before + 1, self.max_candles_in_state)
+        )
+
+        n_keep = min(len(closed), history)
+        state['bars'] = bars[:, bars.shape[1] - n_keep :].T.tolist()
+        state['n_bars'] += len(closed) - n_kept
+        state['pending'] = pending
+        state['window_start_ms'] = window_start_ms
+
+        outputs = self.registry.outputs
+        indicators = zip(*(values[name].tolist() for name in outputs))
+        return [
+            {**candle, **dict(zip(outputs, row))}
+            for candle, row in zip(candles, indicators)
+        ]
+
+
+def _derive(raw: np.ndarray, previous: np.ndarray, has_previous: np.ndarray):
+    """
+    The fields of BAR_FIELDS for the high, low, close and volume rows of `raw`,
+    with the same arithmetic as `incremental.make_bar`
+
+    Args:
+        raw (np.ndarray): high, low, close and volume, one column per bar
+        previous (np.ndarray): the fields of the bar before every bar
+        has_previous (np.ndarray): whether there is a bar before, the first bar of
+            a pair gets zeros
+    """
+    high, low, close, volume = raw
+    bars = np.zeros((len(BAR_FIELDS), raw.shape[1]))
+    bars[HIGH], bars[LOW], bars[CLOSE], bars[VOLUME] = high, low, close, volume
+    bars[CLOSE_SQ] = close * close
+    typical_price = bars[TYPICAL_PRICE] = (high + low + close) / 3.0
+
+    previous_close = previous[CLOSE]
+    change = close - previous_close
+    bars[LOSS] = np.where(has_previous & (change < 0), -change, 0.0)
+    bars[GAIN] = np.where(has_previous & (change >= 0), change, 0.0)
+
+    tr = np.maximum(
+        high - low,
+        np.maximum(np.abs(high - previous_close), np.abs(low - previous_close)),
+    )
+    bars[TR] = np.where(has_previous, tr, 0.0)
+
+    diff_plus = high - previous[HIGH]
+    diff_minus = previous[LOW] - low
+    is_minus = (diff_minus > 0) & (diff_plus < diff_minus)
+    is_plus = ~is_minus & (diff_plus > 0) & (diff_plus > diff_minus)
+    bars[MINUS_DM] = np.where(has_previous & is_minus, diff_minus, 0.0)
+    bars[PLUS_DM] = np.where(has_previous & is_plus, diff_plus, 0.0)
+
+    flow = typical_price - previous[TYPICAL_PRICE]
+    money_flow = typical_price * volume
+    bars[MF_NEG] = np.where(has_previous & (flow < 0), money_flow, 0.0)
+    bars[MF_POS] = np.where(has_previous & (flow > 0), money_flow, 0.0)
+    return bars
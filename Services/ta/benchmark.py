@@ -0,0 +1,377 @@
+"""
+Benchmarks of the ta service hot path, single threaded so the numbers read as
+candles per second per core. The helpers building the candles and running them
+through every engine are shared with tests/test_parity.py, which checks that the
+engines give the same messages.
+
+    uv run python benchmark.py
+"""
+
+import math
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+from functools import partial
+from typing import Callable, Dict, List
+
+import numpy as np
+from batch_indicators import BatchIndicators
+from candle import same_window
+from incremental import IncrementalIndicators
+from loguru import logger
+from registry import IndicatorRegistry
+from snapshot import StateSnapshots
+from timeframes import TimeframeIndicators
+from quixstreams.utils.json import dumps, loads
+from technical_indicators import compute_indicators, indicators_from_columns
+
+N_WINDOWS = 3_000
+PAIR = 'BTC/USD'
+
+
+class DictState:
+    """
+    The two methods of the quixstreams State the ta service uses, on a dict
+    """
+
+    def __init__(self):
+        self._values = {}
+
+    def get(self, key: str, default=None):
+        return self._values.get(key, default)
+
+    def set(self, key: str, value):
+        self._values[key] = value
+
+
+class JsonState(DictState):
+    """
+    DictState that keeps the values as JSON like the state store, so every get
+    and set pays the round trip the service pays
+    """
+
+    def get(self, key: str, default=None):
+        value = self._values.get(key)
+        return default if value is None else loads(value)
+
+    def set(self, key: str, value):
+        self._values[key] = dumps(value)
+
+    def n_bytes(self) -> int:
+        return sum(len(value) for value in self._values.values())
+
+
+def make_candles(
+    n_windows: int,
+    updates_per_window: int,
+    seed: int = 42,
+    pair: str = PAIR,
+    candle_seconds: int = 60,
+) -> List[dict]:
+    """
+    Synthetic candles of a pair, 1 minute ones by default, every window either
+    final or followed by
+    `updates_per_window` versions of it like `emit_incomplete_candles` sends, with
+    a quiet stretch of zero-volume candles now and then
+    """
+    rng = random.Random(seed)
+    price = 30_000.0
+    window_ms = candle_seconds * 1000
+    candles = []
+    for i in range(n_windows):
+        quiet = i % 500 >= 480
+        open_ = high = low = price
+        volume = 0.0
+        for update in range(updates_per_window):
+            if not quiet:
+                price *= 1 + rng.gauss(0, 0.001)
+                high, low = max(high, price), min(low, price)
+                volume += rng.random() * 3
+            candles.append(
+                {
+                    'pair': pair,
+                    'timestamp_ms': i * window_ms + update,
+                    'open': open_,
+                    'high': high,
+                    'low': low,
+                    'close': price,
+                    'volume': volume,
+                    'window_start_ms': i * window_ms,
+                    'window_end_ms': (i + 1) * window_ms,
+                    'candle_seconds': candle_seconds,
+                }
+            )
+    return candles
+
+
+def talib_path(max_candles_in_state: int) -> Callable[[dict], dict]:
+    state = DictState()
+
+    def process(candle: dict) -> dict:
+        return compute_indicators(candle, state, max_candles_in_state)
+
+    return process
+
+
+def list_update_candle(candle: dict, state, max_candles_in_state: int) -> dict:
+    """
+    The candle history as a list of candle dicts, the way the state kept it before
+    the packed columns, to compare against
+    """
+    candles = state.get('candles', default=[])
+    if candles and same_window(candle, candles[-1]):
+        candles[-1] = candle
+    else:
+        candles.append(candle)
+    if len(candles) > max_candles_in_state:
+        candles.pop(0)
+    state.set('candles', candles)
+    return candle
+
+
+def list_compute_indicators(candle: dict, state) -> dict:
+    candles = state.get('candles', [])
+    columns = [np.array([c[name] for c in candles]) for name in ('high', 'low')]
+    columns += [np.array([c[name] for c in candles]) for name in ('close', 'volume')]
+    return indicators_from_columns(candle, *columns)
+
+
+def list_path(max_candles_in_state: int, state) -> Callable[[dict], dict]:
+    def process(candle: dict) -> dict:
+        candle = list_update_candle(candle, state, max_candles_in_state)
+        return list_compute_indicators(candle, state)
+
+    return process
+
+
+def columns_path(max_candles_in_state: int, state) -> Callable[[dict], dict]:
+    def process(candle: dict) -> dict:
+        return compute_indicators(candle, state, max_candles_in_state)
+
+    return process
+
+
+def incremental_path(
+    max_candles_in_state: int, registry: IndicatorRegistry = None
+) -> Callable[[dict], dict]:
+    state = DictState()
+    engine = IncrementalIndicators(max_candles_in_state, registry)
+    return lambda candle: engine.update(candle, state)
+
+
+def snapshot_path(
+    max_candles_in_state: int, snapshots: StateSnapshots
+) -> Callable[[dict], dict]:
+    """
+    The incremental path with the snapshot filter and update of the service, None
+    for the candles the filter drops
+    """
+    states = defaultdict(DictState)
+    engine = IncrementalIndicators(max_candles_in_state)
+    update = snapshots.wrap(engine.update)
+
+    def process(candle: dict) -> dict:
+        state = states[candle['pair']]
+        if snapshots.warm_start(candle, state):
+            return update(candle, state)
+
+    return process
+
+
+def timeframes_path(
+    timeframes: Dict[int, Callable[[], IncrementalIndicators]],
+) -> Callable[[dict], dict]:
+    """
+    Every timeframe of the pair through one state, like the service with extra
+    timeframes
+    """
+    state = DictState()
+    engines = TimeframeIndicators(
+        min(timeframes),
+        {seconds: engine().update for seconds, engine in timeframes.items()},
+    )
+    return lambda candle: engines.update(candle, state)
+
+
+def timeframe_streams() -> tuple:
+    """
+    1m, 5m and 1h candles of a pair in one topic, the 5m ones with other indicators
+
+    Returns:
+        tuple: the engine of every timeframe, the candles of every timeframe, and
+            all of them in the order the candles service emits them, by the end of
+            their window
+    """
+    short = [
+        {'name': 'rsi_9', 'kind': 'rsi', 'period': 9},
+        {'name': 'sma_7', 'kind': 'sma', 'period': 7},
+    ]
+    timeframes = {
+        60: partial(IncrementalIndicators, 60),
+        300: partial(IncrementalIndicators, 120, IndicatorRegistry(short)),
+        3600: partial(IncrementalIndicators, 24),
+    }
+    streams = {
+        seconds: make_candles(
+            3600 * 60 // seconds, 5, seed=seconds, candle_seconds=seconds
+        )
+        for seconds in timeframes
+    }
+    candles = sorted(
+        (candle for stream in streams.values() for candle in stream),
+        key=lambda c: c['window_end_ms'] + c['timestamp_ms'] - c['window_start_ms'],
+    )
+    return timeframes, streams, candles
+
+
+def windows_to_valid(messages: List[dict]) -> int:
+    """
+    Number of windows before every indicator of the messages has a value
+    """
+    for message in messages:
+        if not any(isinstance(v, float) and math.isnan(v) for v in message.values()):
+            return (
+                message['window_start_ms'] - messages[0]['window_start_ms']
+            ) // 60_000
+    return len({message['window_start_ms'] for message in messages})
+
+
+def batch(
+    max_candles_in_state: int,
+    candles: List[dict],
+    chunk_size: int,
+    registry: IndicatorRegistry = None,
+) -> List[dict]:
+    indicators = BatchIndicators(max_candles_in_state, registry)
+    messages = []
+    for i in range(0, len(candles), chunk_size):
+        messages.extend(indicators.add(candles[i : i + chunk_size]))
+    return messages
+
+
+def run(process: Callable[[dict], dict], candles: List[dict]) -> List[dict]:
+    return [process(dict(candle)) for candle in candles]
+
+
+def measure(process: Callable[[dict], dict], candles: List[dict]) -> float:
+    """
+    Returns:
+        float: µs per message
+    """
+    start = time.perf_counter()
+    for candle in candles:
+        process(dict(candle))
+    return (time.perf_counter() - start) / len(candles) * 1e6
+
+
+if __name__ == '__main__':
+    logger.remove()
+
+    candles = make_candles(N_WINDOWS, 1)
+    print(f'\n{"talib, state as JSON":>20} {"list":>24} {"packed columns":>24}')
+    for max_candles_in_state in (60, 240):
+        results = []
+        for path in (list_path, columns_path):
+            state = JsonState()
+            us = measure(path(max_candles_in_state, state), candles)
+            results.append(f'{us:>6.1f} µs/msg {state.n_bytes():>6} B')
+        print(f'{max_candles_in_state:>20} {results[0]:>24} {results[1]:>24}')
+
+    print(f'\n{"max_candles_in_state":>20} {"talib":>14} {"incremental":>14}')
+    for max_candles_in_state in (60, 120, 240, 480):
+        talib_us = measure(talib_path(max_candles_in_state), candles)
+        incremental_us = measure(incremental_path(max_candles_in_state), candles)
+        print(
+            f'{max_candles_in_state:>20} {talib_us:>9.1f} µs/msg '
+            f'{incremental_us:>9.1f} µs/msg'
+        )
+
+    # historical runs, all the candles of a pair in the topic already
+    candles = make_candles(N_WINDOWS * 10, 1)
+    print()
+    for name, build in (
+        ('talib', lambda candles: run(talib_path(60), candles)),
+        ('incremental', lambda candles: run(incremental_path(60), candles)),
+        *[
+            (
+                f'batch, {chunk_size:,} candles',
+                partial(batch, 60, chunk_size=chunk_size),
+            )
+            for chunk_size in (1_000, 10_000)
+        ],
+    ):
+        start = time.perf_counter()
+        build(candles)
+        elapsed = time.perf_counter() - start
+        print(f'{name:>22}: {len(candles) / elapsed:>10,.0f} candles/s per core')
+
+    # where the time of a candle goes, with indicator_timing
+    registry = IndicatorRegistry(timed=True, stats_interval_sec=math.inf)
+    measure(incremental_path(60, registry), candles)
+    print(f'\n{"µs per candle":>20}')
+    for name, elapsed_ns in sorted(registry.timings.items(), key=lambda i: -i[1]):
+        print(f'{name:>20} {elapsed_ns / registry.candles_timed / 1000:>9.2f}')
+
+    # updates of the candle in progress, as with emit_incomplete_candles
+    print(f'\n{"updates per window":>20} {"talib":>14} {"incremental":>14}')
+    for updates_per_window in (1, 10, 50):
+        candles = make_candles(N_WINDOWS * 5 // updates_per_window, updates_per_window)
+        talib_us = measure(talib_path(60), candles)
+        incremental_us = measure(incremental_path(60), candles)
+        print(
+            f'{updates_per_window:>20} {talib_us:>9.1f} µs/msg '
+            f'{incremental_us:>9.1f} µs/msg'
+        )
+
+    # 3 timeframes from one topic, in one pass or one service each, serialized
+    # like the topic
+    timeframes, _, timeframe_candles = timeframe_streams()
+    values = [dumps(candle) for candle in timeframe_candles]
+
+    def one_pass():
+        process = timeframes_path(timeframes)
+        for value in values:
+            process(loads(value))
+
+    def service_per_timeframe():
+        for seconds in timeframes:
+            process = timeframes_path({seconds: timeframes[seconds]})
+            for value in values:
+                candle = loads(value)
+                if candle['candle_seconds'] == seconds:
+                    process(candle)
+
+    timings = defaultdict(list)
+    for _ in range(3):
+        for path in (one_pass, service_per_timeframe):
+            start = time.perf_counter()
+            path()
+            timings[path].append((time.perf_counter() - start) / len(values) * 1e6)
+    one_pass_us = min(timings[one_pass])
+    per_service_us = min(timings[service_per_timeframe])
+    print(
+        f'\n1m, 5m and 1h candles: {one_pass_us:.1f} µs per candle of the topic in '
+        f'one pass, {per_service_us:.1f} µs in a service per timeframe'
+    )
+
+    # restarting with an empty state store, 100 pairs
+    pairs = [f'PAIR{i}/USD' for i in range(100)]
+    streams = [make_candles(200, 1, seed=i, pair=pair) for i, pair in enumerate(pairs)]
+    candles = [candle for window in zip(*streams) for candle in window]
+    cold = run(incremental_path(60), candles[len(candles) // 2 :])
+    with tempfile.TemporaryDirectory() as snapshot_dir:
+        snapshots = StateSnapshots(snapshot_dir, 'ta', ['indicators'], math.inf)
+        run(snapshot_path(60, snapshots), candles[: len(candles) // 2])
+        snapshots.save()
+        size = os.path.getsize(snapshots.path)
+        start = time.perf_counter()
+        snapshots = StateSnapshots(snapshot_dir, 'ta', ['indicators'])
+        load_ms = (time.perf_counter() - start) * 1e3
+        warm = run(snapshot_path(60, snapshots), candles[len(candles) // 2 :])
+    print(
+        f'\nrestart with 100 pairs: every indicator valid after '
+        f'{windows_to_valid(cold)} windows cold, {windows_to_valid(warm)} from '
+        f'a {size / 1e6:.1f} MB snapshot loaded in {load_ms:.0f} ms'
+    )
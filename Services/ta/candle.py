@@ -1,46 +1,135 @@
-from config import config
+from typing import Optional, Tuple
+
+import numpy as np
 from loguru import logger
 from quixstreams import State
 
-MAX_CANDLES_IN_STATE = config.max_candles_in_state
+# the columns of the candle history, in the order they are packed
+COLUMNS = ('high', 'low', 'close', 'volume')
 
 
-def update_candle(candle: dict, state: State) -> dict:
+def update_history(
+    candle: dict, state: State, max_candles_in_state: int
+) -> Tuple[np.ndarray, ...]:
     """
-    update the list of candles we have in our state using the latest candle
+    update the history of candles we have in our state using the latest candle
 
-    if the latest candle corresponds to a new window and total number of candles
-    is less than num_candles_in_state we just append it to the list
-    if it corresponds to the same window, we replace the last candle in the list
+    if the latest candle corresponds to a new window we add it to the history,
+    dropping the oldest candle once there are max_candles_in_state of them
+    if it corresponds to the same window, we replace the last candle in the history
 
     Args:
         candle (dict): latest candle
         state (State): state of the candles
-        num_candles_in_state (int): number of candles to keep in state
+        max_candles_in_state (int): number of candles to keep in state
 
     Returns:
-        candles
+        Tuple[np.ndarray, ...]: the high, low, close and volume of the candles in
+            the history, oldest first, so the indicators don't read the state again
     """
-    candles = state.get('candles', default=[])
-    if not candles:
-        candles.append(candle)
-    elif same_window(candle, candles[-1]):
-        candles[-1] = candle
+    history = state.get('history', default=None)
+    if history is None:
+        # the state kept a list of candle dicts before
+        candles = state.get('candles', default=None)
+        history = new_history(max_candles_in_state, candles)
+        if candles is not None:
+            state.delete('candles')
+    elif history['capacity'] != max_candles_in_state:
+        history = resize_history(history, max_candles_in_state)
+
+    columns = unpack_columns(history)
+    capacity = history['capacity']
+    if history['size'] and same_window(candle, history):
+        slot = (history['head'] - 1) % capacity
     else:
-        candles.append(candle)
+        slot = history['head']
+        history['head'] = (slot + 1) % capacity
+        history['size'] = min(history['size'] + 1, capacity)
 
-    if len(candles) > MAX_CANDLES_IN_STATE:
-        candles.pop(0)
+    for row, name in enumerate(COLUMNS):
+        columns[row, slot] = candle[name]
+    history['window_start_ms'] = candle['window_start_ms']
+    history['window_end_ms'] = candle['window_end_ms']
+    history['pair'] = candle['pair']
+    history['columns'] = pack_columns(columns)
 
     # TODO: we should check the candles have no missing windows
     # This can happen for low volume pairs. In this case, we could interpoalte the missing windows
+    # Live candles with WINDOW_CLOSE_DELAY_MS set come with the empty windows filled
+    # in as zero-volume candles, historical ones can still have gaps.
+
+    logger.debug(f'Number of candles in state for {candle["pair"]}: {history["size"]}')
+
+    # Update the state with the new history of candles
+    state.set('history', history)
+
+    return history_columns(history, columns)
+
+
+def new_history(capacity: int, candles: Optional[list] = None) -> dict:
+    """
+    An empty history of `capacity` candles, or one holding the last of `candles`,
+    the list of candle dicts the state kept before
+    """
+    candles = (candles or [])[-capacity:]
+    columns = np.zeros((len(COLUMNS), capacity))
+    for slot, candle in enumerate(candles):
+        for row, name in enumerate(COLUMNS):
+            columns[row, slot] = candle[name]
+
+    last = candles[-1] if candles else {}
+    return {
+        'capacity': capacity,
+        # slot of the next new candle, and number of candles in the history
+        'head': len(candles) % capacity,
+        'size': len(candles),
+        'window_start_ms': last.get('window_start_ms'),
+        'window_end_ms': last.get('window_end_ms'),
+        'pair': last.get('pair'),
+        'columns': pack_columns(columns),
+    }
+
 
-    logger.debug(f'Number of candles in state for {candle["pair"]}: {len(candles)}')
+def resize_history(history: dict, capacity: int) -> dict:
+    """
+    The history with room for `capacity` candles, keeping the last ones
+    """
+    columns = history_columns(history, unpack_columns(history))
+    candles = [dict(zip(COLUMNS, values)) for values in zip(*columns)]
+    resized = new_history(capacity, candles)
+    for field in ('window_start_ms', 'window_end_ms', 'pair'):
+        resized[field] = history[field]
+    return resized
+
+
+def history_columns(history: dict, columns: np.ndarray) -> Tuple[np.ndarray, ...]:
+    """
+    The candles of the history in order: the `size` slots before the head, which
+    wrap around the end of the ring once it is full
+    """
+    head, size = history['head'], history['size']
+    if size <= head:
+        return tuple(columns[:, head - size : head])
+    return tuple(np.concatenate((columns[:, head - size :], columns[:, :head]), axis=1))
 
-    # Update the state with the new list of candles
-    state.set('candles', candles)
 
-    return candle
+def pack_columns(columns: np.ndarray) -> str:
+    # the state store keeps JSON, the floats go in as one hex string, which
+    # decodes several times faster than base64
+    return columns.astype('<f8', copy=False).tobytes().hex()
+
+
+def unpack_columns(history: dict) -> np.ndarray:
+    """
+    The ring of the history as one row per column of COLUMNS
+
+    The whole ring is one hex string in the state, decoded and written again on
+    every message, rather than a state key per slot: talib needs every candle of
+    the history on every message anyway, and one decode of the whole ring costs
+    less than reading the slots one key at a time.
+    """
+    packed = bytearray.fromhex(history['columns'])
+    return np.frombuffer(packed, dtype='<f8').reshape(len(COLUMNS), -1)
 
 
 def same_window(candle_1: dict, candle_2: dict) -> bool:
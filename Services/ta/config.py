@@ -1,4 +1,4 @@
-from typing import Literal
+from typing import List, Literal, Optional
 
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
@@ -11,9 +11,36 @@ class Config(BaseSettings):
     kafka_input_topic: str
     kafka_output_topic: str
     kafka_consumer_group: str
+    # partitions of the candles topic when this service creates it, the same as
+    # the candles service sets, one partition by default
+    kafka_input_topic_partitions: Optional[int] = None
     max_candles_in_state: int
     candle_seconds: int
+    # more timeframes computed from the same topic in the same pass, every one with
+    # its own state per pair, e.g. [{"candle_seconds": 300}, {"candle_seconds": 3600,
+    # "max_candles_in_state": 48}], the parameters not set are the ones above
+    extra_timeframes: Optional[List[dict]] = []
     data_source: Literal['live', 'historical']
+    # encoding of the indicators, binary is smaller and json easier to debug
+    wire_format: Literal['json', 'binary'] = 'json'
+    # running indicators updated per candle, or talib over the candles in state
+    indicator_engine: Literal['incremental', 'talib'] = 'incremental'
+    # historical runs can compute the indicators of whole chunks of candles at once
+    # with numpy instead of one candle at a time
+    batch_indicators: Optional[bool] = False
+    batch_max_candles: Optional[int] = 10_000
+    # the indicators of the incremental and batch engines, as a JSON list of
+    # {"name": ..., "kind": ..., parameters}, the ones of the talib path by default
+    indicators: Optional[List[dict]] = None
+    # log the time spent in every indicator
+    indicator_timing: Optional[bool] = False
+    # run the service in several worker processes sharing the partitions of the
+    # input topic, 0 keeps a single process
+    workers: Optional[int] = 0
+    # snapshots of the state of the pairs, so a service starting with an empty
+    # state store picks them up where they were instead of warming up again
+    snapshot_dir: Optional[str] = None
+    snapshot_interval_sec: Optional[float] = 60.0
 
 
 config = Config()
@@ -0,0 +1,663 @@
+"""
+The indicators of the incremental and batch engines, declared as data.
+
+An indicator is a kind, like 'rsi' or 'macd', with its parameters and a name, e.g.
+{'name': 'rsi_9', 'kind': 'rsi', 'period': 9}. Its outputs are the name plus the
+suffixes of the kind: 'macd', 'macd_signal' and 'macd_hist' for a 'macd' named
+'macd'. The registry resolves the indicators into what they are built from:
+
+    indicator -> rolling sums -> bar fields
+
+The bar fields (gains, losses, true range, ...) are derived once per bar, and every
+rolling sum once per bar however many indicators read it, so the bands and the
+base line of the cloud share their 20-bar sum of closes, the RSIs their sums of
+gains and losses, ATR and ADX the true ranges, and so on. Adding an indicator only
+adds the sums nobody computes yet.
+
+Every kind is written twice: `compute` for one candle of the incremental engine,
+and `compute_batch` for columns of candles of the batch engine, with the same
+arithmetic as ta-lib in the same order.
+"""
+
+import math
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from loguru import logger
+
+# ta-lib treats anything this close to zero as zero
+EPSILON = 1e-14
+
+# every bar is a list of these values: the candle, plus what is derived from it and
+# the bar before, computed once when the bar comes in
+BAR_FIELDS = (
+    'high',
+    'low',
+    'close',
+    'volume',
+    'close_sq',
+    'gain',
+    'loss',
+    'tr',
+    'plus_dm',
+    'minus_dm',
+    'typical_price',
+    'mf_pos',
+    'mf_neg',
+)
+(
+    HIGH,
+    LOW,
+    CLOSE,
+    VOLUME,
+    CLOSE_SQ,
+    GAIN,
+    LOSS,
+    TR,
+    PLUS_DM,
+    MINUS_DM,
+    TYPICAL_PRICE,
+    MF_POS,
+    MF_NEG,
+) = range(len(BAR_FIELDS))
+
+# the indicators of technical_indicators.py, in the order of its message
+DEFAULT_INDICATORS = [
+    {'name': 'rsi_9', 'kind': 'rsi', 'period': 9},
+    {'name': 'rsi_14', 'kind': 'rsi', 'period': 14},
+    {'name': 'rsi_21', 'kind': 'rsi', 'period': 21},
+    {'name': 'macd', 'kind': 'macd', 'fast': 10, 'slow': 24, 'signal': 9},
+    {'name': 'bbands', 'kind': 'bbands', 'period': 20, 'nbdev': 2.0},
+    {'name': 'stochrsi', 'kind': 'stochrsi', 'period': 10, 'fastk': 5, 'fastd': 3},
+    {'name': 'adx', 'kind': 'adx', 'period': 14},
+    {'name': 'volume_ema', 'kind': 'ema', 'field': 'volume', 'period': 10},
+    {'name': 'ichimoku', 'kind': 'ichimoku', 'conv': 9, 'base': 20, 'span_b': 40},
+    {'name': 'mfi', 'kind': 'mfi', 'period': 10},
+    {'name': 'atr', 'kind': 'atr', 'period': 10},
+    {'name': 'price_roc', 'kind': 'roc', 'period': 6},
+    {'name': 'sma_7', 'kind': 'sma', 'period': 7},
+    {'name': 'sma_14', 'kind': 'sma', 'period': 14},
+    {'name': 'sma_21', 'kind': 'sma', 'period': 21},
+]
+
+# a rolling sum: (bar field, number of bars, lag). A sum with lag L covers the bars
+# up to L bars before the last one.
+SumSpec = Tuple[int, int, int]
+
+
+class Indicator:
+    """
+    An indicator of the registry: the rolling sums and the last bars it reads, and
+    how to compute its outputs from them
+    """
+
+    # the outputs are the name plus these
+    suffixes: Tuple[str, ...] = ('',)
+
+    def __init__(self, name: str):
+        self.name = name
+        self.outputs = [name + suffix for suffix in self.suffixes]
+        # the sums it reads, and the last bars it reads besides them
+        self.sums: List[SumSpec] = []
+        self.bars = 0
+        # lookback of every output in ta-lib, it is NaN until there are more bars
+        self.lookbacks: List[int] = []
+        # where its sums are in the sums of the registry, set by the registry
+        self.sum_indices: Tuple[int, ...] = ()
+
+    def compute(self, bars: List[list], sums: List[float]) -> tuple:
+        """
+        The outputs as of the last of the bars
+
+        Args:
+            bars (List[list]): the last bars, as lists of BAR_FIELDS
+            sums (List[float]): all the sums of the registry, up to the last bar
+        """
+        raise NotImplementedError
+
+    def compute_batch(self, window: np.ndarray, sums: List[np.ndarray]) -> tuple:
+        """
+        The outputs as of the last bar of every column
+
+        Args:
+            window (np.ndarray): bar fields x bars x columns
+            sums (List[np.ndarray]): all the sums of the registry, for every column
+        """
+        raise NotImplementedError
+
+
+class Average(Indicator):
+    """
+    Average of a bar field over the period
+    """
+
+    field = 'close'
+
+    def __init__(self, name: str, period: int, field: Optional[str] = None):
+        super().__init__(name)
+        self.period = period
+        field = field or self.field
+        self.sums = [(BAR_FIELDS.index(field), period, 0)]
+        self.lookbacks = [self.lookback()]
+
+    def lookback(self) -> int:
+        return self.period - 1
+
+    def compute(self, bars, sums):
+        return (sums[self.sum_indices[0]] / self.period,)
+
+    def compute_batch(self, window, sums):
+        return (sums[self.sum_indices[0]] / self.period,)
+
+
+class Sma(Average):
+    """
+    SMA of a bar field, the closes by default
+    """
+
+
+class Ema(Average):
+    """
+    EMA of a bar field as `talib.stream` gives it: seeded with the average of the
+    period at the start of the bars it looks at, so the EMA as of the last bar is
+    the average of the last `period` bars
+    """
+
+
+class Atr(Average):
+    """
+    ATR as `talib.stream` gives it: the average of the last `period` true ranges
+    """
+
+    field = 'tr'
+
+    def __init__(self, name: str, period: int):
+        super().__init__(name, period)
+
+    def lookback(self) -> int:
+        return self.period
+
+
+class Rsi(Indicator):
+    """
+    RSI as `talib.stream` gives it: the average gain over the average gain and loss
+    of the last `period` bars
+    """
+
+    def __init__(self, name: str, period: int):
+        super().__init__(name)
+        self.period = period
+        self.sums = [(GAIN, period, 0), (LOSS, period, 0)]
+        self.lookbacks = [period]
+
+    def compute(self, bars, sums):
+        gain, loss = self.sum_indices
+        return (_rsi(sums[gain] / self.period, sums[loss] / self.period),)
+
+    def compute_batch(self, window, sums):
+        gain, loss = self.sum_indices
+        return (_rsi_batch(sums[gain] / self.period, sums[loss] / self.period),)
+
+
+class Macd(Indicator):
+    """
+    MACD of ta-lib: both EMAs are seeded with the average of their period as of
+    `signal - 1` bars ago, then run over the last bars, and the signal line is the
+    average of the MACD of these bars
+    """
+
+    suffixes = ('', '_signal', '_hist')
+
+    def __init__(self, name: str, fast: int, slow: int, signal: int):
+        super().__init__(name)
+        self.fast, self.slow, self.signal = fast, slow, signal
+        self.sums = [(CLOSE, fast, signal - 1), (CLOSE, slow, signal - 1)]
+        self.bars = signal - 1
+        self.lookbacks = [(slow - 1) + (signal - 1)] * 3
+
+    def compute(self, bars, sums):
+        k_fast = 2.0 / (self.fast + 1.0)
+        k_slow = 2.0 / (self.slow + 1.0)
+        fast = sums[self.sum_indices[0]] / self.fast
+        slow = sums[self.sum_indices[1]] / self.slow
+        macd = fast - slow
+        total = macd
+        for bar in bars[-self.bars :]:
+            close = bar[CLOSE]
+            fast = ((close - fast) * k_fast) + fast
+            slow = ((close - slow) * k_slow) + slow
+            macd = fast - slow
+            total += macd
+        signal = total / self.signal
+        return macd, signal, macd - signal
+
+    def compute_batch(self, window, sums):
+        k_fast = 2.0 / (self.fast + 1.0)
+        k_slow = 2.0 / (self.slow + 1.0)
+        fast = sums[self.sum_indices[0]] / self.fast
+        slow = sums[self.sum_indices[1]] / self.slow
+        macd = fast - slow
+        total = macd.copy()
+        for close in window[CLOSE, -self.bars :]:
+            fast = ((close - fast) * k_fast) + fast
+            slow = ((close - slow) * k_slow) + slow
+            macd = fast - slow
+            total += macd
+        signal = total / self.signal
+        return macd, signal, macd - signal
+
+
+class Bbands(Indicator):
+    """
+    Bollinger bands of the closes, `nbdev` standard deviations around their average
+    """
+
+    suffixes = ('_upper', '_middle', '_lower')
+
+    def __init__(self, name: str, period: int, nbdev: float):
+        super().__init__(name)
+        self.period, self.nbdev = period, nbdev
+        self.sums = [(CLOSE, period, 0), (CLOSE_SQ, period, 0)]
+        self.lookbacks = [period - 1] * 3
+
+    def compute(self, bars, sums):
+        middle = sums[self.sum_indices[0]] / self.period
+        variance = sums[self.sum_indices[1]] / self.period
+        variance -= middle * middle
+        deviation = math.sqrt(variance) if variance >= EPSILON else 0.0
+        deviation *= self.nbdev
+        return middle + deviation, middle, middle - deviation
+
+    def compute_batch(self, window, sums):
+        middle = sums[self.sum_indices[0]] / self.period
+        variance = sums[self.sum_indices[1]] / self.period
+        variance -= middle * middle
+        deviation = np.where(variance >= EPSILON, np.sqrt(variance), 0.0)
+        deviation *= self.nbdev
+        return middle + deviation, middle, middle - deviation
+
+
+class Stochrsi(Indicator):
+    """
+    STOCHRSI of ta-lib: the RSI seeded `fastk + fastd - 2` bars ago and smoothed
+    over the last bars, then its fast stochastic.
+
+    The RSI is seeded from the bars rather than from a rolling sum, since in flat
+    markets the fast stochastic divides the tiny spread of nearly equal RSI values,
+    which any rounding difference changes.
+    """
+
+    suffixes = ('_fastk', '_fastd')
+
+    def __init__(self, name: str, period: int, fastk: int, fastd: int):
+        super().__init__(name)
+        self.period, self.fastk, self.fastd = period, fastk, fastd
+        self.lag = (fastk - 1) + (fastd - 1)
+        self.bars = period + self.lag
+        self.lookbacks = [period + self.lag] * 2
+
+    def compute(self, bars, sums):
+        period = self.period
+        average_gain = average_loss = 0.0
+        for bar in bars[-self.lag - period : -self.lag]:
+            average_gain += bar[GAIN]
+            average_loss += bar[LOSS]
+        average_gain /= period
+        average_loss /= period
+
+        rsi = [_rsi(average_gain, average_loss)]
+        for bar in bars[-self.lag :]:
+            average_loss = (average_loss * (period - 1) + bar[LOSS]) / period
+            average_gain = (average_gain * (period - 1) + bar[GAIN]) / period
+            total = average_gain + average_loss
+            rsi.append(
+                0.0 if -EPSILON < total < EPSILON else 100.0 * (average_gain / total)
+            )
+
+        fastk_sum = 0.0
+        for end in range(len(rsi) - self.fastd + 1, len(rsi) + 1):
+            window = rsi[end - self.fastk : end]
+            lowest = min(window)
+            diff = (max(window) - lowest) / 100.0
+            fastk = (rsi[end - 1] - lowest) / diff if diff != 0.0 else 0.0
+            fastk_sum += fastk
+
+        return fastk, fastk_sum / self.fastd
+
+    def compute_batch(self, window, sums):
+        period = self.period
+        average_gain = sum_rows(window, GAIN, period, self.lag) / period
+        average_loss = sum_rows(window, LOSS, period, self.lag) / period
+
+        rsi = [_rsi_batch(average_gain, average_loss)]
+        for row in range(window.shape[1] - self.lag, window.shape[1]):
+            average_loss = (average_loss * (period - 1) + window[LOSS, row]) / period
+            average_gain = (average_gain * (period - 1) + window[GAIN, row]) / period
+            rsi.append(_rsi_batch(average_gain, average_loss))
+
+        fastk_sum = 0.0
+        for end in range(len(rsi) - self.fastd + 1, len(rsi) + 1):
+            lookback = rsi[end - self.fastk : end]
+            lowest = np.minimum.reduce(lookback)
+            diff = (np.maximum.reduce(lookback) - lowest) / 100.0
+            fastk = np.where(diff != 0.0, (rsi[end - 1] - lowest) / diff, 0.0)
+            fastk_sum += fastk
+        return fastk, fastk_sum / self.fastd
+
+
+class Adx(Indicator):
+    """
+    ADX of ta-lib: the directional movements and true ranges summed over
+    `period - 1` bars, then smoothed over the last `period` bars, averaging the DX
+    of each of them
+    """
+
+    def __init__(self, name: str, period: int):
+        super().__init__(name)
+        self.period = period
+        self.sums = [
+            (TR, period - 1, period),
+            (PLUS_DM, period - 1, period),
+            (MINUS_DM, period - 1, period),
+        ]
+        self.bars = period
+        self.lookbacks = [2 * period - 1]
+
+    def compute(self, bars, sums):
+        period = self.period
+        tr, plus_dm, minus_dm = (sums[i] for i in self.sum_indices)
+        sum_dx = 0.0
+        for bar in bars[-period:]:
+            minus_dm = minus_dm - minus_dm / period + bar[MINUS_DM]
+            plus_dm = plus_dm - plus_dm / period + bar[PLUS_DM]
+            tr = tr - (tr / period) + bar[TR]
+            if not -EPSILON < tr < EPSILON:
+                minus_di = 100.0 * (minus_dm / tr)
+                plus_di = 100.0 * (plus_dm / tr)
+                total = minus_di + plus_di
+                if not -EPSILON < total < EPSILON:
+                    sum_dx += 100.0 * (abs(minus_di - plus_di) / total)
+        return (sum_dx / period,)
+
+    def compute_batch(self, window, sums):
+        period = self.period
+        tr, plus_dm, minus_dm = (sums[i] for i in self.sum_indices)
+        sum_dx = np.zeros_like(tr)
+        for row in range(window.shape[1] - period, window.shape[1]):
+            minus_dm = minus_dm - minus_dm / period + window[MINUS_DM, row]
+            plus_dm = plus_dm - plus_dm / period + window[PLUS_DM, row]
+            tr = tr - (tr / period) + window[TR, row]
+            minus_di = 100.0 * (minus_dm / tr)
+            plus_di = 100.0 * (plus_dm / tr)
+            total = minus_di + plus_di
+            dx = 100.0 * (np.abs(minus_di - plus_di) / total)
+            sum_dx += np.where(
+                (np.abs(tr) >= EPSILON) & (np.abs(total) >= EPSILON), dx, 0.0
+            )
+        return (sum_dx / period,)
+
+
+class Ichimoku(Indicator):
+    """
+    The lines of the cloud as EMAs of the closes, as in technical_indicators.py,
+    which `talib.stream` gives as averages
+    """
+
+    suffixes = ('_conv', '_base', '_span_a', '_span_b')
+
+    def __init__(self, name: str, conv: int, base: int, span_b: int):
+        super().__init__(name)
+        self.periods = (conv, base, span_b)
+        self.sums = [(CLOSE, n, 0) for n in self.periods]
+        # span A is there once both of the lines it averages are
+        self.lookbacks = [conv - 1, base - 1, max(conv, base) - 1, span_b - 1]
+
+    def compute(self, bars, sums):
+        conv, base, span_b = (
+            sums[i] / n for i, n in zip(self.sum_indices, self.periods)
+        )
+        return conv, base, (conv + base) / 2, span_b
+
+    compute_batch = compute
+
+
+class Mfi(Indicator):
+    """
+    MFI of ta-lib: the positive money flow over the money flow of the period, 0
+    when the money flow is below 1
+    """
+
+    def __init__(self, name: str, period: int):
+        super().__init__(name)
+        self.sums = [(MF_POS, period, 0), (MF_NEG, period, 0)]
+        self.lookbacks = [period]
+
+    def compute(self, bars, sums):
+        positive = sums[self.sum_indices[0]]
+        money_flow = positive + sums[self.sum_indices[1]]
+        return (100.0 * (positive / money_flow) if money_flow >= 1.0 else 0.0,)
+
+    def compute_batch(self, window, sums):
+        positive = sums[self.sum_indices[0]]
+        money_flow = positive + sums[self.sum_indices[1]]
+        return (np.where(money_flow >= 1.0, 100.0 * (positive / money_flow), 0.0),)
+
+
+class Roc(Indicator):
+    """
+    Rate of change of the close over the period, in percent
+    """
+
+    def __init__(self, name: str, period: int):
+        super().__init__(name)
+        self.period = period
+        self.bars = period + 1
+        self.lookbacks = [period]
+
+    def compute(self, bars, sums):
+        previous = bars[-1 - self.period][CLOSE]
+        if previous == 0.0:
+            return (0.0,)
+        return (((bars[-1][CLOSE] / previous) - 1.0) * 100.0,)
+
+    def compute_batch(self, window, sums):
+        previous = window[CLOSE, -1 - self.period]
+        change = ((window[CLOSE, -1] / previous) - 1.0) * 100.0
+        return (np.where(previous != 0.0, change, 0.0),)
+
+
+KINDS = {
+    'sma': Sma,
+    'ema': Ema,
+    'atr': Atr,
+    'rsi': Rsi,
+    'macd': Macd,
+    'bbands': Bbands,
+    'stochrsi': Stochrsi,
+    'adx': Adx,
+    'ichimoku': Ichimoku,
+    'mfi': Mfi,
+    'roc': Roc,
+}
+
+
+class IndicatorRegistry:
+    """
+    The indicators to compute, resolved into the rolling sums they share, with
+    optional timing of every indicator.
+
+    The outputs come in the order of the indicators, NaN until there are more bars
+    than their lookback.
+    """
+
+    def __init__(
+        self,
+        indicators: Optional[Sequence[dict]] = None,
+        timed: bool = False,
+        stats_interval_sec: float = 60.0,
+    ):
+        """
+        Args:
+            indicators (Optional[Sequence[dict]]): name, kind and parameters of
+                every indicator, DEFAULT_INDICATORS if not given
+            timed (bool): measure the time spent in every indicator, and log it
+            stats_interval_sec (float): how often to log the timings
+        """
+        self.indicators: List[Indicator] = []
+        for spec in DEFAULT_INDICATORS if indicators is None else indicators:
+            params = dict(spec)
+            kind = params.pop('kind')
+            if kind not in KINDS:
+                raise ValueError(
+                    f'Unknown indicator kind {kind!r}, expected one of {list(KINDS)}'
+                )
+            self.indicators.append(KINDS[kind](**params))
+
+        self.outputs = [name for i in self.indicators for name in i.outputs]
+        if len(set(self.outputs)) != len(self.outputs):
+            raise ValueError(f'Indicator outputs are not unique: {self.outputs}')
+        self.lookbacks = {
+            name: lookback
+            for indicator in self.indicators
+            for name, lookback in zip(indicator.outputs, indicator.lookbacks)
+        }
+        # once a pair has more bars than this, every output is ready
+        self.all_ready = max(self.lookbacks.values())
+
+        # every sum once, in the order the indicators ask for them
+        self.sums: List[SumSpec] = []
+        for indicator in self.indicators:
+            for spec in indicator.sums:
+                if spec not in self.sums:
+                    self.sums.append(spec)
+            indicator.sum_indices = tuple(self.sums.index(s) for s in indicator.sums)
+
+        # bars of the closed windows the engines keep, enough to take the oldest
+        # bar out of every sum and for the indicators reading the last bars
+        self.history = max(
+            [n + lag for _, n, lag in self.sums] + [i.bars for i in self.indicators]
+        )
+
+        self._computes = [indicator.compute for indicator in self.indicators]
+
+        self.timed = timed
+        self.stats_interval_sec = stats_interval_sec
+        # ns spent in every indicator, and in the bars and sums they share
+        self.timings = {'bars and sums': 0}
+        self.timings.update((indicator.name, 0) for indicator in self.indicators)
+        self.candles_timed = 0
+        self._logged_at = time.monotonic()
+
+    def compute(self, bars: List[list], sums: List[float], n_bars: int) -> dict:
+        """
+        The outputs as of the last of the bars
+
+        Args:
+            bars (List[list]): the last bars, at least `history` of them if there
+                are
+            sums (List[float]): the sums of the registry up to the last bar
+            n_bars (int): number of bars the indicators look at
+        """
+        if self.timed:
+            return self._compute_timed(bars, sums, n_bars)
+
+        if n_bars > self.all_ready:
+            values = []
+            for compute in self._computes:
+                values += compute(bars, sums)
+            return dict(zip(self.outputs, values))
+
+        result = {}
+        for indicator in self.indicators:
+            if n_bars > min(indicator.lookbacks):
+                values = indicator.compute(bars, sums)
+            else:
+                values = [math.nan] * len(indicator.outputs)
+            for name, lookback, value in zip(
+                indicator.outputs, indicator.lookbacks, values
+            ):
+                result[name] = value if n_bars > lookback else math.nan
+        return result
+
+    def compute_batch(
+        self, window: np.ndarray, sums: List[np.ndarray], n_bars: np.ndarray
+    ) -> Dict[str, np.ndarray]:
+        """
+        The outputs as of the last bar of every column
+
+        Args:
+            window (np.ndarray): bar fields x bars x columns
+            sums (List[np.ndarray]): the sums of the registry for every column
+            n_bars (np.ndarray): number of bars every column looks at
+        """
+        result = {}
+        # the NaN and zero divisions land in the branches np.where drops
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for indicator in self.indicators:
+                values = indicator.compute_batch(window, sums)
+                for name, lookback, value in zip(
+                    indicator.outputs, indicator.lookbacks, values
+                ):
+                    result[name] = np.where(n_bars > lookback, value, np.nan)
+        return result
+
+    def record(self, name: str, elapsed_ns: int):
+        """
+        Adds time spent on the candle being computed
+        """
+        self.timings[name] += elapsed_ns
+
+    def log_stats(self):
+        n_candles = max(self.candles_timed, 1)
+        per_indicator = ', '.join(
+            f'{name} {elapsed_ns / n_candles / 1000:.1f}'
+            for name, elapsed_ns in sorted(
+                self.timings.items(), key=lambda item: -item[1]
+            )
+        )
+        logger.info(f'µs per candle over {self.candles_timed} candles: {per_indicator}')
+        self._logged_at = time.monotonic()
+
+    def _compute_timed(self, bars: List[list], sums: List[float], n_bars: int):
+        result = {}
+        for indicator in self.indicators:
+            started_ns = time.perf_counter_ns()
+            if n_bars > min(indicator.lookbacks):
+                values = indicator.compute(bars, sums)
+            else:
+                values = [math.nan] * len(indicator.outputs)
+            self.timings[indicator.name] += time.perf_counter_ns() - started_ns
+            for name, lookback, value in zip(
+                indicator.outputs, indicator.lookbacks, values
+            ):
+                result[name] = value if n_bars > lookback else math.nan
+
+        self.candles_timed += 1
+        if time.monotonic() - self._logged_at >= self.stats_interval_sec:
+            self.log_stats()
+        return result
+
+
+def sum_rows(window: np.ndarray, field: int, n: int, lag: int = 0) -> np.ndarray:
+    """
+    The sum of `field` over `n` bars ending `lag` bars before the last one, for
+    every column, added up one bar after the other like ta-lib
+    """
+    end = window.shape[1] - lag
+    total = window[field, end - n].copy()
+    for row in range(end - n + 1, end):
+        total += window[field, row]
+    return total
+
+
+def _rsi(average_gain: float, average_loss: float) -> float:
+    total = average_gain + average_loss
+    if -EPSILON < total < EPSILON:
+        return 0.0
+    return 100.0 * (average_gain / total)
+
+
+def _rsi_batch(average_gain: np.ndarray, average_loss: np.ndarray) -> np.ndarray:
+    total = average_gain + average_loss
+    return np.where(np.abs(total) < EPSILON, 0.0, 100.0 * (average_gain / total))
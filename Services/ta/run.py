@@ -1,8 +1,27 @@
-from candle import update_candle
+import time
+from typing import Callable, Dict, List, Optional
+
+from batch_indicators import BatchIndicators
+from incremental import IncrementalIndicators
 from loguru import logger
-from quixstreams import Application
+from quixstreams import Application, State
+from quixstreams.models import SerializationContext, Topic, TopicConfig
+from registry import IndicatorRegistry
+from snapshot import StateSnapshots, rewind_to_snapshot
 from technical_indicators import compute_indicators
+from timeframes import TimeframeIndicators, parse_timeframes
 from typing_extensions import Literal
+from wire_format import (
+    INDICATOR_NAMES,
+    TA_SCHEMA,
+    WireDeserializer,
+    WireFormat,
+    get_serializer,
+)
+from workers import TAWorkers
+
+# the keys of the state of a pair every engine keeps
+STATE_KEYS = {'incremental': ['indicators'], 'talib': ['history']}
 
 
 def main(
@@ -13,6 +32,18 @@ def main(
     max_candles_in_state: int,
     candle_seconds: int,
     data_source: Literal['live', 'historical'],
+    wire_format: WireFormat = 'json',
+    indicator_engine: Literal['incremental', 'talib'] = 'incremental',
+    batch_indicators: bool = False,
+    batch_max_candles: int = 10_000,
+    indicators: Optional[List[dict]] = None,
+    indicator_timing: bool = False,
+    state_dir: str = 'state',
+    snapshot_dir: Optional[str] = None,
+    snapshot_interval_sec: float = 60.0,
+    snapshot_name: str = 'ta',
+    extra_timeframes: Optional[List[dict]] = None,
+    kafka_input_topic_partitions: Optional[int] = None,
 ):
     """
     1. ingests candles from the kafka topic
@@ -27,42 +58,132 @@ def main(
         max_candles_in_state (int): number of candles to keep in state
         candle_seconds (int): size of the candles in seconds
         data_source (Literal['live', 'historical']): data source
+        wire_format (WireFormat): encode the indicators as 'json' or 'binary'
+        indicator_engine (Literal['incremental', 'talib']): update the indicators
+            of every pair in constant time, or recompute them with talib from the
+            candles in the state
+        batch_indicators (bool): compute the indicators of whole chunks of candles
+            at once, only for historical runs
+        batch_max_candles (int): maximum number of candles per chunk
+        indicators (Optional[List[dict]]): name, kind and parameters of the
+            indicators to compute, the ones of technical_indicators.py if not given
+        indicator_timing (bool): log the time spent in every indicator
+        state_dir (str): directory of the state store
+        snapshot_dir (Optional[str]): directory of the snapshots of the state of
+            the pairs, to warm start from when the state store is empty
+        snapshot_interval_sec (float): how often to write the snapshot
+        snapshot_name (str): name of the snapshot file of this process
+        extra_timeframes (Optional[List[dict]]): candle_seconds, and optionally
+            max_candles_in_state and indicators, of more timeframes to compute from
+            the same topic
+        kafka_input_topic_partitions (Optional[int]): partitions of the candles
+            topic when this service creates it, one per worker at most
 
     Returns:
         None
     """
     logger.info('starting ta service!')
 
+    timeframes = parse_timeframes(
+        candle_seconds, max_candles_in_state, indicators, extra_timeframes
+    )
+    registries = {}
+    for timeframe in timeframes:
+        registry = IndicatorRegistry(timeframe.indicators, timed=indicator_timing)
+        if indicator_engine == 'talib' and registry.outputs != INDICATOR_NAMES:
+            raise ValueError('The talib engine only computes the default indicators')
+        if wire_format == 'binary' and registry.outputs != INDICATOR_NAMES:
+            raise ValueError(
+                'The binary wire format only carries the default indicators, '
+                'use the json one with other indicators'
+            )
+        registries[timeframe.candle_seconds] = registry
+
     # initialize the quixstreams application
     app = Application(
         broker_address=kafka_broker_address,
         consumer_group=kafka_consumer_group,
         auto_offset_reset='latest' if data_source == 'live' else 'earliest',
+        state_dir=state_dir,
     )
 
-    # Define a topic where the candles will be read
+    # Define a topic where the candles will be read. The workers share its
+    # partitions, a topic that exists already keeps the partitions it has.
     input_topic = app.topic(
         name=kafka_input_topic,
-        value_deserializer='json',
+        value_deserializer=WireDeserializer(),
+        config=TopicConfig(
+            num_partitions=kafka_input_topic_partitions, replication_factor=1
+        )
+        if kafka_input_topic_partitions
+        else None,
     )
 
     # Define a topic where the indicators will be pushed
     output_topic = app.topic(
         name=kafka_output_topic,
-        value_serializer='json',
+        value_serializer=get_serializer(wire_format, TA_SCHEMA),
     )
 
+    if batch_indicators:
+        if data_source != 'historical':
+            raise ValueError('Batch indicators are only for historical runs')
+        if snapshot_dir is not None:
+            raise ValueError('Snapshots are only for the streaming path')
+        run_batches(
+            app,
+            input_topic,
+            output_topic,
+            {
+                timeframe.candle_seconds: BatchIndicators(
+                    timeframe.max_candles_in_state,
+                    registries[timeframe.candle_seconds],
+                )
+                for timeframe in timeframes
+            },
+            batch_max_candles,
+        )
+        return
+
     # Create a streaming dataframe for transforming
     sdf = app.dataframe(topic=input_topic)
 
-    # we only keep the candles with the same windows size as the candle_seconds
-    sdf = sdf[sdf['candle_seconds'] == candle_seconds]
+    snapshots = None
+    if snapshot_dir is not None:
+        # pairs with an empty state start from the snapshot, and the snapshot keeps
+        # the state of every pair
+        snapshots = StateSnapshots(
+            snapshot_dir,
+            snapshot_name,
+            STATE_KEYS[indicator_engine],
+            snapshot_interval_sec,
+        )
 
-    # update the list of candles in the state
-    sdf = sdf.apply(update_candle, stateful=True)
+    updates = {}
+    for timeframe in timeframes:
+        update_state = timeframe_update(
+            indicator_engine,
+            timeframe.max_candles_in_state,
+            registries[timeframe.candle_seconds],
+        )
+        if snapshots is not None:
+            update_state = snapshots.wrap(update_state)
+        updates[timeframe.candle_seconds] = update_state
+    timeframe_indicators = TimeframeIndicators(candle_seconds, updates)
 
-    # compute the technical indicators from the candles in the state
-    sdf = sdf.apply(compute_indicators, stateful=True)
+    # we only keep the candles with the window sizes of the timeframes
+    sdf = sdf[sdf['candle_seconds'].isin(list(updates))]
+
+    if snapshots is not None:
+        sdf = sdf.filter(
+            lambda candle, state: snapshots.warm_start(
+                candle, timeframe_indicators.state_of(candle, state)
+            ),
+            stateful=True,
+        )
+
+    # update the indicators of the pair in the timeframe of the candle
+    sdf = sdf.apply(timeframe_indicators.update, stateful=True)
 
     sdf = sdf.update(lambda value: logger.debug(f'final message: {value}'))
 
@@ -74,11 +195,130 @@ def main(
 
     app.run()
 
+    if snapshots is not None:
+        snapshots.save()
+
+
+def timeframe_update(
+    indicator_engine: Literal['incremental', 'talib'],
+    max_candles_in_state: int,
+    registry: IndicatorRegistry,
+) -> Callable[[dict, State], dict]:
+    """
+    The stateful update of the indicators of a pair with a candle of a timeframe
+    """
+    if indicator_engine == 'incremental':
+        # update the running indicators of the pair with the candle
+        return IncrementalIndicators(max_candles_in_state, registry).update
+
+    def update_with_talib(candle: dict, state: State) -> dict:
+        # update the candles in the state and compute the technical indicators
+        return compute_indicators(candle, state, max_candles_in_state)
+
+    return update_with_talib
+
+
+def run_batches(
+    app: Application,
+    input_topic: Topic,
+    output_topic: Topic,
+    indicators: Dict[int, BatchIndicators],
+    batch_max_candles: int,
+    stats_interval_sec: float = 10.0,
+):
+    """
+    Historical alternative to the streaming dataframe: consumes the candles in
+    chunks and computes their indicators with array operations, instead of one
+    candle at a time through the state store.
+
+    The output is the same as the streaming path, message by message. The last bars
+    of every pair live in memory only, so after a restart the indicators warm up
+    again. Historical runs start from a fresh consumer group anyway.
+
+    Args:
+        app (Application): the quixstreams application
+        input_topic (Topic): topic to read candles from
+        output_topic (Topic): topic to push indicators to
+        indicators (Dict[int, BatchIndicators]): the indicators of every
+            timeframe, by candle seconds
+        batch_max_candles (int): maximum number of candles per chunk
+        stats_interval_sec (float): how often to log the throughput
+    """
+    deserializer = WireDeserializer()
+    ctx = SerializationContext(topic=input_topic.name, field='value')
+
+    started_at = time.monotonic()
+    logged_at = started_at
+
+    with (
+        app.get_consumer(auto_commit_enable=False) as consumer,
+        app.get_producer() as producer,
+    ):
+        consumer.subscribe([input_topic.name])
+
+        while True:
+            messages = []
+            while len(messages) < batch_max_candles:
+                msg = consumer.poll(timeout=0.1 if messages else 1.0)
+                if msg is None:
+                    break
+                if msg.error():
+                    raise RuntimeError(f'Failed to consume candles: {msg.error()}')
+                messages.append(msg)
+
+            if not messages:
+                continue
+
+            # we only keep the candles with the window sizes of the timeframes
+            candles = [deserializer(msg.value(), ctx) for msg in messages]
+            kept = [
+                (msg, candle)
+                for msg, candle in zip(messages, candles)
+                if candle['candle_seconds'] in indicators
+            ]
+
+            # every timeframe computes its candles, back in the order they came
+            positions = {}
+            for i, (_, candle) in enumerate(kept):
+                positions.setdefault(candle['candle_seconds'], []).append(i)
+            results = [None] * len(kept)
+            for seconds, timeframe_positions in positions.items():
+                timeframe_results = indicators[seconds].add(
+                    [kept[i][1] for i in timeframe_positions]
+                )
+                for i, result in zip(timeframe_positions, timeframe_results):
+                    results[i] = result
+
+            for (msg, _), result in zip(kept, results):
+                # like to_topic(), with the key and timestamp of the candle
+                producer.produce(
+                    topic=output_topic.name,
+                    key=msg.key(),
+                    value=output_topic.serialize(value=result).value,
+                    timestamp=msg.timestamp()[1],
+                )
+
+            # the indicators are in the topic before the candles are marked as
+            # consumed
+            producer.flush()
+            consumer.commit(asynchronous=False)
+
+            if time.monotonic() - logged_at >= stats_interval_sec:
+                elapsed_sec = time.monotonic() - started_at
+                candles_processed = sum(
+                    timeframe.candles_processed for timeframe in indicators.values()
+                )
+                logger.info(
+                    f'{candles_processed / elapsed_sec:,.0f} candles/s, '
+                    f'{candles_processed} candles'
+                )
+                logged_at = time.monotonic()
+
 
 if __name__ == '__main__':
     from config import config
 
-    main(
+    service_kwargs = dict(
         kafka_broker_address=config.kafka_broker_address,
         kafka_input_topic=config.kafka_input_topic,
         kafka_output_topic=config.kafka_output_topic,
@@ -86,4 +326,33 @@ if __name__ == '__main__':
         max_candles_in_state=config.max_candles_in_state,
         candle_seconds=config.candle_seconds,
         data_source=config.data_source,
+        wire_format=config.wire_format,
+        indicator_engine=config.indicator_engine,
+        batch_indicators=config.batch_indicators,
+        batch_max_candles=config.batch_max_candles,
+        indicators=config.indicators,
+        indicator_timing=config.indicator_timing,
+        snapshot_dir=config.snapshot_dir,
+        snapshot_interval_sec=config.snapshot_interval_sec,
+        extra_timeframes=config.extra_timeframes,
+        kafka_input_topic_partitions=config.kafka_input_topic_partitions,
     )
+
+    if config.snapshot_dir is not None and not config.batch_indicators:
+        # a new consumer group replays the candles from the snapshot on, once for
+        # all the workers
+        resume_from_ms = StateSnapshots(
+            config.snapshot_dir, 'ta', STATE_KEYS[config.indicator_engine]
+        ).resume_from_ms()
+        if resume_from_ms is not None:
+            rewind_to_snapshot(
+                config.kafka_broker_address,
+                config.kafka_consumer_group,
+                config.kafka_input_topic,
+                resume_from_ms,
+            )
+
+    if config.workers > 0:
+        TAWorkers(config.workers, **service_kwargs).run()
+    else:
+        main(**service_kwargs)
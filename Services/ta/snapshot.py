@@ -0,0 +1,227 @@
+import glob
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from confluent_kafka import Consumer, TopicPartition
+from loguru import logger
+from quixstreams import State
+from quixstreams.utils.json import dumps, loads
+
+
+class StateSnapshots:
+    """
+    Keeps the last state of every pair and timeframe in memory and writes it to a
+    file every `interval_sec` and on shutdown, so a service starting with an empty
+    state store, after a fresh deploy or with a new consumer group, picks the pairs
+    up where the snapshot left them instead of warming up for
+    `max_candles_in_state` windows.
+
+    A pair is seeded from the snapshot on its first candle of a timeframe, and only
+    if its state is empty: a state restored by quixstreams from the changelog goes
+    on from its own checkpoint. Candles of windows older than the last window of a
+    pair are dropped, so the candles replayed from before the snapshot are not
+    counted twice.
+
+    Every process writes its own file in the snapshot directory and reads them all,
+    keeping the latest state of every pair, so the workers of the service can
+    trade pairs between restarts.
+    """
+
+    def __init__(
+        self,
+        snapshot_dir: str,
+        name: str,
+        keys: List[str],
+        interval_sec: float = 60.0,
+    ):
+        """
+        Args:
+            snapshot_dir (str): directory of the snapshot files
+            name (str): name of the file of this process
+            keys (List[str]): keys of the state of a pair the engine uses
+            interval_sec (float): how often to write the snapshot
+        """
+        self.snapshot_dir = snapshot_dir
+        self.path = os.path.join(snapshot_dir, f'{name}.json')
+        self.keys = keys
+        self.interval_sec = interval_sec
+        # the last window and the state of every pair and timeframe
+        self.pairs: Dict[str, dict] = {}
+        # pairs and timeframes whose state was checked for a warm start
+        self._checked: Set[str] = set()
+        self._saved_at = time.monotonic()
+        self.load()
+
+    def load(self):
+        """
+        Reads every snapshot file of the directory, keeping the latest state of
+        every pair
+        """
+        for path in glob.glob(os.path.join(self.snapshot_dir, '*.json')):
+            with open(path, 'rb') as f:
+                snapshot = loads(f.read())
+            if snapshot['keys'] != self.keys:
+                logger.warning(f'Skipping {path}, it is the state of another engine')
+                continue
+            for pair, record in snapshot['pairs'].items():
+                loaded = self.pairs.get(pair)
+                if (
+                    loaded is None
+                    or record['window_start_ms'] > loaded['window_start_ms']
+                ):
+                    self.pairs[pair] = record
+
+        if self.pairs:
+            logger.info(
+                f'Loaded the snapshot of {len(self.pairs)} pairs, the oldest from '
+                f'window {self.resume_from_ms()}'
+            )
+
+    def save(self):
+        """
+        Writes the snapshot, replacing the file only once it is complete
+        """
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        snapshot = {
+            'keys': self.keys,
+            'saved_at_ms': int(time.time() * 1000),
+            'pairs': self.pairs,
+        }
+        with open(self.path + '.tmp', 'wb') as f:
+            f.write(dumps(snapshot))
+        os.replace(self.path + '.tmp', self.path)
+        self._saved_at = time.monotonic()
+        logger.debug(f'Saved the snapshot of {len(self.pairs)} pairs to {self.path}')
+
+    def resume_from_ms(self) -> Optional[int]:
+        """
+        The oldest last window of the pairs in the snapshot, the candles from there
+        on are the ones to replay
+        """
+        return min((r['window_start_ms'] for r in self.pairs.values()), default=None)
+
+    def warm_start(self, candle: dict, state: State) -> bool:
+        """
+        Stateful filter before the update of the state: seeds the state of the pair
+        from the snapshot on its first candle if the state is empty, and drops the
+        candles of windows before the last one of the pair
+
+        Returns:
+            bool: whether the candle goes on to the update of the state
+        """
+        pair = _record_key(candle)
+        if pair not in self._checked:
+            self._checked.add(pair)
+            record = self.pairs.get(pair)
+            if record is not None and all(
+                state.get(key, default=None) is None for key in self.keys
+            ):
+                for key, value in record['state'].items():
+                    state.set(key, value)
+                logger.info(
+                    f'Warm start of {pair} from the snapshot of window '
+                    f'{record["window_start_ms"]}'
+                )
+            elif record is not None:
+                # the state store kept the pair, it goes on from there
+                del self.pairs[pair]
+
+        record = self.pairs.get(pair)
+        if record is None or candle['window_start_ms'] >= record['window_start_ms']:
+            return True
+        logger.debug(f'Dropping a candle of {pair} older than its state')
+        return False
+
+    def wrap(
+        self, update: Callable[[dict, State], Any]
+    ) -> Callable[[dict, State], Any]:
+        """
+        Wraps the stateful function updating the state of a pair with a candle, to
+        keep the state for the snapshot
+        """
+
+        def update_with_snapshot(candle: dict, state: State):
+            recording = _RecordingState(state)
+            result = update(candle, recording)
+            pair = _record_key(candle)
+            record = self.pairs.get(pair)
+            values = record['state'] if record is not None else {}
+            self.pairs[pair] = {
+                'window_start_ms': candle['window_start_ms'],
+                'state': {**values, **recording.values},
+            }
+
+            if time.monotonic() - self._saved_at >= self.interval_sec:
+                self.save()
+            return result
+
+        return update_with_snapshot
+
+
+def _record_key(candle: dict) -> str:
+    return f'{candle["pair"]}@{candle["candle_seconds"]}'
+
+
+class _RecordingState:
+    """
+    The state of a pair, keeping the values set on it. The state store hands out
+    new objects on every get, so the values are not changed once set.
+    """
+
+    def __init__(self, state: State):
+        self._state = state
+        self.values: Dict[str, Any] = {}
+
+    def get(self, key: str, default=None):
+        return self._state.get(key, default=default)
+
+    def set(self, key: str, value):
+        self._state.set(key, value)
+        self.values[key] = value
+
+    def delete(self, key: str):
+        self._state.delete(key)
+
+
+def rewind_to_snapshot(
+    broker_address: str, consumer_group: str, topic: str, resume_from_ms: int
+):
+    """
+    Points a consumer group without committed offsets at the first candles of the
+    windows of the snapshot, instead of the start or the end of the topic, so only
+    the candles the snapshot does not have are replayed. A group with committed
+    offsets resumes from them as usual.
+    """
+    consumer = Consumer(
+        {
+            'bootstrap.servers': broker_address,
+            'group.id': consumer_group,
+            'enable.auto.commit': False,
+        }
+    )
+    try:
+        metadata = consumer.list_topics(topic, timeout=10).topics.get(topic)
+        if metadata is None or metadata.error is not None:
+            return
+        partitions = [TopicPartition(topic, p) for p in metadata.partitions]
+        fresh = [
+            TopicPartition(topic, tp.partition, resume_from_ms)
+            for tp in consumer.committed(partitions, timeout=10)
+            if tp.offset < 0
+        ]
+        if not fresh:
+            return
+
+        offsets = consumer.offsets_for_times(fresh, timeout=10)
+        for tp in offsets:
+            # no candle that recent, the group starts at the end
+            if tp.offset < 0:
+                _, tp.offset = consumer.get_watermark_offsets(tp, timeout=10)
+        consumer.commit(offsets=offsets, asynchronous=False)
+        logger.info(
+            f'Replaying {topic} from window {resume_from_ms} in '
+            f'{len(offsets)} partitions'
+        )
+    finally:
+        consumer.close()
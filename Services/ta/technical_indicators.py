@@ -1,4 +1,5 @@
 import numpy as np
+from candle import update_history
 from quixstreams import State
 from talib import stream
 
@@ -6,19 +7,27 @@ from talib import stream
 def compute_indicators(
     candle: dict,
     state: State,
+    max_candles_in_state: int,
 ) -> dict:
     """
-    Computes the technical indicators from the candles in the state
+    Adds the candle to the candles in the state and computes the technical
+    indicators from them
     """
-    candles = state.get('candles', [])
+    # high, low, close and volume of the candles, as the update left them
+    high, low, close, volume = update_history(candle, state, max_candles_in_state)
+    return indicators_from_columns(candle, high, low, close, volume)
 
-    # extract open, high, low, close from the candles
-    # open = np.array([candle['open'] for candle in candles])
-    high = np.array([candle['high'] for candle in candles])
-    low = np.array([candle['low'] for candle in candles])
-    close = np.array([candle['close'] for candle in candles])
-    volume = np.array([candle['volume'] for candle in candles])
 
+def indicators_from_columns(
+    candle: dict,
+    high: np.ndarray,
+    low: np.ndarray,
+    close: np.ndarray,
+    volume: np.ndarray,
+) -> dict:
+    """
+    Computes the technical indicators from the columns of the candles, oldest first
+    """
     indicators = {}
 
     # Compute the technical indicators
@@ -0,0 +1,143 @@
+"""
+The engines of the ta service give the same messages: the incremental indicators
+and the talib path, the batch indicators of historical runs and the streaming ones,
+a warm start from a snapshot and an uninterrupted run, and the timeframes of one
+service and a service per timeframe.
+"""
+
+import math
+from typing import List
+
+import pytest
+from benchmark import (
+    N_WINDOWS,
+    DictState,
+    batch,
+    incremental_path,
+    list_path,
+    make_candles,
+    run,
+    snapshot_path,
+    talib_path,
+    timeframe_streams,
+    timeframes_path,
+)
+from registry import IndicatorRegistry
+from snapshot import StateSnapshots
+
+# the bands take the square root of the rounding noise of a zero variance in flat
+# markets, everything else matches to a few ulps of the price
+REL_TOL = {'bbands_upper': 1e-6, 'bbands_lower': 1e-6}
+
+CUSTOM = [
+    {'name': 'rsi_9', 'kind': 'rsi', 'period': 9},
+    {'name': 'sma_14', 'kind': 'sma', 'period': 14},
+    {'name': 'sma_50', 'kind': 'sma', 'period': 50},
+    {'name': 'ema_30', 'kind': 'ema', 'period': 30},
+    {'name': 'atr', 'kind': 'atr', 'period': 10},
+]
+
+
+def check_parity(expected: List[dict], actual: List[dict], exact: bool = False):
+    assert len(expected) == len(actual)
+    for i, (a, b) in enumerate(zip(expected, actual)):
+        assert list(a) == list(b), f'message {i} has different fields'
+        for field, value in a.items():
+            if isinstance(value, str):
+                assert value == b[field]
+                continue
+            value, other = float(value), float(b[field])
+            if math.isnan(value) or math.isnan(other):
+                assert math.isnan(value) and math.isnan(other), (
+                    f'message {i}: {field} is {value} and {other}'
+                )
+                continue
+            rel_tol, abs_tol = (0.0, 0.0) if exact else (REL_TOL.get(field, 1e-9), 1e-9)
+            assert math.isclose(value, other, rel_tol=rel_tol, abs_tol=abs_tol), (
+                f'message {i}: {field} is {value} and {other}'
+            )
+
+
+@pytest.mark.parametrize('updates_per_window', [1, 5])
+@pytest.mark.parametrize('max_candles_in_state', [30, 60])
+def test_incremental_matches_talib(updates_per_window, max_candles_in_state):
+    candles = make_candles(N_WINDOWS, updates_per_window)
+    check_parity(
+        run(talib_path(max_candles_in_state), candles),
+        run(incremental_path(max_candles_in_state), candles),
+    )
+
+
+@pytest.mark.parametrize('updates_per_window', [1, 5])
+@pytest.mark.parametrize('max_candles_in_state', [30, 60])
+@pytest.mark.parametrize('chunk_size', [1, 777, 100_000])
+def test_batch_matches_incremental(
+    updates_per_window, max_candles_in_state, chunk_size
+):
+    candles = make_candles(N_WINDOWS, updates_per_window)
+    check_parity(
+        run(incremental_path(max_candles_in_state), candles),
+        batch(max_candles_in_state, candles, chunk_size),
+    )
+
+
+def test_custom_indicators_match_the_defaults():
+    candles = make_candles(N_WINDOWS, 5)
+    default = run(incremental_path(60), candles)
+    custom = run(incremental_path(60, IndicatorRegistry(CUSTOM)), candles)
+    check_parity(custom, batch(60, candles, 777, IndicatorRegistry(CUSTOM)))
+
+    # the sums resync on another cadence with more bars kept, so to a few ulps
+    shared = ('pair', 'rsi_9', 'sma_14', 'atr')
+    check_parity(
+        [{name: message[name] for name in shared} for message in default],
+        [{name: message[name] for name in shared} for message in custom],
+    )
+
+    # 60 candles in state, so an sma of 50 is ready from the 50th window
+    sma_50 = [message['sma_50'] for message in custom]
+    assert all(math.isnan(value) for value in sma_50[: 49 * 5])
+    assert not any(math.isnan(value) for value in sma_50[49 * 5 :])
+
+
+def test_warm_start_matches_an_uninterrupted_run(tmp_path):
+    # a restart halfway, the state store empty and the candles replayed from the
+    # snapshot on like the rewound consumer group reads them
+    candles = make_candles(N_WINDOWS, 5)
+    expected = run(incremental_path(60), candles)
+
+    snapshots = StateSnapshots(str(tmp_path), 'ta', ['indicators'], math.inf)
+    run(snapshot_path(60, snapshots), candles[: len(candles) // 2 + 2])
+    snapshots.save()
+
+    snapshots = StateSnapshots(str(tmp_path), 'ta', ['indicators'])
+    resume_from_ms = snapshots.resume_from_ms()
+    first = next(
+        i for i, c in enumerate(candles) if c['window_start_ms'] >= resume_from_ms
+    )
+    # a few candles from before the snapshot, as offsets_for_times may land
+    replayed = run(snapshot_path(60, snapshots), candles[first - 7 :])
+
+    assert replayed[:7] == [None] * 7
+    check_parity(expected[first:], replayed[7:], exact=True)
+
+
+def test_every_timeframe_matches_a_service_of_its_own():
+    timeframes, streams, candles = timeframe_streams()
+    messages = run(timeframes_path(timeframes), candles)
+    for seconds, stream in streams.items():
+        state = DictState()
+        engine = timeframes[seconds]()
+        expected = [engine.update(dict(candle), state) for candle in stream]
+        actual = [m for m in messages if m['candle_seconds'] == seconds]
+        check_parity(expected, actual, exact=True)
+
+
+@pytest.mark.parametrize('updates_per_window', [1, 5])
+def test_packed_history_matches_the_list_of_candles(updates_per_window):
+    candles = make_candles(500, updates_per_window)
+    check_parity(
+        run(list_path(60, DictState()), candles),
+        run(talib_path(60), candles),
+        exact=True,
+    )
@@ -0,0 +1,75 @@
+"""
+The worker processes of the ta service: the batch indicators are refused, and a
+worker dying stops all the others. The workers run a stand-in for the service, the
+supervision does not depend on what they run.
+"""
+
+import os
+import signal
+import time
+from typing import Any, Dict
+
+import pytest
+import workers
+from workers import TAWorkers
+
+N_WORKERS = 3
+
+
+def fake_worker(service_kwargs: Dict[str, Any]):
+    """
+    Takes its state directory like the service does and runs until it is stopped,
+    the worker named in `dying_worker` exits with code 3 after a moment
+    """
+    os.makedirs(service_kwargs['state_dir'])
+    if service_kwargs['snapshot_name'] == service_kwargs['dying_worker']:
+        time.sleep(0.5)
+        os._exit(3)
+    while True:
+        time.sleep(1)
+
+
+@pytest.fixture
+def supervised(monkeypatch):
+    """
+    TAWorkers running `fake_worker`, without a broker, and the signal handlers of
+    the test session put back afterwards
+    """
+    monkeypatch.setattr(workers, 'run_worker', fake_worker)
+    monkeypatch.setattr(workers, 'input_partitions', lambda *_: None)
+    handlers = {sig: signal.getsignal(sig) for sig in (signal.SIGTERM, signal.SIGINT)}
+    yield
+    for sig, handler in handlers.items():
+        signal.signal(sig, handler)
+
+
+def test_batch_indicators_are_refused():
+    with pytest.raises(ValueError, match='Batch indicators'):
+        TAWorkers(2, batch_indicators=True)
+
+    TAWorkers(2, batch_indicators=False)
+
+
+def test_a_dying_worker_stops_all_the_others(supervised, tmp_path):
+    ta_workers = TAWorkers(
+        N_WORKERS,
+        state_dir=str(tmp_path),
+        kafka_broker_address='localhost:9092',
+        kafka_input_topic='candles',
+        dying_worker='worker-1',
+    )
+
+    started_at = time.monotonic()
+    with pytest.raises(RuntimeError, match='ta-worker-1 exited with code 3'):
+        ta_workers.run(check_interval_sec=0.1)
+
+    # stopped by SIGTERM, not after the timeout of stop()
+    assert time.monotonic() - started_at < 10
+    assert not any(worker.is_alive() for worker in ta_workers._workers)
+    assert sorted(w.exitcode for w in ta_workers._workers) == [
+        -signal.SIGTERM,
+        -signal.SIGTERM,
+        3,
+    ]
+    # every worker had a state directory of its own
+    assert sorted(os.listdir(tmp_path)) == [f'worker-{i}' for i in range(N_WORKERS)]
@@ -0,0 +1,108 @@
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+from quixstreams import State
+
+
+class Timeframe(NamedTuple):
+    candle_seconds: int
+    max_candles_in_state: int
+    # name, kind and parameters of the indicators, the default ones if None
+    indicators: Optional[List[dict]]
+
+
+def parse_timeframes(
+    candle_seconds: int,
+    max_candles_in_state: int,
+    indicators: Optional[List[dict]],
+    extra_timeframes: Optional[List[dict]],
+) -> List[Timeframe]:
+    """
+    The timeframe of candle_seconds and the extra ones, every extra one taking the
+    parameters it does not set from candle_seconds
+
+    Args:
+        candle_seconds (int): size of the base candles in seconds
+        max_candles_in_state (int): number of candles the base indicators look at
+        indicators (Optional[List[dict]]): the base indicators
+        extra_timeframes (Optional[List[dict]]): candle_seconds, and optionally
+            max_candles_in_state and indicators, of every extra timeframe
+    """
+    timeframes = [Timeframe(candle_seconds, max_candles_in_state, indicators)]
+    for params in extra_timeframes or []:
+        unknown = set(params) - set(Timeframe._fields)
+        if 'candle_seconds' not in params or unknown:
+            raise ValueError(
+                f'A timeframe needs candle_seconds and can set {Timeframe._fields}, '
+                f'got {params}'
+            )
+        timeframes.append(
+            Timeframe(
+                params['candle_seconds'],
+                params.get('max_candles_in_state', max_candles_in_state),
+                params.get('indicators', indicators),
+            )
+        )
+
+    seconds = [timeframe.candle_seconds for timeframe in timeframes]
+    if len(set(seconds)) != len(seconds):
+        raise ValueError(f'Timeframes are not unique: {seconds}')
+    return timeframes
+
+
+class TimeframeIndicators:
+    """
+    Computes the indicators of several timeframes of candles in one pass over the
+    candles topic, every timeframe with its own parameters and its own state per
+    pair, so the candles are consumed and deserialized once for all of them.
+
+    The message key is the pair whatever the timeframe, so the states of a pair sit
+    side by side in the state of its key: the base timeframe under the keys the
+    service always used, so adding timeframes keeps its state, and every other one
+    under the same keys with its candle seconds.
+    """
+
+    def __init__(
+        self, candle_seconds: int, updates: Dict[int, Callable[[dict, State], dict]]
+    ):
+        """
+        Args:
+            candle_seconds (int): size of the base candles in seconds
+            updates (Dict[int, Callable[[dict, State], dict]]): the stateful update
+                of every timeframe, by candle seconds
+        """
+        self.candle_seconds = candle_seconds
+        self.updates = updates
+
+    def state_of(self, candle: dict, state: State):
+        """
+        The state of the pair of the candle in the timeframe of the candle
+        """
+        if candle['candle_seconds'] == self.candle_seconds:
+            return state
+        return _TimeframeState(state, candle['candle_seconds'])
+
+    def update(self, candle: dict, state: State) -> dict:
+        """
+        Stateful apply of the streaming dataframe, with one state per pair
+        """
+        update = self.updates[candle['candle_seconds']]
+        return update(candle, self.state_of(candle, state))
+
+
+class _TimeframeState:
+    """
+    The state of a pair with the keys of a timeframe
+    """
+
+    def __init__(self, state: State, candle_seconds: int):
+        self._state = state
+        self._suffix = f'_{candle_seconds}s'
+
+    def get(self, key: str, default=None):
+        return self._state.get(key + self._suffix, default=default)
+
+    def set(self, key: str, value):
+        self._state.set(key + self._suffix, value)
+
+    def delete(self, key: str):
+        self._state.delete(key + self._suffix)
@@ -0,0 +1,149 @@
+import multiprocessing
+import signal
+import time
+from typing import Any, Dict, Optional
+
+from confluent_kafka.admin import AdminClient
+from loguru import logger
+
+
+class TAWorkers:
+    """
+    Runs the ta service in several worker processes, one streaming application
+    each, all in the same consumer group.
+
+    Kafka deals the partitions of the candles topic to the workers, and the
+    candles of a pair always land in the same partition, so every worker owns a
+    disjoint set of pairs with its own state, and the candles of a pair are
+    processed in order by one worker at a time. More workers than partitions
+    leaves the extra ones idle.
+
+    When a worker joins or leaves, quixstreams commits the checkpoint of the
+    partitions moving away before handing them over, and the worker taking them
+    restores their state from the changelog topic, so no candle is lost or counted
+    twice in the indicators. Every worker keeps its state in its own directory, a
+    partition moving between workers of the same host never waits on the lock of
+    the other one.
+    """
+
+    def __init__(
+        self,
+        n_workers: int,
+        state_dir: str = 'state',
+        **service_kwargs: Any,
+    ):
+        """
+        Args:
+            n_workers (int): number of worker processes
+            state_dir (str): directory of the state of the workers, one sub
+                directory each
+            service_kwargs: passed to `run.main` in every worker
+        """
+        if service_kwargs.get('batch_indicators'):
+            raise ValueError(
+                'Batch indicators keep the bars of the pairs in memory, they can '
+                'not move between workers'
+            )
+        self.n_workers = n_workers
+        self.state_dir = state_dir
+        self.service_kwargs = service_kwargs
+        self._workers = []
+        self._stopping = False
+
+    def run(self, check_interval_sec: float = 1.0):
+        """
+        Starts the workers and waits for them, stopping them all on SIGTERM or
+        SIGINT, or as soon as one of them dies
+        """
+        n_partitions = input_partitions(
+            self.service_kwargs['kafka_broker_address'],
+            self.service_kwargs['kafka_input_topic'],
+        )
+        if n_partitions is not None and n_partitions < self.n_workers:
+            logger.warning(
+                f'{self.service_kwargs["kafka_input_topic"]} has {n_partitions} '
+                f'partitions, {self.n_workers - n_partitions} of the '
+                f'{self.n_workers} workers will be idle, set '
+                f'KAFKA_OUTPUT_TOPIC_PARTITIONS of the candles service before it '
+                f'creates the topic'
+            )
+
+        # spawn instead of fork, every worker builds its own kafka clients
+        ctx = multiprocessing.get_context('spawn')
+        for worker_id in range(self.n_workers):
+            worker = ctx.Process(
+                target=run_worker,
+                args=(
+                    {
+                        **self.service_kwargs,
+                        'state_dir': f'{self.state_dir}/worker-{worker_id}',
+                        'snapshot_name': f'worker-{worker_id}',
+                    },
+                ),
+                name=f'ta-worker-{worker_id}',
+            )
+            worker.start()
+            self._workers.append(worker)
+        logger.info(f'Started {self.n_workers} ta workers')
+
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+
+        try:
+            while True:
+                time.sleep(check_interval_sec)
+                # Ctrl+C reaches the workers too, they may be gone already
+                if self._stopping:
+                    break
+                self._check_workers()
+        finally:
+            self.stop()
+
+    def stop(self, timeout_sec: float = 30.0):
+        """
+        Stops the workers the way the service stops on its own: SIGTERM lets every
+        worker commit its checkpoint before it exits
+        """
+        self._stopping = True
+        for worker in self._workers:
+            if worker.is_alive():
+                worker.terminate()
+        deadline = time.monotonic() + timeout_sec
+        for worker in self._workers:
+            worker.join(max(deadline - time.monotonic(), 0))
+            if worker.is_alive():
+                logger.warning(f'{worker.name} did not stop, killing it')
+                worker.kill()
+                worker.join()
+
+    def _on_signal(self, *_):
+        logger.info('Stopping the ta workers')
+        self._stopping = True
+
+    def _check_workers(self):
+        for worker in self._workers:
+            if not worker.is_alive():
+                raise RuntimeError(
+                    f'TA worker {worker.name} exited with code {worker.exitcode}'
+                )
+
+
+def run_worker(service_kwargs: Dict[str, Any]):
+    """
+    Entry point of a worker process, runs the streaming application until it is
+    stopped
+    """
+    from run import main
+
+    main(**service_kwargs)
+
+
+def input_partitions(broker_address: str, topic: str) -> Optional[int]:
+    """
+    Returns the number of partitions of the topic, None if it does not exist yet
+    """
+    admin = AdminClient({'bootstrap.servers': broker_address})
+    metadata = admin.list_topics(topic, timeout=10).topics.get(topic)
+    if metadata is None or metadata.error is not None:
+        return None
+    return len(metadata.partitions)
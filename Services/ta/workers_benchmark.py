@@ -0,0 +1,298 @@
+"""
+Benchmark of the ta workers against a broker: the real `TAWorkers` on a candles
+topic with several partitions, 1 and 5 minute candles of many pairs, while one more
+worker joins the consumer group and leaves it again. Checks that every pair gets
+the messages of an uninterrupted run, in order, and fails loudly if it does not.
+Messages sent again after a rebalance are allowed and counted, the indicators
+behind them must be the ones already sent.
+
+Needs the broker of docker-compose/redpanda.yaml, every run makes topics and a
+consumer group of its own:
+
+    make -C ../../docker-compose start-redpanda
+    uv run python workers_benchmark.py --workers 1 2 4 --partitions 4
+"""
+
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+import uuid
+from functools import partial
+from typing import Any, Dict, List
+
+from benchmark import make_candles, run, timeframes_path
+from confluent_kafka import Consumer, ConsumerGroupState, Producer
+from confluent_kafka.admin import AdminClient, NewTopic
+from incremental import IncrementalIndicators
+from quixstreams.utils.json import dumps, loads
+from workers import TAWorkers
+
+# the ta service prints every message at debug level
+os.environ.setdefault('LOGURU_LEVEL', 'INFO')
+
+MAX_CANDLES_IN_STATE = 60
+
+
+def pair_candles(pair: str, seed: int, n_windows: int) -> List[dict]:
+    """
+    The 1 and 5 minute candles of a pair, in the order the candles service emits
+    them
+    """
+    candles = make_candles(n_windows, 1, seed=seed, pair=pair) + make_candles(
+        n_windows // 5, 1, seed=seed, pair=pair, candle_seconds=300
+    )
+    return sorted(candles, key=lambda c: (c['window_end_ms'], -c['candle_seconds']))
+
+
+def expected_messages(candles: List[dict]) -> List[dict]:
+    """
+    The messages of the candles of a pair in an uninterrupted run, as they read
+    back from the topic
+    """
+    timeframes = {
+        seconds: partial(IncrementalIndicators, MAX_CANDLES_IN_STATE)
+        for seconds in (60, 300)
+    }
+    return [loads(dumps(m)) for m in run(timeframes_path(timeframes), candles)]
+
+
+class PairCheck:
+    """
+    Follows the messages of a pair as they come out of the ta topic
+    """
+
+    def __init__(self, pair: str, expected: List[dict]):
+        self.pair = pair
+        self.expected = expected
+        self.n_done = 0
+        self.n_replayed = 0
+
+    def add(self, message: dict):
+        if self.n_done < len(self.expected) and message == self.expected[self.n_done]:
+            self.n_done += 1
+        elif message in self.expected[: self.n_done]:
+            # a worker handing over its partitions may send its last messages again
+            self.n_replayed += 1
+        else:
+            raise AssertionError(
+                f'{self.pair}: message {self.n_done} is not the one of an '
+                f'uninterrupted run: {message}'
+            )
+
+
+class OutputReader:
+    """
+    Reads the ta topic and checks the messages of every pair
+    """
+
+    def __init__(self, broker_address: str, topic: str, checks: Dict[str, PairCheck]):
+        self.checks = checks
+        self.consumer = Consumer(
+            {
+                'bootstrap.servers': broker_address,
+                'group.id': f'workers-benchmark-reader-{uuid.uuid4()}',
+                'auto.offset.reset': 'earliest',
+                'enable.auto.commit': False,
+            }
+        )
+        self.consumer.subscribe([topic])
+
+    def n_done(self) -> int:
+        return sum(check.n_done for check in self.checks.values())
+
+    def n_replayed(self) -> int:
+        return sum(check.n_replayed for check in self.checks.values())
+
+    def read_until(self, n_done: int, timeout_sec: float = 300.0):
+        """
+        Reads the topic until `n_done` messages came out in order
+        """
+        deadline = time.monotonic() + timeout_sec
+        while self.n_done() < n_done:
+            if time.monotonic() > deadline:
+                raise TimeoutError(
+                    f'{self.n_done()} of {n_done} messages after {timeout_sec}s'
+                )
+            for msg in self.consumer.consume(10_000, timeout=0.5):
+                if msg.error():
+                    raise RuntimeError(f'Failed to read the ta topic: {msg.error()}')
+                self.checks[msg.key().decode()].add(loads(msg.value()))
+
+    def close(self):
+        self.consumer.close()
+
+
+def run_workers(n_workers: int, state_dir: str, service_kwargs: Dict[str, Any]):
+    """
+    Entry point of the process of a `TAWorkers`, like the service with WORKERS set
+    """
+    TAWorkers(n_workers, state_dir, **service_kwargs).run()
+
+
+def start_workers(
+    n_workers: int, state_dir: str, service_kwargs: Dict[str, Any]
+) -> multiprocessing.Process:
+    process = multiprocessing.get_context('spawn').Process(
+        target=run_workers, args=(n_workers, state_dir, service_kwargs)
+    )
+    process.start()
+    return process
+
+
+def stop_workers(process: multiprocessing.Process):
+    # SIGTERM, the workers commit their checkpoints before they exit
+    process.terminate()
+    process.join()
+    if process.exitcode not in (0, -15):
+        raise RuntimeError(f'The workers exited with code {process.exitcode}')
+
+
+def wait_for_members(
+    admin: AdminClient, group: str, n_members: int, timeout_sec: float = 120.0
+):
+    """
+    Waits until the consumer group has `n_members` members and its partitions are
+    dealt
+    """
+    deadline = time.monotonic() + timeout_sec
+    while time.monotonic() < deadline:
+        description = admin.describe_consumer_groups([group])[group].result()
+        if (
+            len(description.members) == n_members
+            and description.state == ConsumerGroupState.STABLE
+        ):
+            return
+        time.sleep(0.5)
+    raise TimeoutError(f'{group} never had {n_members} members')
+
+
+def produce(producer: Producer, topic: str, candles: List[dict]):
+    for candle in candles:
+        producer.produce(topic, key=candle['pair'].encode(), value=dumps(candle))
+        # the local queue of the producer is bounded
+        producer.poll(0)
+    producer.flush()
+
+
+def benchmark(
+    broker_address: str,
+    n_workers: int,
+    n_partitions: int,
+    n_pairs: int,
+    n_windows: int,
+) -> dict:
+    """
+    Runs the candles of the pairs through the workers in three parts: with the
+    workers alone, with one more worker joining the group, and after it left
+
+    Returns:
+        dict: candles per second of every part, and the messages sent again
+    """
+    run_id = uuid.uuid4().hex[:8]
+    input_topic = f'workers_benchmark_candles_{run_id}'
+    output_topic = f'workers_benchmark_ta_{run_id}'
+    group = f'workers_benchmark_{run_id}'
+
+    admin = AdminClient({'bootstrap.servers': broker_address})
+    # fails fast without a broker
+    admin.list_topics(timeout=10)
+    for future in admin.create_topics(
+        [
+            NewTopic(topic, num_partitions=n_partitions, replication_factor=1)
+            for topic in (input_topic, output_topic)
+        ]
+    ).values():
+        future.result()
+
+    streams = {
+        pair: pair_candles(pair, seed, n_windows)
+        for seed, pair in enumerate(f'PAIR{i}/USD' for i in range(n_pairs))
+    }
+    checks = {
+        pair: PairCheck(pair, expected_messages(candles))
+        for pair, candles in streams.items()
+    }
+    # the candles of all the pairs interleaved, like the candles service sends them
+    candles = [candle for window in zip(*streams.values()) for candle in window]
+    third = len(candles) // 3
+    parts = [candles[:third], candles[third : 2 * third], candles[2 * third :]]
+
+    service_kwargs = dict(
+        kafka_broker_address=broker_address,
+        kafka_input_topic=input_topic,
+        kafka_output_topic=output_topic,
+        kafka_consumer_group=group,
+        max_candles_in_state=MAX_CANDLES_IN_STATE,
+        candle_seconds=60,
+        data_source='historical',
+        extra_timeframes=[{'candle_seconds': 300}],
+    )
+    reader = OutputReader(broker_address, output_topic, checks)
+    producer = Producer({'bootstrap.servers': broker_address})
+    elapsed = []
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        workers = start_workers(n_workers, f'{state_dir}/workers', service_kwargs)
+        joining = None
+        try:
+            wait_for_members(admin, group, n_workers)
+            for i, part in enumerate(parts):
+                produce(producer, input_topic, part)
+                start = time.perf_counter()
+                if i == 1:
+                    # a worker joins while the candles are processed, and takes over
+                    # some partitions with their state
+                    joining = start_workers(1, f'{state_dir}/joining', service_kwargs)
+                elif i == 2:
+                    # and leaves while the candles are processed, handing them back
+                    stop_workers(joining)
+                reader.read_until(sum(len(p) for p in parts[: i + 1]))
+                elapsed.append(time.perf_counter() - start)
+                if i == 1:
+                    # it leaves once it is in the group for sure
+                    wait_for_members(admin, group, n_workers + 1)
+        finally:
+            if joining is not None and joining.is_alive():
+                stop_workers(joining)
+            stop_workers(workers)
+            reader.close()
+
+    admin.delete_topics([input_topic, output_topic])
+    return {
+        'candles_per_sec': [len(p) / e for p, e in zip(parts, elapsed)],
+        'replayed': reader.n_replayed(),
+        'candles': len(candles),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--broker', default='localhost:19092')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--partitions', type=int, default=4)
+    parser.add_argument('--pairs', type=int, default=48)
+    parser.add_argument('--windows', type=int, default=1_000)
+    args = parser.parse_args()
+
+    print(
+        f'{args.pairs} pairs, {args.windows} windows of 1m and 5m candles, '
+        f'{args.partitions} partitions'
+    )
+    print(
+        f'\n{"workers":>8} {"candles/s":>12} {"+1 joining":>12} {"after leaving":>14}'
+        f' {"sent again":>11}'
+    )
+    for n_workers in args.workers:
+        result = benchmark(
+            args.broker, n_workers, args.partitions, args.pairs, args.windows
+        )
+        alone, joining, left = result['candles_per_sec']
+        print(
+            f'{n_workers:>8} {alone:>12,.0f} {joining:>12,.0f} {left:>14,.0f}'
+            f' {result["replayed"]:>11,}'
+        )
+    print(
+        f'{os.cpu_count()} cores, every pair got the messages of an uninterrupted run'
+    )
@@ -3,6 +3,7 @@ from typing import Literal
 from loguru import logger
 from quixstreams import Application
 from sink import HopsworksFeatureStoreSink
+from wire_format import WireDeserializer
 
 
 def main(
@@ -33,9 +34,10 @@ def main(
         auto_offset_reset='latest' if data_source == 'live' else 'earliest',
     )
 
+    # reads both json and binary messages
     input_topic = app.topic(
         name=kafka_input_topic,
-        value_deserializer='json',
+        value_deserializer=WireDeserializer(),
     )
 
     sdf = app.dataframe(input_topic)
@@ -0,0 +1,393 @@
+"""
+Binary wire format of the trades, candles and ta topics.
+
+Every message is a 3 byte header (magic byte, schema id, schema version), the
+string fields as a length byte followed by utf-8, then all the numeric fields in a
+fixed little endian layout. There are no key names on the wire, which makes the
+messages about 3x smaller than JSON.
+
+JSON stays available for debugging: producers pick the format with their
+`wire_format` setting, and `WireDeserializer` reads both, telling them apart by
+the first byte. A message with a string over 255 bytes, which its length byte
+can't hold, goes out as JSON even with the binary format.
+
+None of an optional field travels as NaN, so a NaN decodes as None. The JSON of
+quixstreams writes NaN as null, so both formats give None for it. A NaN of a
+field that is not optional stays NaN in binary only.
+
+This module is copied as is into every service that reads or writes these topics,
+since each service is built on its own. The source is Services/shared/wire_format.py:
+edit it there and run `python Services/shared/sync_copies.py` to update the copies,
+the pre-commit hook fails on a copy that differs. Bump the version of a schema
+whenever its fields change.
+
+    uv run python wire_format.py    # bytes/msg and µs/msg against JSON
+"""
+
+import math
+import struct
+from typing import Any, Dict, Iterable, List, Literal, NamedTuple, Sequence, Union
+
+from quixstreams.models.serializers import (
+    Deserializer,
+    JSONDeserializer,
+    JSONSerializer,
+    SerializationContext,
+    SerializationError,
+    Serializer,
+)
+
+WireFormat = Literal['json', 'binary']
+
+# never '{', the first byte of a JSON message
+MAGIC = 0xB7
+_HEADER = struct.Struct('<BBB')
+
+# None of the optional fields travels as NaN or as the smallest int64
+_NULL_INT = -(2**63)
+_NAN = math.nan
+
+_KINDS = {
+    'str': None,
+    'float': 'd',
+    'int': 'q',
+    'optional_float': 'd',
+    'optional_int': 'q',
+}
+
+
+class StringTooLongError(ValueError):
+    """
+    A string field of the message is longer than its length byte can hold
+    """
+
+
+class Field(NamedTuple):
+    name: str
+    kind: Literal['str', 'float', 'int', 'optional_float', 'optional_int']
+
+
+class Schema:
+    """
+    Fixed layout of the messages of one topic
+    """
+
+    def __init__(self, schema_id: int, version: int, fields: Sequence[Field]):
+        """
+        Args:
+            schema_id (int): id of the schema on the wire, unique across topics
+            version (int): version of the schema on the wire, bump it whenever the
+                fields change
+            fields (Sequence[Field]): the fields of the message, the string fields
+                first
+        """
+        kinds = [field.kind for field in fields]
+        n_strings = kinds.count('str')
+        if kinds[:n_strings] != ['str'] * n_strings:
+            raise ValueError('String fields must come before the numeric ones')
+        if any(kind not in _KINDS for kind in kinds):
+            raise ValueError(f'Unknown field kind in {kinds}')
+
+        self.schema_id = schema_id
+        self.version = version
+        self.fields = list(fields)
+        self.names = [field.name for field in fields]
+
+        self._header = _HEADER.pack(MAGIC, schema_id, version)
+        self._numbers = struct.Struct(
+            '<' + ''.join(_KINDS[kind] for kind in kinds[n_strings:])
+        )
+        self.encode_values, self.decode = self._compile(
+            self.fields[:n_strings], self.fields[n_strings:]
+        )
+
+    @property
+    def header(self) -> bytes:
+        return self._header
+
+    def encode(self, message: Dict[str, Any]) -> bytes:
+        """
+        Encodes a message with exactly the fields of the schema
+
+        Raises:
+            StringTooLongError: if a string field is over 255 bytes in utf-8
+        """
+        if len(message) != len(self.names):
+            raise SerializationError(
+                f'Message fields {sorted(message)} do not match schema {self.names}'
+            )
+        try:
+            return self.encode_values(*[message[name] for name in self.names])
+        except KeyError as e:
+            raise SerializationError(f'Message has no field {e}') from None
+        except IndexError:
+            # only the length byte of a string is looked up by index
+            too_long = [
+                field.name
+                for field in self.fields
+                if field.kind == 'str' and len(message[field.name].encode()) > 255
+            ]
+            raise StringTooLongError(
+                f'Fields {too_long} are over 255 bytes, the most a string can have'
+            ) from None
+        except (struct.error, ValueError, AttributeError) as e:
+            raise SerializationError(str(e)) from None
+
+    def _compile(self, strings: List[Field], numbers: List[Field]):
+        """
+        Generates the encode and decode functions of the schema, so a message costs
+        one struct call and one dict display instead of a loop over its fields
+        """
+        args = [f'v{i}' for i in range(len(strings) + len(numbers))]
+        string_args, number_args = args[: len(strings)], args[len(strings) :]
+
+        # encode_values(v0, v1, ...) -> bytes, the values in the order of the fields
+        packed = []
+        for arg, field in zip(number_args, numbers):
+            if field.kind == 'optional_float':
+                packed.append(f'_NAN if {arg} is None else {arg}')
+            elif field.kind == 'optional_int':
+                packed.append(f'_NULL_INT if {arg} is None else {arg}')
+            else:
+                packed.append(arg)
+        encode_lines = [f'def encode_values({", ".join(args)}):']
+        parts = ['_header']
+        for arg in string_args:
+            encode_lines.append(f'    {arg} = {arg}.encode()')
+            parts += [f'_length_byte[len({arg})]', arg]
+        parts.append(f'_pack({", ".join(packed)})')
+        encode_lines.append(f'    return b"".join(({", ".join(parts)},))')
+
+        # decode(data) -> dict, with the header already checked by the caller
+        decode_lines = ['def decode(data):', f'    offset = {_HEADER.size}']
+        for arg in string_args:
+            decode_lines += [
+                '    end = offset + 1 + data[offset]',
+                f'    {arg} = data[offset + 1 : end]',
+                # the same few pairs over and over, decoded once each
+                f'    {arg} = _strings.get({arg}) or _intern({arg})',
+                '    offset = end',
+            ]
+        decode_lines.append(
+            f'    ({"".join(a + ", " for a in number_args)}) = _unpack_from(data, offset)'
+        )
+        entries = []
+        for arg, field in zip(args, strings + numbers):
+            if field.kind == 'optional_float':
+                value = f'None if {arg} != {arg} else {arg}'
+            elif field.kind == 'optional_int':
+                value = f'None if {arg} == _NULL_INT else {arg}'
+            else:
+                value = arg
+            entries.append(f'{field.name!r}: {value}')
+        decode_lines.append(f'    return {{{", ".join(entries)}}}')
+
+        strings_seen: Dict[bytes, str] = {}
+
+        def intern(raw: bytes) -> str:
+            if len(strings_seen) > 10_000:
+                strings_seen.clear()
+            strings_seen[raw] = raw.decode()
+            return strings_seen[raw]
+
+        namespace = {
+            '_strings': strings_seen,
+            '_intern': intern,
+            '_header': self._header,
+            '_length_byte': [bytes((i,)) for i in range(256)],
+            '_pack': self._numbers.pack,
+            '_unpack_from': self._numbers.unpack_from,
+            '_NAN': _NAN,
+            '_NULL_INT': _NULL_INT,
+        }
+        exec('\n'.join(encode_lines + decode_lines), namespace)
+        return namespace['encode_values'], namespace['decode']
+
+
+CANDLE_FIELDS = [
+    Field('pair', 'str'),
+    Field('timestamp_ms', 'int'),
+    Field('open', 'float'),
+    Field('high', 'float'),
+    Field('low', 'float'),
+    Field('close', 'float'),
+    Field('volume', 'float'),
+    Field('window_start_ms', 'int'),
+    Field('window_end_ms', 'int'),
+    Field('candle_seconds', 'int'),
+]
+
+# output of compute_indicators in the ta service
+INDICATOR_NAMES = [
+    'rsi_9',
+    'rsi_14',
+    'rsi_21',
+    'macd',
+    'macd_signal',
+    'macd_hist',
+    'bbands_upper',
+    'bbands_middle',
+    'bbands_lower',
+    'stochrsi_fastk',
+    'stochrsi_fastd',
+    'adx',
+    'volume_ema',
+    'ichimoku_conv',
+    'ichimoku_base',
+    'ichimoku_span_a',
+    'ichimoku_span_b',
+    'mfi',
+    'atr',
+    'price_roc',
+    'sma_7',
+    'sma_14',
+    'sma_21',
+]
+
+TRADE_SCHEMA = Schema(
+    schema_id=1,
+    version=1,
+    fields=[
+        Field('pair', 'str'),
+        Field('price', 'float'),
+        Field('volume', 'float'),
+        Field('timestamp_ms', 'int'),
+        Field('trade_id', 'optional_int'),
+    ],
+)
+CANDLE_SCHEMA = Schema(schema_id=2, version=1, fields=CANDLE_FIELDS)
+TA_SCHEMA = Schema(
+    schema_id=3,
+    version=1,
+    fields=CANDLE_FIELDS + [Field(name, 'optional_float') for name in INDICATOR_NAMES],
+)
+
+SCHEMAS = {
+    schema.schema_id: schema for schema in (TRADE_SCHEMA, CANDLE_SCHEMA, TA_SCHEMA)
+}
+
+
+class WireSerializer(Serializer):
+    """
+    Serializes the messages of a topic with its binary schema, or as JSON the
+    messages with a string too long for it
+    """
+
+    def __init__(self, schema: Schema):
+        self.schema = schema
+        self._json = JSONSerializer()
+
+    def __call__(self, value: Dict[str, Any], ctx: SerializationContext) -> bytes:
+        try:
+            return self.schema.encode(value)
+        except StringTooLongError:
+            return self._json(value, ctx)
+
+
+class WireDeserializer(Deserializer):
+    """
+    Deserializes both the binary messages of any known schema and JSON messages
+    """
+
+    def __init__(self, schemas: Iterable[Schema] = SCHEMAS.values()):
+        super().__init__()
+        # decoders by the header of their messages
+        self._decoders = {schema.header: schema.decode for schema in schemas}
+        self._json = JSONDeserializer()
+
+    def __call__(self, value: bytes, ctx: SerializationContext) -> Dict[str, Any]:
+        if not value or value[0] != MAGIC:
+            return self._json(value, ctx)
+
+        decode = self._decoders.get(value[:3])
+        if decode is None:
+            raise SerializationError(
+                f'Unknown wire schema in message header {value[:3]!r}'
+            )
+        return decode(value)
+
+
+def get_serializer(wire_format: WireFormat, schema: Schema) -> Union[str, Serializer]:
+    """
+    Returns the value serializer of a topic for the given wire format
+    """
+    if wire_format == 'binary':
+        return WireSerializer(schema)
+    return 'json'
+
+
+def benchmark(n_messages: int = 100_000):
+    """
+    Compares the size and the encode and decode times of JSON and binary messages
+    """
+    import time
+
+    candle = {
+        'pair': 'BTC/USD',
+        'timestamp_ms': 1731155565415,
+        'open': 76395.1,
+        'high': 76412.7,
+        'low': 76380.0,
+        'close': 76401.3,
+        'volume': 3.18273645,
+        'window_start_ms': 1731155520000,
+        'window_end_ms': 1731155580000,
+        'candle_seconds': 60,
+    }
+    payloads = {
+        'trade': (
+            TRADE_SCHEMA,
+            {
+                'pair': 'BTC/USD',
+                'price': 76395.0,
+                'volume': 0.01305597,
+                'timestamp_ms': 1731155565415,
+                'trade_id': 75468573,
+            },
+        ),
+        'candle': (CANDLE_SCHEMA, candle),
+        'ta': (
+            TA_SCHEMA,
+            {
+                **candle,
+                **{name: 50.0 + i / 7 for i, name in enumerate(INDICATOR_NAMES)},
+                'macd_hist': None,
+            },
+        ),
+    }
+
+    ctx = SerializationContext(topic='benchmark', field='value')
+    json_serializer = JSONSerializer()
+    json_deserializer = JSONDeserializer()
+    deserializer = WireDeserializer()
+
+    def per_message_us(fn: Any, arg: Any) -> float:
+        start = time.perf_counter()
+        for _ in range(n_messages):
+            fn(arg, ctx)
+        return (time.perf_counter() - start) / n_messages * 1e6
+
+    print(f'{"":>8} {"bytes/msg":>20} {"encode µs/msg":>20} {"decode µs/msg":>20}')
+    print(f'{"":>8}' + f' {"json":>10}{"binary":>10}' * 3)
+    for name, (schema, message) in payloads.items():
+        serializer = WireSerializer(schema)
+        as_json = json_serializer(message, ctx)
+        as_binary = serializer(message, ctx)
+        assert deserializer(as_binary, ctx) == message
+
+        rows: List[float] = [
+            len(as_json),
+            len(as_binary),
+            per_message_us(json_serializer, message),
+            per_message_us(serializer, message),
+            per_message_us(json_deserializer, as_json),
+            per_message_us(deserializer, as_binary),
+        ]
+        print(
+            f'{name:>8} {rows[0]:>10.0f}{rows[1]:>10.0f} {rows[2]:>10.2f}'
+            f'{rows[3]:>10.2f} {rows[4]:>10.2f}{rows[5]:>10.2f}'
+        )
+
+
+if __name__ == '__main__':
+    benchmark()
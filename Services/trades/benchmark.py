@@ -0,0 +1,85 @@
+"""
+Microbenchmarks of the trades service hot path, single threaded so the numbers
+read as trades per second per core.
+
+    uv run python benchmark.py
+"""
+
+import time
+from datetime import datetime, timezone
+from typing import Callable, List
+
+from kraken_api.trade import Trade, TradeModel
+from quixstreams.models.serializers import JSONSerializer, SerializationContext
+
+N_TRADES = 200_000
+
+
+def make_rest_rows(n: int) -> List[list]:
+    """
+    Synthetic rows shaped like the Kraken REST Trades response
+    """
+    return [
+        [
+            f'{76000 + i % 500:.5f}',
+            f'{0.001 * (i % 97 + 1):.8f}',
+            1731155565.4159 + i * 0.05,
+        ]
+        + ['s', 'm', '', 75468573 + i]
+        for i in range(n)
+    ]
+
+
+def ingest_pydantic(rows: List[list]) -> int:
+    """
+    The previous path: a pydantic model per trade, dumped to a dict and serialized
+    by the topic's JSON serializer
+    """
+    serializer = JSONSerializer()
+    ctx = SerializationContext(topic='trades', field='value')
+    n_bytes = 0
+    for row in rows:
+        timestamp_ms = int(float(row[2]) * 1000)
+        trade = TradeModel(
+            pair='BTC/USD',
+            price=float(row[0]),
+            volume=float(row[1]),
+            timestamp=datetime.fromtimestamp(timestamp_ms / 1000.0, tz=timezone.utc),
+            timestamp_ms=timestamp_ms,
+            trade_id=row[6],
+        )
+        n_bytes += len(serializer(trade.model_dump(), ctx))
+    return n_bytes
+
+
+def ingest_fast(rows: List[list]) -> int:
+    """
+    The current path: a slotted Trade encoded straight to bytes
+    """
+    n_bytes = 0
+    for row in rows:
+        trade = Trade.from_kraken_rest_api_response(
+            pair='BTC/USD',
+            price=float(row[0]),
+            volume=float(row[1]),
+            timestamp_sec=row[2],
+            trade_id=row[6],
+        )
+        n_bytes += len(trade.to_json_bytes())
+    return n_bytes
+
+
+def measure(name: str, ingest: Callable[[List[list]], int], rows: List[list]):
+    start = time.perf_counter()
+    n_bytes = ingest(rows)
+    elapsed = time.perf_counter() - start
+    print(
+        f'{name:>10}: {len(rows) / elapsed:>12,.0f} trades/s per core, '
+        f'{n_bytes / len(rows):.1f} bytes/trade'
+    )
+
+
+if __name__ == '__main__':
+    rows = make_rest_rows(N_TRADES)
+    measure('pydantic', ingest_pydantic, rows)
+    measure('fast path', ingest_fast, rows)
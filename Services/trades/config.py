@@ -10,8 +10,43 @@ class Config(BaseSettings):
     kafka_broker_address: str
     kafka_topic: str
     pairs: List[str]
-    data_source: Literal['live', 'historical']
+    data_source: Literal['live', 'historical', 'replay']
     last_n_days: Optional[int]
+    # a live connection silent for this long is considered stalled and reopened
+    websocket_heartbeat_timeout_sec: Optional[float] = 5.0
+    websocket_max_backoff_sec: Optional[float] = 30.0
+    # how long a reconnected socket holds back the live trades for the ones it
+    # missed, before it gives up on the REST API and resumes with a gap
+    websocket_gap_backfill_timeout_sec: Optional[float] = 60.0
+    # spread the live pairs over several sockets and worker processes, 0 processes
+    # keeps a single socket in the main process
+    websocket_sockets: Optional[int] = 1
+    websocket_processes: Optional[int] = 0
+    websocket_queue_size: Optional[int] = 1000
+    # batches every socket holds while the queue is full, before dropping trades
+    websocket_max_backlog: Optional[int] = 1000
+    # how the historical trades are downloaded from the REST API
+    rest_backfill_mode: Literal['sequential', 'async'] = 'sequential'
+    rest_requests_per_second: Optional[float] = 1.0
+    rest_burst: Optional[int] = 1
+    rest_slices_per_pair: Optional[int] = 1
+    # local archive of downloaded trades, so re-backfills only fetch what is missing
+    trades_cache_dir: Optional[str] = None
+    trades_cache_max_bytes: Optional[int] = 2_000_000_000
+    # replay the cached trades at this speed relative to real time, 0 for as fast
+    # as possible
+    replay_speed: Optional[float] = 0.0
+    # validate every trade with pydantic before pushing it, for debugging
+    validate_trades: Optional[bool] = False
+    # producer batching, a longer linger and compression trade latency for
+    # throughput, which is what historical runs want
+    producer_linger_ms: Optional[int] = 5
+    producer_batch_size: Optional[int] = 1_000_000
+    producer_batch_num_messages: Optional[int] = 10_000
+    producer_compression_type: Literal['none', 'gzip', 'snappy', 'lz4', 'zstd'] = 'none'
+    producer_stats_interval_sec: Optional[float] = 10.0
+    # encoding of the messages, binary is smaller and json easier to debug
+    wire_format: Literal['json', 'binary'] = 'json'
 
 
 config = Config()
@@ -0,0 +1,80 @@
+import time
+
+from loguru import logger
+
+
+class DeliveryReport:
+    """
+    Counts the messages handed to the producer and the ones the broker acknowledged,
+    so throughput can be logged every few seconds instead of once per message.
+    """
+
+    def __init__(self, interval_sec: float = 10.0):
+        """
+        Args:
+            interval_sec (float): how often `maybe_log()` logs the rates
+        """
+        self.interval_sec = interval_sec
+
+        self.produced = 0
+        self.produced_bytes = 0
+        self.delivered = 0
+        self.delivered_bytes = 0
+        self.failed = 0
+
+        self._started_at = time.monotonic()
+        self._logged_at = self._started_at
+        self._logged_counts = (0, 0, 0)
+
+    def on_produce(self, n_messages: int, n_bytes: int):
+        self.produced += n_messages
+        self.produced_bytes += n_bytes
+
+    def on_delivery(self, err, msg):
+        """
+        Delivery callback of the producer, called from `poll()` and `flush()` once
+        the broker acknowledged the message or gave up on it
+        """
+        if err is not None:
+            # only the first failures are logged, the rest show up in the counts
+            if self.failed < 10:
+                logger.error(f'Failed to deliver message to {msg.topic()}: {err}')
+            self.failed += 1
+            return
+
+        self.delivered += 1
+        self.delivered_bytes += msg.len()
+
+    def maybe_log(self):
+        if time.monotonic() - self._logged_at >= self.interval_sec:
+            self.log()
+
+    def log(self):
+        """
+        Logs the rates since the last call and the totals so far
+        """
+        now = time.monotonic()
+        elapsed_sec = max(now - self._logged_at, 1e-9)
+        produced, delivered, delivered_bytes = self._logged_counts
+
+        logger.info(
+            f'Produced {(self.produced - produced) / elapsed_sec:,.0f} msgs/s, '
+            f'delivered {(self.delivered - delivered) / elapsed_sec:,.0f} msgs/s, '
+            f'{(self.delivered_bytes - delivered_bytes) / elapsed_sec:,.0f} bytes/s '
+            f'({self.delivered} delivered, {self.failed} failed, '
+            f'{self.produced - self.delivered - self.failed} in flight)'
+        )
+
+        self._logged_at = now
+        self._logged_counts = (self.produced, self.delivered, self.delivered_bytes)
+
+    def log_summary(self):
+        """
+        Logs the average rates since the start
+        """
+        elapsed_sec = max(time.monotonic() - self._started_at, 1e-9)
+        logger.info(
+            f'Delivered {self.delivered} messages, {self.delivered_bytes} bytes in '
+            f'{elapsed_sec:.1f}s: {self.delivered / elapsed_sec:,.0f} msgs/s, '
+            f'{self.delivered_bytes / elapsed_sec:,.0f} bytes/s, {self.failed} failed'
+        )
@@ -0,0 +1,30 @@
+import heapq
+from operator import attrgetter
+from typing import Iterable, Iterator
+
+from .base import TradesAPI
+from .trade import Trade
+
+
+def iter_trades(api: TradesAPI) -> Iterator[Trade]:
+    """
+    Yields the trades of `api` page by page. The next page is only requested once
+    the previous one has been consumed.
+    """
+    while not api.is_done():
+        yield from api.get_trades()
+
+
+def merge_trades(cursors: Iterable[Iterator[Trade]]) -> Iterator[Trade]:
+    """
+    Merges per-pair trade cursors, each already sorted by timestamp, into a single
+    stream in global timestamp order.
+
+    The merge holds the next trade of every cursor on a heap, so that trade acts as
+    the cursor's watermark: nothing is emitted until every cursor has moved past
+    it. Only the cursor with the lowest watermark is advanced, so memory stays
+    bounded to about one page per cursor no matter how far ahead the other pairs
+    could run. Trades with the same timestamp come out in the order of `cursors`,
+    so the output is deterministic.
+    """
+    return heapq.merge(*cursors, key=attrgetter('timestamp_ms'))
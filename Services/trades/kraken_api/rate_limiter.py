@@ -0,0 +1,103 @@
+import multiprocessing
+import threading
+import time
+from typing import Optional
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter that can be shared between threads.
+
+    Kraken's public endpoints are limited per IP address, so every cursor that
+    talks to the REST API during a backfill has to take its tokens from the same
+    bucket.
+    """
+
+    def __init__(self, rate: float, capacity: int = 1):
+        """
+        Args:
+            rate (float): number of tokens added to the bucket per second
+            capacity (int): maximum number of tokens in the bucket, i.e. the burst size
+        """
+        if rate <= 0:
+            raise ValueError(f'rate must be positive, got {rate}')
+        if capacity < 1:
+            raise ValueError(f'capacity must be at least 1, got {capacity}')
+
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self) -> float:
+        """
+        Takes one token from the bucket and returns how many seconds the caller has
+        to wait before using it. The balance can go negative, so callers are served
+        in the order they reserved.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated_at) * self.rate
+            )
+            self._updated_at = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self) -> None:
+        """
+        Blocks the calling thread until a token is available
+        """
+        wait_sec = self._reserve()
+        if wait_sec > 0:
+            time.sleep(wait_sec)
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    TokenBucket that can also be shared between processes: the balance lives in
+    shared memory, so the worker processes handed the bucket when they start all
+    take their tokens from it.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        capacity: int = 1,
+        ctx: Optional[multiprocessing.context.BaseContext] = None,
+    ):
+        """
+        Args:
+            rate (float): number of tokens added to the bucket per second
+            capacity (int): maximum number of tokens in the bucket, i.e. the burst size
+            ctx (Optional[BaseContext]): multiprocessing context of the processes
+                sharing the bucket
+        """
+        super().__init__(rate, capacity)
+        ctx = ctx or multiprocessing.get_context()
+        # the tokens and when they were counted, on the monotonic clock every
+        # process of the host shares
+        self._state = ctx.Array('d', [float(capacity), time.monotonic()])
+
+    def _reserve(self) -> float:
+        with self._state.get_lock():
+            tokens, updated_at = self._state[:]
+            now = time.monotonic()
+            tokens = min(self.capacity, tokens + (now - updated_at) * self.rate) - 1
+            self._state[:] = [tokens, now]
+        if tokens >= 0:
+            return 0.0
+        return -tokens / self.rate
+
+    def __getstate__(self):
+        # the thread lock stays behind, the shared state has a lock of its own
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
@@ -0,0 +1,168 @@
+import time
+from bisect import bisect_right
+from itertools import islice
+from typing import Iterator, List, Optional
+
+from loguru import logger
+
+from .base import TradesAPI
+from .merge import merge_trades
+from .trade import Trade
+from .trade_cache import TradeCache
+
+
+class ReplayTradesAPI(TradesAPI):
+    """
+    Replays the trades archived in the trade cache, without touching the network.
+
+    The pairs are merged in timestamp order, with trades of the same millisecond
+    ordered by pair name and then as they were archived, so every replay of the
+    same archive publishes exactly the same sequence.
+
+    `speed` sets the pacing: 1.0 replays at the original timing, N replays N times
+    faster, and 0 publishes as fast as the consumer takes the trades.
+    """
+
+    def __init__(
+        self,
+        cache: TradeCache,
+        pairs: List[str],
+        speed: float = 0.0,
+        since_timestamp_ns: Optional[int] = None,
+        until_timestamp_ns: Optional[int] = None,
+        batch_size: int = 1000,
+    ):
+        """
+        Args:
+            cache (TradeCache): the archive to replay
+            pairs (List[str]): the pairs to replay
+            speed (float): replay speed relative to the original timing, 0 for as
+                fast as possible
+            since_timestamp_ns (Optional[int]): skip the trades up to this time
+            until_timestamp_ns (Optional[int]): stop after this time
+            batch_size (int): maximum number of trades returned per call
+        """
+        if speed < 0:
+            raise ValueError(f'speed must be 0 or positive, got {speed}')
+
+        self.cache = cache
+        self.pairs = sorted(pairs)
+        self.speed = speed
+        self.since_ms = (since_timestamp_ns or 0) // 1_000_000
+        self.until_ms = (
+            None if until_timestamp_ns is None else until_timestamp_ns // 1_000_000
+        )
+        self.batch_size = batch_size
+
+        # sorted pairs, so trades of the same millisecond come out by pair name
+        self._trades = merge_trades(self._iter_pair(pair) for pair in self.pairs)
+        self._next: Optional[Trade] = next(self._trades, None)
+        self._is_done = self._next is None
+
+        # wall clock time the first trade is published at, and its timestamp
+        self._started_at: Optional[float] = None
+        self._first_timestamp_ms = 0
+        self.trades_replayed = 0
+
+        if self._is_done:
+            logger.warning(f'No archived trades to replay for {self.pairs}')
+
+    def get_trades(self) -> List[Trade]:
+        """
+        Returns the next trades that are due, waiting until the first one is
+        """
+        if self._is_done:
+            return []
+
+        if self.speed == 0:
+            trades = [self._next]
+            trades.extend(islice(self._trades, self.batch_size - 1))
+            self._next = None
+            if len(trades) == self.batch_size:
+                self._next = next(self._trades, None)
+            self._record(trades)
+            return trades
+
+        if self._started_at is None:
+            self._started_at = time.monotonic()
+            self._first_timestamp_ms = self._next.timestamp_ms
+
+        wait_sec = self._due_at(self._next) - time.monotonic()
+        if wait_sec > 0:
+            time.sleep(wait_sec)
+
+        # everything due by now, so a slow consumer catches up in big batches
+        now = time.monotonic()
+        trades = []
+        while (
+            self._next is not None
+            and len(trades) < self.batch_size
+            and self._due_at(self._next) <= now
+        ):
+            trades.append(self._next)
+            self._next = next(self._trades, None)
+
+        self._record(trades)
+        return trades
+
+    def is_done(self) -> bool:
+        return self._is_done
+
+    def lag_sec(self) -> float:
+        """
+        Returns how far the replay is behind the schedule set by `speed`
+        """
+        if self._started_at is None or self._next is None:
+            return 0.0
+        return max(0.0, time.monotonic() - self._due_at(self._next))
+
+    def _due_at(self, trade: Trade) -> float:
+        elapsed_sec = (trade.timestamp_ms - self._first_timestamp_ms) / 1000
+        return self._started_at + elapsed_sec / self.speed
+
+    def _record(self, trades: List[Trade]):
+        self.trades_replayed += len(trades)
+        if self._next is None:
+            self._is_done = True
+            logger.info(f'Replayed {self.trades_replayed} trades')
+
+    def _iter_pair(self, pair: str) -> Iterator[Trade]:
+        """
+        Yields the archived trades of a pair in the replay range, segment by segment.
+
+        Segments can overlap, when two backfills of the same pair downloaded the
+        same missing range at the same time. A trade belongs to a segment by its
+        millisecond, so every segment only adds the trades after the last
+        millisecond the previous ones covered, and each trade comes out once and
+        in order.
+        """
+        covered_ms = self.since_ms
+        for segment in self.cache.segments(pair):
+            if segment.until_ns // 1_000_000 <= covered_ms:
+                continue
+            if self.until_ms is not None and segment.since_ns // 1_000_000 >= (
+                self.until_ms
+            ):
+                break
+
+            columns = self.cache.read(segment)
+            if columns is None:
+                logger.warning(f'Cache segment {segment.file_name} is gone, skipping')
+                continue
+
+            timestamps = columns.timestamp_ms
+            start = bisect_right(timestamps, covered_ms)
+            stop = (
+                len(timestamps)
+                if self.until_ms is None
+                else bisect_right(timestamps, self.until_ms)
+            )
+            for i in range(start, stop):
+                yield Trade.from_timestamp_ms(
+                    pair=pair,
+                    price=columns.price[i],
+                    volume=columns.volume[i],
+                    timestamp_ms=timestamps[i],
+                    trade_id=None if columns.trade_id[i] < 0 else columns.trade_id[i],
+                )
+            covered_ms = segment.until_ns // 1_000_000
@@ -1,36 +1,50 @@
 import json
 import time
-from typing import List
+from bisect import bisect_right
+from collections import deque
+from itertools import islice
+from typing import Deque, List, Optional, Tuple
 
 import requests
 from loguru import logger
 
 from .base import TradesAPI
+from .merge import iter_trades, merge_trades
+from .rate_limiter import TokenBucket
 from .trade import Trade
+from .trade_cache import CachedSegment, TradeCache, TradeColumns
 
 
 class KrakenRestAPI(TradesAPI):
-    def __init__(self, pairs: List[str], last_n_days: int):
+    def __init__(
+        self,
+        pairs: List[str],
+        last_n_days: int,
+        batch_size: int = 1000,
+        cache: Optional[TradeCache] = None,
+    ):
         self.pairs = pairs
+        self.batch_size = batch_size
 
         self.apis = [
-            KrakenRestAPISinglePair(pair=pair, last_n_days=last_n_days)
+            make_single_pair_api(pair=pair, last_n_days=last_n_days, cache=cache)
             for pair in self.pairs
         ]
 
+        # trades of all the pairs in timestamp order. A pair's next page is only
+        # requested when the merge needs it.
+        self._trades = merge_trades(iter_trades(api) for api in self.apis)
+        self._is_done = False
+
     def get_trades(self) -> List[Trade]:
         """
-        get trades for each pari, sort them by timestamp and return trades.
+        returns the next `batch_size` trades across all pairs in timestamp order.
         """
-        trades = []
-        for api in self.apis:
-            if not api.is_done():
-                trades += api.get_trades()
-
-        # sort trades by timestamp
-        trades.sort(key=lambda x: x.timestamp_ms)
+        trades = list(islice(self._trades, self.batch_size))
 
-        # breakpoint()
+        # the merge only comes up short once every pair is exhausted
+        if len(trades) < self.batch_size:
+            self._is_done = True
 
         return trades
 
@@ -38,10 +52,20 @@ class KrakenRestAPI(TradesAPI):
         """
         we are done when all apis are done
         """
-        for api in self.apis:
-            if not api.is_done():
-                return False
-        return True
+        return self._is_done
+
+
+def make_single_pair_api(
+    pair: str, last_n_days: int, cache: Optional[TradeCache] = None, **kwargs
+) -> TradesAPI:
+    """
+    Returns the cursor for one pair, going through the trade cache if there is one
+    """
+    if cache is None:
+        return KrakenRestAPISinglePair(pair=pair, last_n_days=last_n_days, **kwargs)
+    return CachedKrakenRestAPISinglePair(
+        cache=cache, pair=pair, last_n_days=last_n_days, **kwargs
+    )
 
 
 class KrakenRestAPISinglePair(TradesAPI):
@@ -51,18 +75,54 @@ class KrakenRestAPISinglePair(TradesAPI):
         self,
         pair: str,
         last_n_days: int,
+        session: Optional[requests.Session] = None,
+        url: str = URL,
+        since_timestamp_ns: Optional[int] = None,
+        until_timestamp_ns: Optional[int] = None,
+        rate_limiter: Optional[TokenBucket] = None,
+        timeout_sec: float = 30.0,
     ):
+        """
+        Args:
+            pair (str): the pair to get trades for, e.g. 'BTC/USD'
+            last_n_days (int): number of days of history to download
+            session (Optional[requests.Session]): session to send the requests with, so
+                several pairs can share one pool of connections
+            url (str): the Trades endpoint, overridable to point at a local fake
+            since_timestamp_ns (Optional[int]): where to start paginating, instead of
+                `last_n_days` ago
+            until_timestamp_ns (Optional[int]): where to stop paginating, instead of
+                the present. Trades after it are dropped.
+            rate_limiter (Optional[TokenBucket]): limiter to take a token from before
+                each request
+            timeout_sec (float): how long to wait for a response, a request that
+                hangs raises instead of stalling the pair forever
+        """
         self.pair = pair
         self.last_n_days = last_n_days
+        self.url = url
+        self.session = session or requests.Session()
+        self.until_timestamp_ns = until_timestamp_ns
+        self.rate_limiter = rate_limiter
+        self.timeout_sec = timeout_sec
+        self.pages_fetched = 0
         self._is_done = False
         # get current timestamp in nanoseconds
-        self.since_timestamp_ns = int(
-            (time.time() - self.last_n_days * 24 * 60 * 60) * 1_000_000_000
-        )
+        if since_timestamp_ns is None:
+            since_timestamp_ns = int(
+                (time.time() - self.last_n_days * 24 * 60 * 60) * 1_000_000_000
+            )
+        self.since_timestamp_ns = since_timestamp_ns
 
-        logger.info(
-            f'Getting trades for pair {self.pair} for the last {self.last_n_days} days'
-        )
+        if self.until_timestamp_ns is None:
+            logger.info(
+                f'Getting trades for pair {self.pair} for the last {self.last_n_days} days'
+            )
+        else:
+            logger.info(
+                f'Getting trades for pair {self.pair} from {self.since_timestamp_ns} '
+                f'to {self.until_timestamp_ns}'
+            )
 
     def get_trades(self) -> List[Trade]:
         """
@@ -73,7 +133,13 @@ class KrakenRestAPISinglePair(TradesAPI):
         headers = {'Accept': 'application/json'}
         params = {'pair': self.pair, 'since': self.since_timestamp_ns}
 
-        response = requests.request('GET', self.URL, params=params, headers=headers)
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
+        response = self.session.get(
+            self.url, params=params, headers=headers, timeout=self.timeout_sec
+        )
+        self.pages_fetched += 1
         if response.status_code == 200:
             data = json.loads(response.text)
 
@@ -81,6 +147,11 @@ class KrakenRestAPISinglePair(TradesAPI):
             logger.error(f'Request failed with status code {response.status_code}')
             return []
 
+        # kraken reports errors such as rate limiting with a 200 status code
+        if data.get('error'):
+            logger.error(f'Failed to get trades for pair {self.pair}: {data["error"]}')
+            return []
+
         # get the trades for the self.pair cryptocurrency
         try:
             trades = data['result'][self.pair]
@@ -95,12 +166,23 @@ class KrakenRestAPISinglePair(TradesAPI):
                 price=float(trade[0]),
                 volume=float(trade[1]),
                 timestamp_sec=trade[2],
+                trade_id=trade[6],
             )
             for trade in trades
         ]
 
+        # drop the trades past the end of the range we were asked for, by their
+        # millisecond like the trade cache does
+        if self.until_timestamp_ns is not None:
+            trades = [
+                trade
+                for trade in trades
+                if trade.timestamp_ms * 1_000_000 <= self.until_timestamp_ns
+            ]
+
         # update the since_timestamp_ns variable
-        self.since_timestamp_ns = float(data['result']['last'])
+        # 'last' is a nanosecond timestamp, too large to go through a float exactly
+        self.since_timestamp_ns = int(data['result']['last'])
 
         # check if we are done
         # TODO: check if this stopping conditions really work
@@ -108,9 +190,195 @@ class KrakenRestAPISinglePair(TradesAPI):
             self._is_done = True
         if self.since_timestamp_ns == 0:
             self._is_done = True
+        if self.until_timestamp_ns is not None and self.is_past_until():
+            self._is_done = True
 
         # breakpoint()
         return trades
 
     def is_done(self) -> bool:
         return self._is_done
+
+    def is_past_until(self) -> bool:
+        """
+        Whether the cursor is past the millisecond of `until_timestamp_ns`, whose
+        trades all belong to the range
+        """
+        return (
+            self.since_timestamp_ns // 1_000_000 > self.until_timestamp_ns // 1_000_000
+        )
+
+
+class CachedKrakenRestAPISinglePair(TradesAPI):
+    """
+    Drop-in replacement for KrakenRestAPISinglePair that serves the parts of its range
+    already in the cache and only downloads the missing ones, archiving them as it
+    goes.
+
+    The cache only keeps the millisecond of a trade, so a trade belongs to a range
+    (since_ns, until_ns] by its millisecond, `since_ns < timestamp_ms * 1e6 <=
+    until_ns`, whether it is served from the cache or downloaded.
+    """
+
+    def __init__(
+        self,
+        cache: TradeCache,
+        pair: str,
+        last_n_days: int,
+        since_timestamp_ns: Optional[int] = None,
+        until_timestamp_ns: Optional[int] = None,
+        page_size: int = 1000,
+        segment_max_trades: int = 100_000,
+        **api_kwargs,
+    ):
+        """
+        Args:
+            cache (TradeCache): the cache to read from and write to
+            pair (str): the pair to get trades for, e.g. 'BTC/USD'
+            last_n_days (int): number of days of history to get
+            since_timestamp_ns (Optional[int]): start of the range, instead of
+                `last_n_days` ago
+            until_timestamp_ns (Optional[int]): end of the range, instead of the present
+            page_size (int): number of cached trades returned per call to get_trades
+            segment_max_trades (int): downloaded trades kept in memory before they are
+                written to the cache as a segment
+            api_kwargs: passed on to the KrakenRestAPISinglePair used for the missing
+                ranges
+        """
+        self.cache = cache
+        self.pair = pair
+        self.last_n_days = last_n_days
+        self.page_size = page_size
+        self.segment_max_trades = segment_max_trades
+        self.api_kwargs = api_kwargs
+
+        if since_timestamp_ns is None:
+            since_timestamp_ns = time.time_ns() - last_n_days * 24 * 60 * 60 * 10**9
+
+        self._pieces: Deque[Tuple[int, Optional[int], Optional[CachedSegment]]] = deque(
+            cache.plan(pair, since_timestamp_ns, until_timestamp_ns)
+        )
+        missing = [piece for piece in self._pieces if piece[2] is None]
+        logger.info(
+            f'{pair}: {len(self._pieces) - len(missing)} ranges cached, '
+            f'{len(missing)} ranges to download'
+        )
+
+        # state of the piece being served
+        self._columns: Optional[TradeColumns] = None
+        self._position = 0
+        self._api: Optional[KrakenRestAPISinglePair] = None
+        self._pending: List[Trade] = []
+        self._pending_since_ns = 0
+        self._pages_fetched = 0
+
+    @property
+    def pages_fetched(self) -> int:
+        """
+        Number of pages downloaded from the REST API so far
+        """
+        return self._pages_fetched + (self._api.pages_fetched if self._api else 0)
+
+    def get_trades(self) -> List[Trade]:
+        if not self._pieces:
+            return []
+
+        start_ns, end_ns, segment = self._pieces[0]
+        if segment is not None:
+            return self._get_cached_trades(start_ns, end_ns, segment)
+        return self._get_missing_trades(start_ns, end_ns)
+
+    def is_done(self) -> bool:
+        return not self._pieces
+
+    def _get_cached_trades(
+        self, start_ns: int, end_ns: int, segment: CachedSegment
+    ) -> List[Trade]:
+        if self._columns is None:
+            self._columns = self.cache.read(segment)
+            if self._columns is None:
+                # evicted since we planned, so download the range instead
+                self._pieces[0] = (start_ns, end_ns, None)
+                return []
+
+            # skip the trades of the segment before the start of our range
+            self._position = bisect_right(
+                self._columns.timestamp_ms, start_ns // 1_000_000
+            )
+
+        columns = self._columns
+        end_ms = end_ns // 1_000_000
+        trades = []
+        stop = min(self._position + self.page_size, len(columns.timestamp_ms))
+        for i in range(self._position, stop):
+            if columns.timestamp_ms[i] > end_ms:
+                stop = len(columns.timestamp_ms)
+                break
+            trades.append(
+                Trade.from_timestamp_ms(
+                    pair=self.pair,
+                    price=columns.price[i],
+                    volume=columns.volume[i],
+                    timestamp_ms=columns.timestamp_ms[i],
+                    trade_id=None if columns.trade_id[i] < 0 else columns.trade_id[i],
+                )
+            )
+        self._position = stop
+
+        if self._position >= len(columns.timestamp_ms):
+            self._columns = None
+            self._pieces.popleft()
+
+        return trades
+
+    def _get_missing_trades(self, start_ns: int, end_ns: Optional[int]) -> List[Trade]:
+        if self._api is None:
+            self._api = KrakenRestAPISinglePair(
+                pair=self.pair,
+                last_n_days=self.last_n_days,
+                since_timestamp_ns=start_ns,
+                until_timestamp_ns=end_ns,
+                **self.api_kwargs,
+            )
+            self._pending_since_ns = start_ns
+
+        api = self._api
+        # the API returns the trades after start_ns, the ones of its millisecond
+        # belong to the piece before
+        trades = [
+            trade
+            for trade in api.get_trades()
+            if trade.timestamp_ms * 1_000_000 > start_ns
+        ]
+        self._pending += trades
+
+        if len(self._pending) >= self.segment_max_trades or api.is_done():
+            if end_ns is not None and api.is_past_until():
+                # the cursor overshot the end of the range, but the trades past it
+                # have been dropped, so the segment covers up to end_ns
+                until_ns = end_ns
+                segment, self._pending = self._pending, []
+            else:
+                # the cursor stopped at its last trade, and the next page can have
+                # more trades of the same millisecond, so the segment ends with the
+                # millisecond before and those trades go to the next one
+                last_ms = api.since_timestamp_ns // 1_000_000
+                until_ns = last_ms * 1_000_000 - 1
+                segment = [t for t in self._pending if t.timestamp_ms < last_ms]
+                self._pending = [t for t in self._pending if t.timestamp_ms >= last_ms]
+
+            if until_ns > self._pending_since_ns:
+                self.cache.write(self.pair, self._pending_since_ns, until_ns, segment)
+                self._pending_since_ns = until_ns
+            else:
+                self._pending = segment + self._pending
+
+        if api.is_done():
+            # caught up with the present, the trades of the last millisecond are
+            # downloaded again by the next backfill
+            self._pending = []
+            self._pages_fetched += api.pages_fetched
+            self._api = None
+            self._pieces.popleft()
+
+        return trades
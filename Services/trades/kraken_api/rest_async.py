@@ -0,0 +1,328 @@
+import asyncio
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from typing import Dict, Hashable, Iterator, List, Optional, Set, Tuple
+
+import requests
+from loguru import logger
+from requests.adapters import HTTPAdapter
+
+from .base import TradesAPI
+from .merge import merge_trades
+from .rate_limiter import TokenBucket
+from .rest import KrakenRestAPISinglePair, make_single_pair_api
+from .trade import Trade
+from .trade_cache import TradeCache
+
+
+class KrakenRestAPIAsync(TradesAPI):
+    """
+    Backfills the trades of all the pairs at the same time.
+
+    Every pair paginates on its own asyncio task, so a slow pair does not hold back
+    the others. All the requests go through one pooled `requests.Session` and take
+    their turn from a shared token bucket, so together they stay inside Kraken's
+    public call budget.
+
+    A deep pair can also be split into time slices that paginate in parallel, each
+    from its own `since` up to the start of the next slice. The slices are stitched
+    back together in order, so the pages of a pair still come out sorted.
+
+    The event loop runs on a background thread and hands the pages of each pair over
+    through a bounded queue. The consumer merges the pairs in timestamp order, and a
+    pair that runs too far ahead of the merge blocks on its full queue. The class
+    keeps the blocking `get_trades()` / `is_done()` interface the trades service
+    expects.
+
+    A cursor that fails ends its pair with the error instead of the closing None,
+    and `get_trades()` raises it, so a failed backfill never looks like a finished
+    one with trades missing.
+    """
+
+    def __init__(
+        self,
+        pairs: List[str],
+        last_n_days: int,
+        requests_per_second: float = 1.0,
+        burst: int = 1,
+        slices_per_pair: int = 1,
+        url: str = KrakenRestAPISinglePair.URL,
+        max_pending_pages: int = 10,
+        batch_size: int = 1000,
+        stats_interval_sec: float = 30.0,
+        cache: Optional[TradeCache] = None,
+    ):
+        """
+        Args:
+            pairs (List[str]): the pairs to backfill
+            last_n_days (int): number of days of history to download
+            requests_per_second (float): sustained request rate shared by all pairs
+            burst (int): how many requests can be sent back to back
+            slices_per_pair (int): number of time slices each pair's range is split
+                into and paginated in parallel
+            url (str): the Trades endpoint, overridable to point at a local fake
+            max_pending_pages (int): pages of a pair downloaded but not consumed yet
+                before its cursors wait for the consumer to catch up. Also bounds the
+                pages each slice can buffer while it waits for the slices before it.
+            batch_size (int): number of trades returned by each call to get_trades
+            stats_interval_sec (float): how often to log the pages per second per pair
+            cache (Optional[TradeCache]): archive of earlier downloads. Only the
+                ranges missing from it are downloaded.
+        """
+        self.pairs = pairs
+        self.max_pending_pages = max_pending_pages
+        self.batch_size = batch_size
+        self.stats_interval_sec = stats_interval_sec
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=len(pairs) * slices_per_pair
+        )
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.rate_limiter = TokenBucket(rate=requests_per_second, capacity=burst)
+
+        now_ns = time.time_ns()
+        since_ns = now_ns - last_n_days * 24 * 60 * 60 * 1_000_000_000
+        slices = split_time_range(since_ns, now_ns, slices_per_pair)
+
+        # the cursors of each pair, one per time slice. The last slice has no end,
+        # so it paginates up to the present like a regular backfill.
+        self.apis: Dict[str, List[TradesAPI]] = {
+            pair: [
+                make_single_pair_api(
+                    pair=pair,
+                    last_n_days=last_n_days,
+                    cache=cache,
+                    session=self.session,
+                    url=url,
+                    since_timestamp_ns=start_ns,
+                    until_timestamp_ns=end_ns if i < len(slices) - 1 else None,
+                    rate_limiter=self.rate_limiter,
+                )
+                for i, (start_ns, end_ns) in enumerate(slices)
+            ]
+            for pair in self.pairs
+        }
+
+        self._started_at: Optional[float] = None
+
+        # pages of each pair handed over from the event loop, closed with a None, or
+        # with the exception that stopped the pair
+        self._pages: Dict[str, queue.Queue] = {
+            pair: queue.Queue(maxsize=max_pending_pages) for pair in self.pairs
+        }
+        self._trades = merge_trades(self._iter_pair(pair) for pair in self.pairs)
+        self._is_done = False
+        self._error: Optional[BaseException] = None
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def get_trades(self) -> List[Trade]:
+        """
+        Returns the next `batch_size` trades across all pairs in timestamp order,
+        waiting for the pages the merge needs.
+        """
+        trades = list(islice(self._trades, self.batch_size))
+
+        # the merge only comes up short once every pair is exhausted
+        if len(trades) < self.batch_size:
+            self._is_done = True
+
+        return trades
+
+    def is_done(self) -> bool:
+        return self._is_done
+
+    def pages_per_second(self) -> Dict[str, float]:
+        """
+        Returns the average number of pages per second fetched for each pair so far
+        """
+        if self._started_at is None:
+            return {pair: 0.0 for pair in self.pairs}
+
+        elapsed_sec = max(time.monotonic() - self._started_at, 1e-9)
+        return {pair: self._pages_fetched(pair) / elapsed_sec for pair in self.pairs}
+
+    def _pages_fetched(self, pair: str) -> int:
+        return sum(api.pages_fetched for api in self.apis[pair])
+
+    def _run(self):
+        """
+        Runs the backfill on this thread's event loop, keeping the error it fails
+        with for the consumer
+        """
+        try:
+            asyncio.run(self._backfill())
+        except BaseException as e:
+            logger.exception(f'Backfill failed: {e}')
+            self._error = e
+
+    def _iter_pair(self, pair: str) -> Iterator[Trade]:
+        """
+        Yields the trades of one pair as its pages arrive, until the pair is closed.
+        Raises the error of the pair, or of the backfill thread if it dies before
+        closing the pair.
+        """
+        pages = self._pages[pair]
+        while True:
+            try:
+                page = pages.get(timeout=1.0)
+            except queue.Empty:
+                if not self._thread.is_alive() and pages.empty():
+                    raise RuntimeError(
+                        f'Backfill of {pair} stopped before its last page'
+                    ) from self._error
+                continue
+
+            if page is None:
+                return
+            if isinstance(page, BaseException):
+                raise RuntimeError(f'Backfill of {pair} failed') from page
+            yield from page
+
+    async def _backfill(self):
+        # one thread per cursor for the blocking requests, plus one per pair for
+        # handing pages over to its bounded queue
+        n_cursors = sum(len(apis) for apis in self.apis.values())
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(
+            ThreadPoolExecutor(max_workers=n_cursors + len(self.apis))
+        )
+
+        self._started_at = time.monotonic()
+        reporter = asyncio.create_task(self._report_stats())
+
+        await asyncio.gather(
+            *(self._backfill_pair(pair, apis) for pair, apis in self.apis.items())
+        )
+
+        reporter.cancel()
+        self._log_stats()
+
+    async def _backfill_pair(self, pair: str, apis: List[TradesAPI]):
+        """
+        Paginates all the slices of one pair in parallel and forwards their pages
+        in order
+        """
+        slice_pages = [asyncio.Queue(maxsize=self.max_pending_pages) for _ in apis]
+        cursors = [
+            asyncio.create_task(self._paginate(api, pages))
+            for api, pages in zip(apis, slice_pages)
+        ]
+
+        try:
+            async for page in stitch_slices(slice_pages):
+                await asyncio.to_thread(self._pages[pair].put, page)
+            await asyncio.gather(*cursors)
+        except Exception as e:
+            for cursor in cursors:
+                cursor.cancel()
+            # the consumer raises it once it reaches the pages before the failure
+            await asyncio.to_thread(self._pages[pair].put, e)
+            raise
+
+        await asyncio.to_thread(self._pages[pair].put, None)
+
+        logger.info(
+            f'Finished backfill for pair {pair} after {self._pages_fetched(pair)} pages'
+        )
+
+    async def _paginate(self, api: TradesAPI, pages: asyncio.Queue):
+        """
+        Paginates one slice until its cursor reaches the end of the slice, then
+        closes its queue with a None, or with the exception if the cursor fails, so
+        the stitch never moves on to the next slice over a hole. The cursor takes
+        its rate limiter token on the worker thread, and only for the pages it
+        actually downloads.
+        """
+        try:
+            while not api.is_done():
+                trades = await asyncio.to_thread(api.get_trades)
+
+                if trades:
+                    await pages.put(trades)
+        except Exception as e:
+            await pages.put(e)
+            raise
+        await pages.put(None)
+
+    async def _report_stats(self):
+        while True:
+            await asyncio.sleep(self.stats_interval_sec)
+            self._log_stats()
+
+    def _log_stats(self):
+        for pair, pages_per_sec in self.pages_per_second().items():
+            logger.info(
+                f'{pair}: {self._pages_fetched(pair)} pages, '
+                f'{pages_per_sec:.2f} pages/s'
+            )
+
+
+def split_time_range(
+    start_ns: int, end_ns: int, n_slices: int
+) -> List[Tuple[int, int]]:
+    """
+    Splits [start_ns, end_ns] into `n_slices` contiguous slices of the same length
+
+    Returns:
+        List[Tuple[int, int]]: (start_ns, end_ns) of each slice, in order
+    """
+    if n_slices < 1:
+        raise ValueError(f'n_slices must be at least 1, got {n_slices}')
+
+    bounds = [start_ns + (end_ns - start_ns) * i // n_slices for i in range(n_slices)]
+    bounds.append(end_ns)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def trade_key(trade: Trade) -> Hashable:
+    """
+    Identifies a trade, to drop the ones returned twice at a slice boundary
+    """
+    if trade.trade_id is not None:
+        return trade.trade_id
+    return (trade.timestamp_ms, trade.price, trade.volume)
+
+
+async def stitch_slices(slice_pages: List[asyncio.Queue]):
+    """
+    Yields the pages of consecutive time slices in order. Each queue is consumed
+    until its closing None before moving on to the next one, and an exception in
+    place of the None is raised.
+
+    Two slices can both return the trades at their shared boundary, so the trades
+    in the last millisecond of a slice are remembered and dropped if the next slice
+    returns them again.
+    """
+    boundary_keys: Set[Hashable] = set()
+    boundary_ms = -1
+
+    for pages in slice_pages:
+        while (page := await pages.get()) is not None:
+            if isinstance(page, BaseException):
+                raise page
+            if boundary_keys:
+                page = [
+                    trade
+                    for trade in page
+                    if trade.timestamp_ms > boundary_ms
+                    or trade_key(trade) not in boundary_keys
+                ]
+                if not page:
+                    continue
+
+            if page[-1].timestamp_ms > boundary_ms:
+                boundary_ms = page[-1].timestamp_ms
+                boundary_keys = set()
+            boundary_keys.update(
+                trade_key(trade) for trade in page if trade.timestamp_ms == boundary_ms
+            )
+
+            yield page
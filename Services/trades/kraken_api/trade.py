@@ -1,12 +1,18 @@
+import json
+import time
 from datetime import datetime, timezone
-from typing import Any, Dict
+from functools import lru_cache
+from typing import Any, Dict, Optional
 
 from pydantic import BaseModel, field_serializer
 
 
-class Trade(BaseModel):
+class TradeModel(BaseModel):
     """
-    trade from kraken api
+    trade from kraken api, validated with pydantic.
+
+    The ingest loop works with the lighter `Trade` record. This model is only built
+    when trades are validated for debugging.
     """
 
     pair: str
@@ -14,12 +20,39 @@ class Trade(BaseModel):
     volume: float
     timestamp: datetime
     timestamp_ms: int
+    trade_id: Optional[int] = None
 
     @field_serializer('timestamp')
     def serialize_datetime(self, dt: datetime) -> str:
         """Serialize datetime to ISO format string"""
         return dt.isoformat()
 
+
+class Trade:
+    """
+    trade from kraken api
+
+    A plain record with __slots__, so building one in the ingest loop costs a single
+    small allocation. The datetime and the dict are only built on demand, and
+    `to_json_bytes()` writes the JSON message directly.
+    """
+
+    __slots__ = ('pair', 'price', 'volume', 'timestamp_ms', 'trade_id')
+
+    def __init__(
+        self,
+        pair: str,
+        price: float,
+        volume: float,
+        timestamp_ms: int,
+        trade_id: Optional[int] = None,
+    ):
+        self.pair = pair
+        self.price = price
+        self.volume = volume
+        self.timestamp_ms = timestamp_ms
+        self.trade_id = trade_id
+
     @classmethod
     def from_kraken_rest_api_response(
         cls,
@@ -27,6 +60,7 @@ class Trade(BaseModel):
         price: float,
         volume: float,
         timestamp_sec: float,
+        trade_id: Optional[int] = None,
     ) -> 'Trade':
         """
         Returns a Trade object from the Kraken REST API response.
@@ -37,17 +71,24 @@ class Trade(BaseModel):
             price: float
             volume: float
             timestamp_sec: float
+            trade_id: int
         """
-        timestamp_ms = int(float(timestamp_sec) * 1000)
-        dt = datetime.fromtimestamp(timestamp_ms / 1000.0, tz=timezone.utc)
-
-        return cls(
-            pair=pair,
-            price=price,
-            volume=volume,
-            timestamp=dt,
-            timestamp_ms=timestamp_ms,
-        )
+        return cls(pair, price, volume, int(float(timestamp_sec) * 1000), trade_id)
+
+    @classmethod
+    def from_timestamp_ms(
+        cls,
+        pair: str,
+        price: float,
+        volume: float,
+        timestamp_ms: int,
+        trade_id: Optional[int] = None,
+    ) -> 'Trade':
+        """
+        Returns a Trade object from values that were already parsed, e.g. read back
+        from the trade cache
+        """
+        return cls(pair, price, volume, timestamp_ms, trade_id)
 
     @classmethod
     def from_kraken_websocket_api_response(
@@ -56,17 +97,96 @@ class Trade(BaseModel):
         price: float,
         volume: float,
         timestamp: str,
+        trade_id: Optional[int] = None,
     ) -> 'Trade':
         """Create a Trade instance from Kraken API response"""
         dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-        return cls(
-            pair=pair,
-            price=price,
-            volume=volume,
-            timestamp=dt,
-            timestamp_ms=int(dt.timestamp() * 1000),
+        return cls(pair, price, volume, int(dt.timestamp() * 1000), trade_id)
+
+    @property
+    def timestamp(self) -> datetime:
+        return datetime.fromtimestamp(self.timestamp_ms / 1000.0, tz=timezone.utc)
+
+    def validate(self) -> TradeModel:
+        """
+        Builds the pydantic model of the trade, raising a ValidationError if any
+        field is invalid
+        """
+        return TradeModel(
+            pair=self.pair,
+            price=self.price,
+            volume=self.volume,
+            timestamp=self.timestamp,
+            timestamp_ms=self.timestamp_ms,
+            trade_id=self.trade_id,
         )
 
     def to_dict(self) -> Dict[str, Any]:
         """Convert Trade to a dictionary with serializable values"""
-        return self.model_dump()
+        return {
+            'pair': self.pair,
+            'price': self.price,
+            'volume': self.volume,
+            'timestamp': _isoformat(self.timestamp_ms),
+            'timestamp_ms': self.timestamp_ms,
+            'trade_id': self.trade_id,
+        }
+
+    def to_json_bytes(self) -> bytes:
+        """
+        Encodes the trade as the same JSON message as `to_dict()`, without building
+        the dict
+        """
+        trade_id = b'null' if self.trade_id is None else b'%d' % self.trade_id
+        return b'%s%r,"volume":%r,"timestamp":"%s","timestamp_ms":%d,"trade_id":%s}' % (
+            _json_prefix(self.pair),
+            float(self.price),
+            float(self.volume),
+            _isoformat(self.timestamp_ms).encode(),
+            self.timestamp_ms,
+            trade_id,
+        )
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, Trade):
+            return NotImplemented
+        return self._astuple() == other._astuple()
+
+    def __repr__(self) -> str:
+        return (
+            f'Trade(pair={self.pair!r}, price={self.price!r}, volume={self.volume!r}, '
+            f'timestamp_ms={self.timestamp_ms!r}, trade_id={self.trade_id!r})'
+        )
+
+    def _astuple(self):
+        return (self.pair, self.price, self.volume, self.timestamp_ms, self.trade_id)
+
+
+# JSON of the first field of each pair's messages, there are only a handful of pairs
+_JSON_PREFIXES: Dict[str, bytes] = {}
+
+
+def _json_prefix(pair: str) -> bytes:
+    prefix = _JSON_PREFIXES.get(pair)
+    if prefix is None:
+        prefix = f'{{"pair":{json.dumps(pair)},"price":'.encode()
+        _JSON_PREFIXES[pair] = prefix
+    return prefix
+
+
+def _isoformat(timestamp_ms: int) -> str:
+    """
+    Same string as `datetime.isoformat()` of the UTC datetime of the timestamp,
+    without building the datetime
+    """
+    seconds, ms = divmod(timestamp_ms, 1000)
+    date_time = _format_seconds(seconds)
+    if ms:
+        return f'{date_time}.{ms:03d}000+00:00'
+    return f'{date_time}+00:00'
+
+
+@lru_cache(maxsize=1024)
+def _format_seconds(seconds: int) -> str:
+    # consecutive trades mostly fall in the same few seconds
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds))
@@ -0,0 +1,254 @@
+import os
+import struct
+import threading
+import time
+from array import array
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Tuple
+
+from loguru import logger
+from pydantic import BaseModel
+
+from .trade import Trade
+
+
+class CachedSegment(BaseModel):
+    """
+    Trades of one pair covering the interval (since_ns, until_ns], stored in one file
+    """
+
+    pair: str
+    since_ns: int
+    until_ns: int
+    file_name: str
+    size_bytes: int
+    last_used_at: float
+
+
+class CacheIndex(BaseModel):
+    segments: List[CachedSegment] = []
+
+
+class TradeColumns(NamedTuple):
+    """
+    Trades of a segment stored column by column. A trade_id of -1 means unknown.
+    """
+
+    timestamp_ms: array
+    price: array
+    volume: array
+    trade_id: array
+
+
+class TradeCache:
+    """
+    Local archive of the trades downloaded from the Kraken REST API, so a backfill
+    only downloads the ranges that earlier runs have not covered yet.
+
+    Layout on disk:
+        <cache_dir>/index.json                     covered intervals of every pair
+        <cache_dir>/<pair>/<since>_<until>.trades  one segment per file
+
+    A segment file is a small header followed by the timestamp_ms, price, volume and
+    trade_id columns, each a packed array of 8 byte values. Segments are evicted
+    least recently used first once the cache grows over `max_bytes`.
+
+    Reading a segment only marks it used in memory, the index is saved with the next
+    write or on `close()`. A crash loses the uses since then, not the segments.
+    """
+
+    INDEX_FILE = 'index.json'
+    SEGMENT_MAGIC = b'KTRC'
+    SEGMENT_VERSION = 1
+    # magic, version, number of trades
+    _HEADER = struct.Struct('<4sHQ')
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        """
+        Args:
+            cache_dir (str): directory to keep the segments and the index in
+            max_bytes (int): total size of the segments before the least recently
+                used ones are evicted
+        """
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        # segments of different pairs and slices are written from several threads
+        self._lock = threading.Lock()
+        self._index = self._load_index()
+        # segments were used since the index was saved
+        self._index_dirty = False
+
+        logger.info(
+            f'Trade cache at {self.cache_dir} holds {len(self._index.segments)} '
+            f'segments, {self.size_bytes()} bytes'
+        )
+
+    def size_bytes(self) -> int:
+        return sum(segment.size_bytes for segment in self._index.segments)
+
+    def segments(self, pair: str) -> List[CachedSegment]:
+        """
+        Returns the cached segments of a pair in time order
+        """
+        with self._lock:
+            return sorted(
+                (s for s in self._index.segments if s.pair == pair),
+                key=lambda s: s.since_ns,
+            )
+
+    def plan(
+        self, pair: str, since_ns: int, until_ns: Optional[int]
+    ) -> List[Tuple[int, Optional[int], Optional[CachedSegment]]]:
+        """
+        Splits (since_ns, until_ns] into consecutive pieces that are either served
+        by a cached segment or missing from the cache.
+
+        Args:
+            pair (str): the pair
+            since_ns (int): start of the range
+            until_ns (Optional[int]): end of the range, None for the present
+
+        Returns:
+            List[Tuple[int, Optional[int], Optional[CachedSegment]]]: (start, end,
+            segment) of each piece in order, with segment None for missing pieces
+        """
+        segments = self.segments(pair)
+
+        pieces = []
+        cursor_ns = since_ns
+        for segment in segments:
+            if until_ns is not None and cursor_ns >= until_ns:
+                break
+            if segment.until_ns <= cursor_ns:
+                continue
+            if until_ns is not None and segment.since_ns >= until_ns:
+                break
+
+            if segment.since_ns > cursor_ns:
+                pieces.append((cursor_ns, segment.since_ns, None))
+                cursor_ns = segment.since_ns
+
+            end_ns = (
+                segment.until_ns
+                if until_ns is None
+                else min(segment.until_ns, until_ns)
+            )
+            pieces.append((cursor_ns, end_ns, segment))
+            cursor_ns = end_ns
+
+        if until_ns is None or cursor_ns < until_ns:
+            pieces.append((cursor_ns, until_ns, None))
+
+        return pieces
+
+    def read(self, segment: CachedSegment) -> Optional[TradeColumns]:
+        """
+        Loads the columns of a segment, or None if it has been evicted meanwhile
+        """
+        path = self.cache_dir / segment.file_name
+        try:
+            data = path.read_bytes()
+        except FileNotFoundError:
+            return None
+
+        magic, version, n_trades = self._HEADER.unpack_from(data)
+        if magic != self.SEGMENT_MAGIC or version != self.SEGMENT_VERSION:
+            logger.warning(f'Ignoring cache segment {path} with unknown format')
+            return None
+
+        columns = []
+        offset = self._HEADER.size
+        for typecode in ('q', 'd', 'd', 'q'):
+            column = array(typecode)
+            column.frombytes(data[offset : offset + 8 * n_trades])
+            columns.append(column)
+            offset += 8 * n_trades
+
+        with self._lock:
+            segment.last_used_at = time.time()
+            self._index_dirty = True
+
+        return TradeColumns(*columns)
+
+    def write(self, pair: str, since_ns: int, until_ns: int, trades: List[Trade]):
+        """
+        Archives the trades of `pair` that cover (since_ns, until_ns] as a new segment
+        and evicts old segments if the cache is over its size
+        """
+        columns = TradeColumns(
+            timestamp_ms=array('q', (t.timestamp_ms for t in trades)),
+            price=array('d', (t.price for t in trades)),
+            volume=array('d', (t.volume for t in trades)),
+            trade_id=array(
+                'q', (-1 if t.trade_id is None else t.trade_id for t in trades)
+            ),
+        )
+        header = self._HEADER.pack(
+            self.SEGMENT_MAGIC, self.SEGMENT_VERSION, len(trades)
+        )
+
+        file_name = f'{pair.replace("/", "-")}/{since_ns}_{until_ns}.trades'
+        path = self.cache_dir / file_name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # like the index, so a crash never leaves a truncated segment behind
+        tmp_path = path.with_name(path.name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(header)
+            for column in columns:
+                f.write(column.tobytes())
+        os.replace(tmp_path, path)
+
+        segment = CachedSegment(
+            pair=pair,
+            since_ns=since_ns,
+            until_ns=until_ns,
+            file_name=file_name,
+            size_bytes=path.stat().st_size,
+            last_used_at=time.time(),
+        )
+
+        with self._lock:
+            self._index.segments.append(segment)
+            self._evict()
+            self._save_index()
+
+        logger.debug(f'Cached {len(trades)} trades of {pair} in {file_name}')
+
+    def close(self):
+        """
+        Saves the uses of the segments read since the index was last saved
+        """
+        with self._lock:
+            if self._index_dirty:
+                self._save_index()
+
+    def _evict(self):
+        """
+        Removes the least recently used segments until the cache fits in max_bytes
+        """
+        total_bytes = self.size_bytes()
+        if total_bytes <= self.max_bytes:
+            return
+
+        self._index.segments.sort(key=lambda s: s.last_used_at)
+        while self._index.segments and total_bytes > self.max_bytes:
+            segment = self._index.segments.pop(0)
+            total_bytes -= segment.size_bytes
+            (self.cache_dir / segment.file_name).unlink(missing_ok=True)
+            logger.info(f'Evicted cache segment {segment.file_name}')
+
+    def _load_index(self) -> CacheIndex:
+        path = self.cache_dir / self.INDEX_FILE
+        if not path.exists():
+            return CacheIndex()
+        return CacheIndex.model_validate_json(path.read_text())
+
+    def _save_index(self):
+        # write to a temporary file first so a crash never leaves a truncated index
+        path = self.cache_dir / self.INDEX_FILE
+        tmp_path = path.with_suffix('.tmp')
+        tmp_path.write_text(self._index.model_dump_json())
+        os.replace(tmp_path, path)
+        self._index_dirty = False
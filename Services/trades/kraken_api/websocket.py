@@ -1,29 +1,152 @@
+import asyncio
 import json
-from typing import List
+import queue
+import random
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional, Set
 
-import websocket
 from loguru import logger
-from websocket import create_connection
+from websockets.asyncio.client import ClientConnection, connect
+from websockets.exceptions import ConnectionClosed, InvalidHandshake
 
 from .base import TradesAPI
+from .merge import merge_trades
+from .rate_limiter import TokenBucket
+from .rest import KrakenRestAPISinglePair
+from .rest_async import trade_key
 from .trade import Trade
 
 
-class KrakenWebsocketAPI(TradesAPI):
+class StalledConnectionError(Exception):
+    """
+    No message, not even a heartbeat, arrived within the heartbeat timeout
+    """
+
+
+class KrakenWebsocketConnection:
+    """
+    One connection to the Kraken Websocket API, subscribed to a set of pairs.
+
+    Kraken sends a heartbeat every second once we are subscribed, so a connection
+    that stays silent for `heartbeat_timeout_sec` is treated as stalled. Stalled or
+    dropped connections are reopened with exponential backoff and resubscribed, and
+    the trades missed while we were away are downloaded from the REST API before
+    live trades flow again, so the stream has no gap and no duplicates across a
+    reconnect.
+
+    If the REST API does not deliver the missed trades within
+    `gap_backfill_timeout_sec`, the live stream resumes anyway, with a gap that
+    is logged, rather than holding back the live trades for as long as the REST
+    API is down.
+    """
+
     URL = 'wss://ws.kraken.com/v2'
 
-    def __init__(self, pairs: List[str]):
+    def __init__(
+        self,
+        pairs: List[str],
+        on_trades: Callable[[List[Trade]], None],
+        url: str = URL,
+        rest_url: str = KrakenRestAPISinglePair.URL,
+        heartbeat_timeout_sec: float = 5.0,
+        min_backoff_sec: float = 0.5,
+        max_backoff_sec: float = 30.0,
+        rest_requests_per_second: float = 1.0,
+        rate_limiter: Optional[TokenBucket] = None,
+        gap_backfill_timeout_sec: float = 60.0,
+    ):
+        """
+        Args:
+            pairs (List[str]): the pairs to subscribe to
+            on_trades (Callable[[List[Trade]], None]): called on the event loop with
+                every batch of new trades, must not block
+            url (str): the websocket endpoint, overridable to point at a local fake
+            rest_url (str): the REST Trades endpoint the missed trades are fetched from
+            heartbeat_timeout_sec (float): seconds without any message before the
+                connection is considered stalled
+            min_backoff_sec (float): wait before the first reconnect attempt
+            max_backoff_sec (float): cap of the exponential backoff between attempts
+            rest_requests_per_second (float): rate limit of the gap backfill requests
+            rate_limiter (Optional[TokenBucket]): limiter shared with other
+                connections, instead of one of `rest_requests_per_second` of its own
+            gap_backfill_timeout_sec (float): how long the live trades are held back
+                for the missed ones, before the stream resumes with a gap
+        """
         self.pairs = pairs
-        websocket.enableTrace(True)
-        logger.info(f'Connecting to Kraken Websocket with pairs: {self.pairs}')
-        self._ws_client = create_connection(url=self.URL)
-        self._subscribe()
+        self.on_trades = on_trades
+        self.url = url
+        self.rest_url = rest_url
+        self.heartbeat_timeout_sec = heartbeat_timeout_sec
+        self.min_backoff_sec = min_backoff_sec
+        self.max_backoff_sec = max_backoff_sec
+        self.rate_limiter = rate_limiter or TokenBucket(rate=rest_requests_per_second)
+        self.gap_backfill_timeout_sec = gap_backfill_timeout_sec
 
-    def _subscribe(self):
+        # stats of the connection, read from other threads
+        self.messages_received = 0
+        self.trades_received = 0
+        self.reconnects = 0
+        self.last_recovery_sec: Optional[float] = None
+        # reconnects after which the live stream resumed without the missed trades
+        self.gaps = 0
+
+        # last emitted timestamp of each pair, and the keys of the trades emitted at
+        # that exact millisecond, to drop the trades we get twice across a reconnect
+        self._last_ms: Dict[str, int] = {}
+        self._keys_at_last_ms: Dict[str, Set] = {}
+
+        # wall clock time of the last message, where a backfill after a reconnect
+        # starts for the pairs that had no trade yet
+        self._last_message_ns = time.time_ns()
+        # when the connection was lost and where its backfill starts, both None
+        # while we are connected and caught up
+        self._disconnected_at: Optional[float] = None
+        self._gap_since_ns: Optional[int] = None
+
+    async def run(self):
         """
-        subscribe to the websocket and handle initial subscription messages
+        Keeps a connection open, reconnecting with exponential backoff whenever it
+        stalls or drops
+        """
+        backoff_sec = self.min_backoff_sec
+        while True:
+            connected = False
+            try:
+                async with connect(self.url) as ws:
+                    connected = True
+                    await self._subscribe(ws)
+                    backoff_sec = self.min_backoff_sec
+                    await self._consume(ws)
+            except (
+                ConnectionClosed,
+                InvalidHandshake,
+                OSError,
+                StalledConnectionError,
+                TimeoutError,
+            ) as e:
+                logger.warning(f'Websocket connection lost: {e!r}')
+
+            # only a connection we had counts as lost, failed attempts to open one
+            # neither count as reconnects nor start a gap before the first trades
+            if connected:
+                # the gap to backfill starts where the last connection went quiet
+                if self._disconnected_at is None:
+                    self._disconnected_at = time.monotonic()
+                    self._gap_since_ns = self._last_message_ns
+                self.reconnects += 1
+
+            # jitter so the shards of a deployment do not reconnect in lockstep
+            delay_sec = backoff_sec * random.uniform(0.5, 1.0)
+            logger.info(f'Reconnecting in {delay_sec:.1f}s')
+            await asyncio.sleep(delay_sec)
+            backoff_sec = min(backoff_sec * 2, self.max_backoff_sec)
+
+    async def _subscribe(self, ws: ClientConnection):
+        """
+        Sends the subscribe message. The confirmations are handled as they arrive
+        with the rest of the messages, however many Kraken sends.
         """
-        # send a subscribe message to the websocket
         subscribe_msg = {
             'method': 'subscribe',
             'params': {
@@ -33,53 +156,245 @@ class KrakenWebsocketAPI(TradesAPI):
             },
         }
         logger.info(f'Sending subscribe message: {subscribe_msg}')
-        self._ws_client.send(json.dumps(subscribe_msg))
+        await ws.send(json.dumps(subscribe_msg))
+
+    async def _consume(self, ws: ClientConnection):
+        """
+        Reads messages until the connection stalls or drops.
 
-        # skip subscription confirmation messages
-        for _ in self.pairs:
-            msg1 = self._ws_client.recv()
-            msg2 = self._ws_client.recv()
-            logger.info(f'Subscription confirmation message: {msg1}, {msg2}')
+        After a reconnect the missed interval is downloaded from the REST API in the
+        background. Live trades are held back until it is done, then the backfilled
+        trades are emitted followed by the held back ones.
+        """
+        gap: Optional[asyncio.Task] = None
+        held_back: List[Trade] = []
+        if self._disconnected_at is not None:
+            gap = asyncio.create_task(
+                asyncio.to_thread(
+                    self._fetch_missed_trades,
+                    self._gap_since_ns,
+                    time.time_ns(),
+                    time.monotonic() + self.gap_backfill_timeout_sec,
+                )
+            )
 
-    def get_trades(self) -> List[Trade]:
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(
+                        ws.recv(), timeout=self.heartbeat_timeout_sec
+                    )
+                except asyncio.TimeoutError:
+                    raise StalledConnectionError(
+                        f'No message for {self.heartbeat_timeout_sec}s'
+                    ) from None
+                self._last_message_ns = time.time_ns()
+                self.messages_received += 1
+
+                trades = self._parse(data)
+                if gap is None:
+                    self._emit(trades)
+                    continue
+
+                held_back.extend(trades)
+                if gap.done():
+                    missed = self._gap_result(gap)
+                    self._emit(missed)
+                    self._emit(held_back)
+                    gap = None
+                    held_back = []
+
+                    self.last_recovery_sec = time.monotonic() - self._disconnected_at
+                    self._disconnected_at = None
+                    self._gap_since_ns = None
+                    logger.info(
+                        f'Recovered from disconnect in {self.last_recovery_sec:.2f}s, '
+                        f'backfilled {len(missed)} trades from the REST API'
+                    )
+        finally:
+            # the next connection backfills again from the last emitted trades
+            if gap is not None:
+                gap.cancel()
+
+    def _fetch_missed_trades(
+        self, since_ns: int, until_ns: int, deadline: float
+    ) -> List[Trade]:
         """
-        Fetches the trades fromm the Kraken Websocket APIs and returns them as a list of Trade objects.
+        Downloads the trades of every pair in (since, until] from the REST API, in
+        timestamp order. Each pair starts from its last emitted trade.
 
-        Returns:
-            List[Trade]: A list of Trade objects
+        Raises:
+            TimeoutError: at `deadline`, in `time.monotonic()`. The REST API
+                answers errors with an empty page and the cursors ask again,
+                forever while it is down.
         """
-        data = self._ws_client.recv()
-        logger.info(f'Received message: {data}')
+        apis = [
+            KrakenRestAPISinglePair(
+                pair=pair,
+                last_n_days=0,
+                url=self.rest_url,
+                since_timestamp_ns=self._last_ms.get(pair, since_ns // 1_000_000)
+                * 1_000_000,
+                until_timestamp_ns=until_ns,
+                rate_limiter=self.rate_limiter,
+            )
+            for pair in self.pairs
+        ]
+        return list(merge_trades(_iter_trades_until(api, deadline) for api in apis))
 
-        if 'heartbeat' in data:
-            logger.info('Received heartbeat message')
-            return []
+    def _gap_result(self, gap: asyncio.Task) -> List[Trade]:
+        # better to resume the live stream with a gap than to not resume at all
+        try:
+            return gap.result()
+        except TimeoutError as e:
+            logger.error(
+                f'Resuming the live stream with a gap from {self._gap_since_ns}: {e}'
+            )
+        except Exception:
+            logger.exception(
+                f'Failed to backfill the missed trades, resuming the live stream '
+                f'with a gap from {self._gap_since_ns}'
+            )
+        self.gaps += 1
+        return []
+
+    def _emit(self, trades: List[Trade]):
+        """
+        Hands the trades over to the main thread, dropping the ones that were
+        already emitted
+        """
+        new_trades = []
+        for trade in trades:
+            last_ms = self._last_ms.get(trade.pair, -1)
+            if trade.timestamp_ms < last_ms:
+                continue
+            if trade.timestamp_ms > last_ms:
+                self._last_ms[trade.pair] = trade.timestamp_ms
+                self._keys_at_last_ms[trade.pair] = set()
+
+            key = trade_key(trade)
+            keys = self._keys_at_last_ms[trade.pair]
+            if key in keys:
+                continue
+            keys.add(key)
+            new_trades.append(trade)
 
-        # transform raw string into a JSON object
+        if new_trades:
+            self.trades_received += len(new_trades)
+            self.on_trades(new_trades)
+
+    def _parse(self, data: str) -> List[Trade]:
+        """
+        Returns the trades in a message, and nothing for subscription confirmations,
+        heartbeats and status messages
+        """
         try:
-            data = json.loads(data)
+            msg = json.loads(data)
         except json.JSONDecodeError as e:
             logger.error(f'Error decoding JSON: {e}')
             return []
 
-        try:
-            trades_data = data['data']
-        except KeyError as e:
-            logger.error(f'No data field in message: {e}')
+        if msg.get('method') == 'subscribe':
+            if not msg.get('success'):
+                logger.error(f'Subscription failed: {msg}')
+            else:
+                logger.info(f'Subscription confirmation message: {msg}')
+            return []
+
+        if msg.get('channel') != 'trade':
             return []
 
-        trades = [
+        return [
             Trade.from_kraken_websocket_api_response(
                 pair=trade['symbol'],
                 price=trade['price'],
                 volume=trade['qty'],
                 timestamp=trade['timestamp'],
+                trade_id=trade.get('trade_id'),
             )
-            for trade in trades_data
+            for trade in msg.get('data', [])
         ]
 
-        # breakpoint()
-        return trades
+
+def _iter_trades_until(
+    api: KrakenRestAPISinglePair, deadline: float
+) -> Iterator[Trade]:
+    """
+    `iter_trades` that raises a TimeoutError at `deadline`, in `time.monotonic()`,
+    instead of asking a failing REST API again and again
+    """
+    while not api.is_done():
+        if time.monotonic() > deadline:
+            raise TimeoutError(
+                f'The trades of {api.pair} were not backfilled in time, '
+                f'{api.pages_fetched} pages fetched'
+            )
+        yield from api.get_trades()
+
+
+class KrakenWebsocketAPI(TradesAPI):
+    """
+    Live trades from the Kraken Websocket API, on a single connection.
+
+    The connection runs on an asyncio loop in a background thread and hands the
+    trades over through a queue. See `KrakenShardedWebsocketAPI` to spread many
+    pairs over several connections and processes.
+    """
+
+    URL = KrakenWebsocketConnection.URL
+
+    def __init__(self, pairs: List[str], **connection_kwargs):
+        """
+        Args:
+            pairs (List[str]): the pairs to subscribe to
+            connection_kwargs: passed to `KrakenWebsocketConnection`
+        """
+        self.pairs = pairs
+        self._trades: queue.Queue = queue.Queue()
+        self.connection = KrakenWebsocketConnection(
+            pairs, on_trades=self._trades.put, **connection_kwargs
+        )
+        self._error: Optional[BaseException] = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+        logger.info(f'Connecting to Kraken Websocket with pairs: {self.pairs}')
+        self._thread.start()
+
+    @property
+    def reconnects(self) -> int:
+        return self.connection.reconnects
+
+    @property
+    def last_recovery_sec(self) -> Optional[float]:
+        return self.connection.last_recovery_sec
+
+    def get_trades(self) -> List[Trade]:
+        """
+        Returns the trades received since the last call, waiting up to a second for
+        the first one.
+
+        Returns:
+            List[Trade]: A list of Trade objects
+        """
+        try:
+            trades = self._trades.get(timeout=1)
+        except queue.Empty:
+            if not self._thread.is_alive():
+                raise RuntimeError('Websocket connection failed') from self._error
+            return []
+
+        while True:
+            try:
+                trades.extend(self._trades.get_nowait())
+            except queue.Empty:
+                return trades
 
     def is_done(self) -> bool:
         return False
+
+    def _run(self):
+        try:
+            asyncio.run(self.connection.run())
+        except BaseException as e:
+            logger.exception('Websocket connection failed')
+            self._error = e
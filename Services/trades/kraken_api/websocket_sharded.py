@@ -0,0 +1,306 @@
+import asyncio
+import multiprocessing
+import queue
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from loguru import logger
+
+from .base import TradesAPI
+from .rate_limiter import SharedTokenBucket
+from .trade import Trade
+from .websocket import KrakenWebsocketConnection
+
+# counters each shard publishes to the parent process, in this order
+_MESSAGES, _TRADES, _RECONNECTS, _BACKLOG, _DROPPED = range(5)
+_N_COUNTERS = 5
+
+
+class ShardStats(NamedTuple):
+    shard: int
+    pairs: int
+    messages_per_second: float
+    trades_per_second: float
+    reconnects: int
+    # batches received by the shard that have not made it into the shared queue yet
+    backlog: int
+    # trades dropped since the start because the backlog was full
+    dropped_trades: int
+
+
+class KrakenShardedWebsocketAPI(TradesAPI):
+    """
+    Live trades of many pairs, spread over several websocket connections running
+    in several worker processes.
+
+    Pairs are dealt round robin to `n_sockets` shards, and the shards round robin
+    to `n_processes` workers. Every shard is a `KrakenWebsocketConnection` with its
+    own subscription, heartbeat and reconnect handling, so one bad socket does not
+    hold back the others. All the shards feed one bounded queue that this process
+    drains into the producer.
+
+    A slow producer does not stall the sockets: each shard hands its batches to a
+    forwarding thread that blocks on the full queue instead, and the batches
+    waiting there show up as the shard's backlog. The backlog is bounded too, a
+    shard whose backlog is full drops the new batches and counts their trades, so a
+    producer that does not keep up costs trades, never the memory of the workers.
+    The order of the trades of a pair is preserved since a pair lives on a single
+    shard.
+
+    All the connections take the tokens of their gap backfill requests from one
+    bucket shared by the workers, so shards reconnecting together stay within
+    `rest_requests_per_second` between them.
+    """
+
+    def __init__(
+        self,
+        pairs: List[str],
+        n_sockets: int = 1,
+        n_processes: int = 1,
+        max_queue_size: int = 1000,
+        max_backlog: int = 1000,
+        rest_requests_per_second: float = 1.0,
+        stats_interval_sec: float = 30.0,
+        **connection_kwargs: Any,
+    ):
+        """
+        Args:
+            pairs (List[str]): the pairs to subscribe to
+            n_sockets (int): number of websocket connections to spread the pairs over
+            n_processes (int): number of worker processes running the connections
+            max_queue_size (int): batches of trades the shared queue holds before the
+                shards have to wait for the producer
+            max_backlog (int): batches of trades every shard holds while it waits for
+                the shared queue, before it drops the new ones
+            rest_requests_per_second (float): rate limit of the gap backfill requests
+                of all the connections together
+            stats_interval_sec (float): how often to log the stats of every shard
+            connection_kwargs: passed to every `KrakenWebsocketConnection`
+        """
+        self.pairs = pairs
+        self.shards = split_pairs(pairs, n_sockets)
+        self.stats_interval_sec = stats_interval_sec
+        n_processes = max(1, min(n_processes, len(self.shards)))
+
+        # spawn instead of fork, the parent may already run threads of its own
+        ctx = multiprocessing.get_context('spawn')
+        self._queue = ctx.Queue(maxsize=max_queue_size)
+        self._counters = ctx.Array('q', len(self.shards) * _N_COUNTERS, lock=False)
+        connection_kwargs['rate_limiter'] = SharedTokenBucket(
+            rate=rest_requests_per_second, ctx=ctx
+        )
+
+        self._workers = []
+        for worker_id in range(n_processes):
+            shard_ids = list(range(worker_id, len(self.shards), n_processes))
+            worker = ctx.Process(
+                target=run_worker,
+                args=(
+                    {shard_id: self.shards[shard_id] for shard_id in shard_ids},
+                    self._queue,
+                    self._counters,
+                    max_backlog,
+                    connection_kwargs,
+                ),
+                name=f'kraken-websocket-{worker_id}',
+                daemon=True,
+            )
+            worker.start()
+            self._workers.append(worker)
+
+        logger.info(
+            f'Connecting to Kraken Websocket with {len(self.pairs)} pairs on '
+            f'{len(self.shards)} sockets in {len(self._workers)} processes'
+        )
+
+        # counters at the last call of `shard_stats()`, to turn them into rates
+        self._last_counters = list(self._counters)
+        self._last_stats_at = time.monotonic()
+
+        self._reporter = threading.Thread(target=self._report_stats, daemon=True)
+        self._reporter.start()
+
+    def get_trades(self) -> List[Trade]:
+        """
+        Returns the trades of all the shards received since the last call, waiting
+        up to a second for the first batch.
+
+        Returns:
+            List[Trade]: A list of Trade objects
+        """
+        try:
+            trades = self._queue.get(timeout=1)
+        except queue.Empty:
+            self._check_workers()
+            return []
+
+        while True:
+            try:
+                trades.extend(self._queue.get_nowait())
+            except queue.Empty:
+                return trades
+
+    def is_done(self) -> bool:
+        return False
+
+    def queue_depth(self) -> Optional[int]:
+        """
+        Returns the number of batches waiting in the shared queue, None on platforms
+        that cannot tell
+        """
+        try:
+            return self._queue.qsize()
+        except NotImplementedError:
+            return None
+
+    def shard_stats(self) -> List[ShardStats]:
+        """
+        Returns the stats of every shard, with the rates averaged since the last call
+        """
+        counters = list(self._counters)
+        now = time.monotonic()
+        elapsed_sec = max(now - self._last_stats_at, 1e-9)
+
+        stats = []
+        for shard_id, pairs in enumerate(self.shards):
+            base = shard_id * _N_COUNTERS
+            last = self._last_counters
+            stats.append(
+                ShardStats(
+                    shard=shard_id,
+                    pairs=len(pairs),
+                    messages_per_second=(
+                        counters[base + _MESSAGES] - last[base + _MESSAGES]
+                    )
+                    / elapsed_sec,
+                    trades_per_second=(counters[base + _TRADES] - last[base + _TRADES])
+                    / elapsed_sec,
+                    reconnects=counters[base + _RECONNECTS],
+                    backlog=counters[base + _BACKLOG],
+                    dropped_trades=counters[base + _DROPPED],
+                )
+            )
+
+        self._last_counters = counters
+        self._last_stats_at = now
+        return stats
+
+    def _check_workers(self):
+        for worker in self._workers:
+            if not worker.is_alive():
+                raise RuntimeError(
+                    f'Websocket worker {worker.name} exited with code {worker.exitcode}'
+                )
+
+    def _report_stats(self):
+        while True:
+            time.sleep(self.stats_interval_sec)
+            for stats in self.shard_stats():
+                logger.info(
+                    f'Shard {stats.shard}: {stats.pairs} pairs, '
+                    f'{stats.messages_per_second:.1f} msgs/s, '
+                    f'{stats.trades_per_second:.1f} trades/s, '
+                    f'{stats.reconnects} reconnects, backlog {stats.backlog}, '
+                    f'{stats.dropped_trades} trades dropped'
+                )
+            logger.info(f'Websocket queue depth: {self.queue_depth()}')
+
+
+def split_pairs(pairs: List[str], n_shards: int) -> List[List[str]]:
+    """
+    Deals the pairs round robin into at most `n_shards` non empty shards
+    """
+    n_shards = max(1, min(n_shards, len(pairs)))
+    return [pairs[i::n_shards] for i in range(n_shards)]
+
+
+def run_worker(
+    shards: Dict[int, List[str]],
+    trades_queue: multiprocessing.Queue,
+    counters,
+    max_backlog: int,
+    connection_kwargs: Dict[str, Any],
+):
+    """
+    Entry point of a worker process, runs the connections of its shards on one
+    event loop until the parent goes away
+    """
+    asyncio.run(
+        _run_shards(shards, trades_queue, counters, max_backlog, connection_kwargs)
+    )
+
+
+async def _run_shards(
+    shards: Dict[int, List[str]],
+    trades_queue: multiprocessing.Queue,
+    counters,
+    max_backlog: int,
+    connection_kwargs: Dict[str, Any],
+):
+    connections = {}
+    backlogs = {}
+    for shard_id, pairs in shards.items():
+        # the event loop must never block on the shared queue, or the heartbeats of
+        # every socket of this worker would time out while the producer catches up
+        backlog = ShardBacklog(shard_id, max_backlog)
+        threading.Thread(
+            target=backlog.forward, args=(trades_queue,), daemon=True
+        ).start()
+        backlogs[shard_id] = backlog
+        connections[shard_id] = KrakenWebsocketConnection(
+            pairs, on_trades=backlog.put, **connection_kwargs
+        )
+
+    async def publish_counters():
+        while True:
+            for shard_id, connection in connections.items():
+                base = shard_id * _N_COUNTERS
+                counters[base + _MESSAGES] = connection.messages_received
+                counters[base + _TRADES] = connection.trades_received
+                counters[base + _RECONNECTS] = connection.reconnects
+                counters[base + _BACKLOG] = backlogs[shard_id].batches.qsize()
+                counters[base + _DROPPED] = backlogs[shard_id].dropped_trades
+            await asyncio.sleep(1)
+
+    await asyncio.gather(
+        publish_counters(), *(connection.run() for connection in connections.values())
+    )
+
+
+class ShardBacklog:
+    """
+    The batches of a shard waiting for the shared queue, at most `max_batches`
+    """
+
+    def __init__(self, shard_id: int, max_batches: int):
+        self.shard_id = shard_id
+        self.batches: queue.Queue = queue.Queue(maxsize=max_batches)
+        self.dropped_trades = 0
+        self._overflowing = False
+
+    def put(self, trades: List[Trade]):
+        """
+        Adds the batch, or drops it if the backlog is full. Never blocks, it is
+        called on the event loop of the sockets.
+        """
+        try:
+            self.batches.put_nowait(trades)
+        except queue.Full:
+            self.dropped_trades += len(trades)
+            # once per overflow, the stats report the count
+            if not self._overflowing:
+                logger.warning(
+                    f'Backlog of shard {self.shard_id} is full, dropping trades '
+                    f'until the producer catches up'
+                )
+                self._overflowing = True
+            return
+        self._overflowing = False
+
+    def forward(self, trades_queue: multiprocessing.Queue):
+        """
+        Moves the batches to the shared queue, waiting on it when it is full
+        """
+        while True:
+            trades_queue.put(self.batches.get())
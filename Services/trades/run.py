@@ -1,11 +1,28 @@
+from typing import Any, Dict, Optional
+
+from delivery_report import DeliveryReport
 from kraken_api.base import TradesAPI
 from kraken_api.rest import KrakenRestAPI
+from kraken_api.replay import ReplayTradesAPI
+from kraken_api.rest_async import KrakenRestAPIAsync
+from kraken_api.trade import Trade
+from kraken_api.trade_cache import TradeCache
 from kraken_api.websocket import KrakenWebsocketAPI
+from kraken_api.websocket_sharded import KrakenShardedWebsocketAPI
 from loguru import logger
 from quixstreams import Application
+from wire_format import TRADE_SCHEMA, WireFormat, get_serializer
 
 
-def main(kafka_broker_address: str, kafka_topic: str, trades_api: TradesAPI):
+def main(
+    kafka_broker_address: str,
+    kafka_topic: str,
+    trades_api: TradesAPI,
+    validate_trades: bool = False,
+    producer_config: Optional[Dict[str, Any]] = None,
+    stats_interval_sec: float = 10.0,
+    wire_format: WireFormat = 'json',
+):
     """
     reads trades from the kraken API and push them to kafka topics.
 
@@ -17,6 +34,11 @@ def main(kafka_broker_address: str, kafka_topic: str, trades_api: TradesAPI):
         kafka_broker_address (str): the address of the kafka broker
         kafka_topic (str): the topic to push the trades to
         kraken_api (TradesAPI) with 2 methods: get_trades() and is_done()
+        validate_trades (bool): validate every trade with pydantic, for debugging
+        producer_config (Optional[Dict[str, Any]]): librdkafka settings of the
+            producer, e.g. linger.ms, batch.size and compression.type
+        stats_interval_sec (float): how often to log the producer throughput
+        wire_format (WireFormat): encode the trades as 'json' or 'binary'
     Returns:
         None
     """
@@ -24,42 +46,135 @@ def main(kafka_broker_address: str, kafka_topic: str, trades_api: TradesAPI):
 
     # initialize the quixstreams application
     # this class will handle the low-level details to connect to kafka.
-    app = Application(broker_address=kafka_broker_address)
+    app = Application(
+        broker_address=kafka_broker_address, producer_extra_config=producer_config
+    )
 
     # Define a topic where the trades will be pushed
-    topic = app.topic(name=kafka_topic, value_serializer='json')
+    topic = app.topic(
+        name=kafka_topic,
+        value_serializer=get_serializer(wire_format, TRADE_SCHEMA),
+    )
+    encode = Trade.to_json_bytes if wire_format == 'json' else encode_trade
+
+    # the broker acknowledges the messages asynchronously, the report counts them
+    # in the delivery callback and logs the throughput every few seconds
+    report = DeliveryReport(interval_sec=stats_interval_sec)
 
     # Create a Producer instance
     with app.get_producer() as producer:
         while not trades_api.is_done():
             trades = trades_api.get_trades()
 
-            for trade in trades:
-                # serialize the trade to json
-                message = topic.serialize(
-                    key=trade.pair.replace('/', '-'),
-                    value=trade.to_dict(),
+            if validate_trades:
+                for trade in trades:
+                    trade.validate()
+
+            # serialize the whole batch up front, the trades encode themselves
+            # straight to bytes instead of going through a dict and the topic
+            # serializer. The producer batches and compresses them on its side.
+            messages = [
+                (trade.pair.replace('/', '-'), encode(trade)) for trade in trades
+            ]
+            for key, value in messages:
+                producer.produce(
+                    topic=topic.name,
+                    value=value,
+                    key=key,
+                    on_delivery=report.on_delivery,
                 )
 
-                # push the serialized message to the topic
-                producer.produce(topic=topic.name, value=message.value, key=message.key)
+            report.on_produce(len(messages), sum(len(value) for _, value in messages))
+            report.maybe_log()
 
-                logger.info(f'Pushed trade to topic {kafka_topic}')
+    # leaving the context manager flushed the producer, so every message has been
+    # acknowledged or has failed by now
+    report.log_summary()
+
+
+def encode_trade(trade: Trade) -> bytes:
+    """
+    Encodes the trade in the binary wire format of the trades topic, or as JSON if
+    its pair is too long for it, like `WireSerializer` does
+    """
+    try:
+        return TRADE_SCHEMA.encode_values(
+            trade.pair, trade.price, trade.volume, trade.timestamp_ms, trade.trade_id
+        )
+    except IndexError:
+        # the length byte of the pair is looked up by index
+        return trade.to_json_bytes()
 
 
 if __name__ == '__main__':
     from config import config
 
+    trades_cache = None
+    if config.data_source in ('historical', 'replay') and config.trades_cache_dir:
+        trades_cache = TradeCache(
+            cache_dir=config.trades_cache_dir,
+            max_bytes=config.trades_cache_max_bytes,
+        )
+
     # initialize the kraken api depending on the data source
-    if config.data_source == 'live':
-        kraken_api = KrakenWebsocketAPI(config.pairs)
+    if config.data_source == 'replay':
+        if trades_cache is None:
+            raise ValueError('Replaying trades needs TRADES_CACHE_DIR')
+        kraken_api = ReplayTradesAPI(
+            trades_cache, config.pairs, speed=config.replay_speed
+        )
+    elif config.data_source == 'live' and config.websocket_processes > 0:
+        kraken_api = KrakenShardedWebsocketAPI(
+            config.pairs,
+            n_sockets=config.websocket_sockets,
+            n_processes=config.websocket_processes,
+            max_queue_size=config.websocket_queue_size,
+            max_backlog=config.websocket_max_backlog,
+            heartbeat_timeout_sec=config.websocket_heartbeat_timeout_sec,
+            max_backoff_sec=config.websocket_max_backoff_sec,
+            gap_backfill_timeout_sec=config.websocket_gap_backfill_timeout_sec,
+            rest_requests_per_second=config.rest_requests_per_second,
+        )
+    elif config.data_source == 'live':
+        kraken_api = KrakenWebsocketAPI(
+            config.pairs,
+            heartbeat_timeout_sec=config.websocket_heartbeat_timeout_sec,
+            max_backoff_sec=config.websocket_max_backoff_sec,
+            gap_backfill_timeout_sec=config.websocket_gap_backfill_timeout_sec,
+            rest_requests_per_second=config.rest_requests_per_second,
+        )
+    elif config.data_source == 'historical' and config.rest_backfill_mode == 'async':
+        kraken_api = KrakenRestAPIAsync(
+            config.pairs,
+            last_n_days=config.last_n_days,
+            requests_per_second=config.rest_requests_per_second,
+            burst=config.rest_burst,
+            slices_per_pair=config.rest_slices_per_pair,
+            cache=trades_cache,
+        )
     elif config.data_source == 'historical':
-        kraken_api = KrakenRestAPI(config.pairs, last_n_days=config.last_n_days)
+        kraken_api = KrakenRestAPI(
+            config.pairs, last_n_days=config.last_n_days, cache=trades_cache
+        )
     else:
         raise ValueError(f'Unknown data source: {config.data_source}')
 
-    main(
-        kafka_broker_address=config.kafka_broker_address,
-        kafka_topic=config.kafka_topic,
-        trades_api=kraken_api,
-    )
+    # the cache only saves the segments it read on close
+    try:
+        main(
+            kafka_broker_address=config.kafka_broker_address,
+            kafka_topic=config.kafka_topic,
+            trades_api=kraken_api,
+            validate_trades=config.validate_trades,
+            producer_config={
+                'linger.ms': config.producer_linger_ms,
+                'batch.size': config.producer_batch_size,
+                'batch.num.messages': config.producer_batch_num_messages,
+                'compression.type': config.producer_compression_type,
+            },
+            stats_interval_sec=config.producer_stats_interval_sec,
+            wire_format=config.wire_format,
+        )
+    finally:
+        if trades_cache is not None:
+            trades_cache.close()
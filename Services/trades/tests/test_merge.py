@@ -0,0 +1,101 @@
+"""
+The merge of the per-pair cursors: timestamp order across pairs, ties in the order
+of the cursors, and cursors only advanced as far as the merge needs.
+"""
+
+from itertools import islice
+from typing import Iterator, List
+
+from kraken_api.base import TradesAPI
+from kraken_api.merge import iter_trades, merge_trades
+from kraken_api.trade import Trade
+
+
+def trades(pair: str, *timestamps_ms: int) -> List[Trade]:
+    return [Trade(pair, 100.0, 0.1, timestamp_ms) for timestamp_ms in timestamps_ms]
+
+
+class FakePages(TradesAPI):
+    """
+    A cursor serving its trades a page at a time, counting the pages requested
+    """
+
+    def __init__(self, pages: List[List[Trade]]):
+        self.pages = pages
+        self.pages_fetched = 0
+
+    def get_trades(self) -> List[Trade]:
+        self.pages_fetched += 1
+        return self.pages[self.pages_fetched - 1]
+
+    def is_done(self) -> bool:
+        return self.pages_fetched == len(self.pages)
+
+
+def consumed(cursor: List[Trade], counts: dict, pair: str) -> Iterator[Trade]:
+    for trade in cursor:
+        counts[pair] += 1
+        yield trade
+
+
+def test_pairs_come_out_in_timestamp_order():
+    btc = trades('BTC/USD', 1, 4, 4, 9)
+    eth = trades('ETH/USD', 2, 3, 10)
+    sol = trades('SOL/USD', 5, 6, 7, 8)
+
+    merged = list(merge_trades([iter(btc), iter(eth), iter(sol)]))
+
+    assert [t.timestamp_ms for t in merged] == [1, 2, 3, 4, 4, 5, 6, 7, 8, 9, 10]
+    assert [t.pair for t in merged][:5] == [
+        'BTC/USD',
+        'ETH/USD',
+        'ETH/USD',
+        'BTC/USD',
+        'BTC/USD',
+    ]
+
+
+def test_ties_come_out_in_the_order_of_the_cursors():
+    btc = trades('BTC/USD', 5, 5)
+    eth = trades('ETH/USD', 5)
+    sol = trades('SOL/USD', 1, 5)
+
+    merged = list(merge_trades([iter(btc), iter(eth), iter(sol)]))
+
+    assert [(t.pair, t.timestamp_ms) for t in merged] == [
+        ('SOL/USD', 1),
+        ('BTC/USD', 5),
+        ('BTC/USD', 5),
+        ('ETH/USD', 5),
+        ('SOL/USD', 5),
+    ]
+
+
+def test_only_the_cursor_behind_is_advanced():
+    counts = {'BTC/USD': 0, 'ETH/USD': 0}
+    # a busy pair far ahead of a quiet one
+    btc = trades('BTC/USD', *range(100, 1_100))
+    eth = trades('ETH/USD', 1, 2, 3, 5_000)
+
+    merged = merge_trades(
+        [
+            consumed(btc, counts, 'BTC/USD'),
+            consumed(eth, counts, 'ETH/USD'),
+        ]
+    )
+    first = list(islice(merged, 3))
+
+    assert [t.timestamp_ms for t in first] == [1, 2, 3]
+    # the busy pair only had its next trade read, the watermark of its cursor
+    assert counts == {'BTC/USD': 1, 'ETH/USD': 3}
+
+
+def test_pages_are_requested_once_the_previous_one_is_consumed():
+    api = FakePages([trades('BTC/USD', 1, 2), trades('BTC/USD', 3, 4), []])
+
+    cursor = iter_trades(api)
+    assert api.pages_fetched == 0
+    assert [next(cursor).timestamp_ms for _ in range(2)] == [1, 2]
+    assert api.pages_fetched == 1
+    assert [t.timestamp_ms for t in cursor] == [3, 4]
+    assert api.pages_fetched == 3
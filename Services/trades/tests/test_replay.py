@@ -0,0 +1,111 @@
+"""
+The replay of the trade cache: the order the pairs come out in, the batches of a
+replay at speed 0, and segments that overlap, each trade only replayed once.
+"""
+
+import time
+from typing import List
+
+import pytest
+from kraken_api.replay import ReplayTradesAPI
+from kraken_api.trade import Trade
+from kraken_api.trade_cache import TradeCache
+
+MS = 1_000_000
+
+
+def trades(pair: str, *timestamps_ms: int) -> List[Trade]:
+    return [
+        Trade(pair, 100.0 + timestamp_ms, 0.5, timestamp_ms, timestamp_ms)
+        for timestamp_ms in timestamps_ms
+    ]
+
+
+@pytest.fixture
+def cache(tmp_path) -> TradeCache:
+    cache = TradeCache(str(tmp_path), max_bytes=10**9)
+    # two backfills of BTC over the same range, and one inside both
+    cache.write('BTC/USD', 0, 10 * MS, trades('BTC/USD', 2, 4, 6, 8, 10))
+    cache.write('BTC/USD', 5 * MS, 14 * MS, trades('BTC/USD', 6, 8, 10, 12, 14))
+    cache.write('BTC/USD', 6 * MS, 8 * MS, trades('BTC/USD', 8))
+    # a boundary in the middle of a millisecond, ms 9 belonging to the second one
+    cache.write('ETH/USD', 0, 9 * MS - 1, trades('ETH/USD', 1, 4, 8))
+    cache.write('ETH/USD', 9 * MS - 1, 20 * MS, trades('ETH/USD', 9, 10, 15))
+    return cache
+
+
+def replay(api: ReplayTradesAPI) -> List[List[tuple]]:
+    batches = []
+    while not api.is_done():
+        batches.append([(t.pair, t.timestamp_ms, t.trade_id) for t in api.get_trades()])
+    return batches
+
+
+EXPECTED = [
+    ('ETH/USD', 1, 1),
+    ('BTC/USD', 2, 2),
+    ('BTC/USD', 4, 4),
+    ('ETH/USD', 4, 4),
+    ('BTC/USD', 6, 6),
+    ('BTC/USD', 8, 8),
+    ('ETH/USD', 8, 8),
+    ('ETH/USD', 9, 9),
+    ('BTC/USD', 10, 10),
+    ('ETH/USD', 10, 10),
+    ('BTC/USD', 12, 12),
+    ('BTC/USD', 14, 14),
+    ('ETH/USD', 15, 15),
+]
+
+
+@pytest.mark.parametrize('batch_size', [1, 4, 13, 1_000])
+def test_speed_0_replays_every_trade_once_in_order(cache, batch_size):
+    # the pairs in any order, ties come out by pair name
+    api = ReplayTradesAPI(cache, ['ETH/USD', 'BTC/USD'], speed=0, batch_size=batch_size)
+
+    batches = replay(api)
+
+    assert [trade for batch in batches for trade in batch] == EXPECTED
+    assert all(len(batch) == batch_size for batch in batches[:-1])
+    assert api.trades_replayed == len(EXPECTED)
+
+
+def test_every_replay_of_the_archive_is_the_same(cache):
+    first = replay(ReplayTradesAPI(cache, ['BTC/USD', 'ETH/USD'], speed=0))
+    # paced, fast enough for the test
+    started_at = time.monotonic()
+    paced = replay(ReplayTradesAPI(cache, ['BTC/USD', 'ETH/USD'], speed=100))
+
+    assert [t for batch in paced for t in batch] == [
+        t for batch in first for t in batch
+    ]
+    # 14ms of trades at 100 times the original speed
+    assert time.monotonic() - started_at < 1
+
+
+def test_range_bounds_apply_by_millisecond(cache):
+    api = ReplayTradesAPI(
+        cache,
+        ['BTC/USD', 'ETH/USD'],
+        speed=0,
+        since_timestamp_ns=4 * MS + 500_000,
+        until_timestamp_ns=10 * MS + 500_000,
+    )
+
+    replayed = [trade for batch in replay(api) for trade in batch]
+
+    assert replayed == [t for t in EXPECTED if 4 < t[1] <= 10]
+
+
+def test_evicted_segment_is_covered_by_an_overlapping_one(cache, tmp_path):
+    first, _, _ = cache.segments('BTC/USD')
+    (tmp_path / first.file_name).unlink()
+
+    api = ReplayTradesAPI(cache, ['BTC/USD'], speed=0)
+
+    assert [t[1] for batch in replay(api) for t in batch] == [6, 8, 10, 12, 14]
+
+
+def test_negative_speed_is_refused(cache):
+    with pytest.raises(ValueError, match='speed'):
+        ReplayTradesAPI(cache, ['BTC/USD'], speed=-1)
@@ -0,0 +1,228 @@
+"""
+The concurrent backfill against a local fake of the Kraken Trades endpoint: every
+pair split in slices paginating in parallel, and a pair whose cursor fails halfway.
+And the stitch of the slices, with trades at their shared boundary.
+"""
+
+import asyncio
+import json
+import threading
+import time
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+from kraken_api.rest_async import KrakenRestAPIAsync, stitch_slices
+from kraken_api.trade import Trade
+
+PAIRS = ['BTC/USD', 'ETH/USD', 'SOL/USD']
+TRADE_INTERVAL_NS = 30 * 1_000_000_000
+PAGE_SIZE = 200
+
+
+class FakeTradesEndpoint:
+    """
+    A day of trades of every pair, a trade every TRADE_INTERVAL_NS, served a page at
+    a time from `since` on like the Trades endpoint
+    """
+
+    def __init__(self, failing_pair: Optional[str] = None, fail_after_pages: int = 3):
+        self.failing_pair = failing_pair
+        self.fail_after_pages = fail_after_pages
+        self.requests: Dict[str, int] = {pair: 0 for pair in PAIRS}
+        self._lock = threading.Lock()
+
+        now_ns = time.time_ns()
+        # half a millisecond in, so the float of the response rounds to the same
+        # millisecond
+        start_ns = now_ns - 23 * 60 * 60 * 1_000_000_000 + 500_000
+        self.trades: Dict[str, List[tuple]] = {}
+        for i, pair in enumerate(PAIRS):
+            timestamps_ns = range(
+                start_ns + i * 1_000_000_000, now_ns - 60_000_000_000, TRADE_INTERVAL_NS
+            )
+            self.trades[pair] = [
+                (i * 1_000_000 + trade_id, timestamp_ns)
+                for trade_id, timestamp_ns in enumerate(timestamps_ns)
+            ]
+
+    def page(self, pair: str, since_ns: int) -> Optional[dict]:
+        """
+        The result of a request, None for a broken response
+        """
+        with self._lock:
+            self.requests[pair] += 1
+            if (
+                pair == self.failing_pair
+                and self.requests[pair] > self.fail_after_pages
+            ):
+                return None
+
+        trades = [t for t in self.trades[pair] if t[1] > since_ns][:PAGE_SIZE]
+        # past the last trade the cursor is caught up with the present
+        last_ns = trades[-1][1] if len(trades) == PAGE_SIZE else time.time_ns()
+        return {
+            pair: [
+                ['100.0', '0.1', timestamp_ns / 1e9, 'b', 'l', '', trade_id]
+                for trade_id, timestamp_ns in trades
+            ],
+            'last': str(last_ns),
+        }
+
+
+def serve(endpoint: FakeTradesEndpoint) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            query = parse_qs(urlparse(self.path).query)
+            result = endpoint.page(query['pair'][0], int(query['since'][0]))
+            if result is None:
+                # cut short, like a response that broke off
+                body = b'{"error": [], "result": {'
+            else:
+                body = json.dumps({'error': [], 'result': result}).encode()
+            self.send_response(HTTPStatus.OK)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@pytest.fixture
+def backfill():
+    """
+    Starts the backfill of the last day against the endpoint of the test
+    """
+    servers = []
+
+    def start(endpoint: FakeTradesEndpoint, slices_per_pair: int):
+        server = serve(endpoint)
+        servers.append(server)
+        return KrakenRestAPIAsync(
+            PAIRS,
+            last_n_days=1,
+            requests_per_second=1_000,
+            burst=100,
+            slices_per_pair=slices_per_pair,
+            url=f'http://127.0.0.1:{server.server_address[1]}/0/public/Trades',
+            max_pending_pages=2,
+            batch_size=500,
+        )
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def drain(api: KrakenRestAPIAsync) -> List[Trade]:
+    trades = []
+    while not api.is_done():
+        trades.extend(api.get_trades())
+    return trades
+
+
+@pytest.mark.parametrize('slices_per_pair', [1, 4])
+def test_backfill_returns_every_trade_once_in_timestamp_order(
+    backfill, slices_per_pair
+):
+    endpoint = FakeTradesEndpoint()
+    api = backfill(endpoint, slices_per_pair)
+
+    trades = drain(api)
+
+    timestamps = [trade.timestamp_ms for trade in trades]
+    assert timestamps == sorted(timestamps)
+    for pair in PAIRS:
+        trade_ids = [trade.trade_id for trade in trades if trade.pair == pair]
+        assert trade_ids == [trade_id for trade_id, _ in endpoint.trades[pair]]
+    # every slice paginated, through the pooled session
+    assert all(n >= slices_per_pair for n in endpoint.requests.values())
+
+
+def test_failing_cursor_fails_the_backfill(backfill):
+    endpoint = FakeTradesEndpoint(failing_pair='ETH/USD', fail_after_pages=3)
+    api = backfill(endpoint, slices_per_pair=2)
+
+    trades = []
+    # the pair that raises is the first one the merge waits on once the backfill
+    # stopped, with the error of the cursor as the cause
+    with pytest.raises(RuntimeError, match='Backfill of') as error:
+        while not api.is_done():
+            trades.extend(api.get_trades())
+
+    # not a backfill that finished with the trades of the pair missing
+    assert not api.is_done()
+    assert isinstance(error.value.__cause__, json.JSONDecodeError)
+    # the trades before the failure went out in order
+    timestamps = [trade.timestamp_ms for trade in trades]
+    assert timestamps == sorted(timestamps)
+
+
+def stitch(*slices: List[list]) -> List[Trade]:
+    """
+    Runs the pages of every slice, each closed like the cursors close it, through
+    the stitch
+    """
+
+    async def run() -> List[Trade]:
+        queues = []
+        for pages in slices:
+            queue = asyncio.Queue()
+            for page in pages:
+                queue.put_nowait(page)
+            queues.append(queue)
+        return [trade async for page in stitch_slices(queues) for trade in page]
+
+    return asyncio.run(run())
+
+
+def trade(timestamp_ms: int, trade_id: Optional[int], price: float = 100.0) -> Trade:
+    return Trade('BTC/USD', price, 0.1, timestamp_ms, trade_id)
+
+
+def test_stitch_drops_the_trades_both_slices_return_at_their_boundary():
+    first = [[trade(1_000, 1), trade(2_000, 2)], [trade(3_000, 3), trade(3_000, 4)]]
+    # the next slice starts at the boundary millisecond, with the trades the
+    # previous one returned and one it did not
+    second = [[trade(3_000, 3), trade(3_000, 4), trade(3_000, 5), trade(4_000, 6)]]
+
+    trades = stitch(first + [None], second + [None])
+
+    assert [t.trade_id for t in trades] == [1, 2, 3, 4, 5, 6]
+
+
+def test_stitch_keeps_the_boundary_across_pages_and_empty_slices():
+    first = [[trade(1_000, 1), trade(3_000, 2)], [trade(3_000, 3)]]
+    # a slice without trades of its own, then one returning the boundary again
+    second = [[trade(3_000, 2), trade(3_000, 3)]]
+    third = [[trade(3_000, 3), trade(3_000, 4), trade(5_000, 5)]]
+
+    trades = stitch(first + [None], second + [None], third + [None])
+
+    assert [t.trade_id for t in trades] == [1, 2, 3, 4, 5]
+
+
+def test_stitch_tells_trades_without_id_apart_by_their_values():
+    first = [[trade(3_000, None, price=100.0), trade(3_000, None, price=101.0)]]
+    second = [[trade(3_000, None, price=101.0), trade(3_000, None, price=102.0)]]
+
+    trades = stitch(first + [None], second + [None])
+
+    assert [t.price for t in trades] == [100.0, 101.0, 102.0]
+
+
+def test_stitch_raises_the_error_of_a_slice():
+    error = ConnectionError('reset')
+    first = [[trade(1_000, 1)], error]
+    second = [[trade(2_000, 2)], None]
+
+    with pytest.raises(ConnectionError):
+        stitch(first, second)
@@ -0,0 +1,241 @@
+"""
+The trade cache on its own: the segment files, the plan of a range over the
+segments, the eviction of the least recently used ones and the index surviving a
+crash. And the cached cursor against the plain one, over a market with several
+trades in the same millisecond.
+"""
+
+import json
+import os
+import struct
+from typing import List, Optional
+
+import pytest
+from kraken_api.rest import CachedKrakenRestAPISinglePair, KrakenRestAPISinglePair
+from kraken_api.trade import Trade
+from kraken_api.trade_cache import TradeCache
+
+PAIR = 'BTC/USD'
+MS = 1_000_000
+
+
+def trades(*timestamps_ms: int) -> List[Trade]:
+    return [
+        Trade(PAIR, 100.0 + i, 0.5, timestamp_ms, i if i % 2 else None)
+        for i, timestamp_ms in enumerate(timestamps_ms)
+    ]
+
+
+def test_segment_file_is_a_header_and_the_columns(tmp_path):
+    cache = TradeCache(str(tmp_path), max_bytes=10**9)
+    written = trades(1_000, 1_001, 1_005)
+    cache.write(PAIR, 999 * MS, 1_005 * MS, written)
+
+    [segment] = cache.segments(PAIR)
+    assert segment.file_name == 'BTC-USD/999000000_1005000000.trades'
+    data = (tmp_path / segment.file_name).read_bytes()
+    assert data[:14] == struct.pack('<4sHQ', b'KTRC', 1, 3)
+    assert len(data) == segment.size_bytes == 14 + 4 * 8 * 3
+    assert struct.unpack_from('<3q', data, 14) == (1_000, 1_001, 1_005)
+
+    columns = cache.read(segment)
+    assert list(columns.timestamp_ms) == [1_000, 1_001, 1_005]
+    assert list(columns.price) == [100.0, 101.0, 102.0]
+    # unknown ids are stored as -1
+    assert list(columns.trade_id) == [-1, 1, -1]
+
+
+def test_segment_of_another_format_is_ignored(tmp_path):
+    cache = TradeCache(str(tmp_path), max_bytes=10**9)
+    cache.write(PAIR, 0, 10 * MS, trades(1, 2))
+    [segment] = cache.segments(PAIR)
+    path = tmp_path / segment.file_name
+    path.write_bytes(b'KTRC' + struct.pack('<H', 2) + path.read_bytes()[6:])
+
+    assert cache.read(segment) is None
+
+
+def test_plan_splits_the_range_into_cached_and_missing_pieces(tmp_path):
+    cache = TradeCache(str(tmp_path), max_bytes=10**9)
+    cache.write(PAIR, 100, 200, [])
+    cache.write(PAIR, 300, 400, [])
+    first, second = cache.segments(PAIR)
+
+    assert cache.plan(PAIR, 0, 500) == [
+        (0, 100, None),
+        (100, 200, first),
+        (200, 300, None),
+        (300, 400, second),
+        (400, 500, None),
+    ]
+    # a range starting and ending inside the segments
+    assert cache.plan(PAIR, 150, 350) == [
+        (150, 200, first),
+        (200, 300, None),
+        (300, 350, second),
+    ]
+    # up to the present
+    assert cache.plan(PAIR, 350, None) == [(350, 400, second), (400, None, None)]
+    # nothing cached for the pair
+    assert cache.plan('ETH/USD', 0, 500) == [(0, 500, None)]
+
+
+def test_least_recently_used_segments_are_evicted(tmp_path, monkeypatch):
+    clock = iter(range(1_000, 2_000))
+    monkeypatch.setattr('kraken_api.trade_cache.time.time', lambda: next(clock))
+    segment_bytes = 14 + 4 * 8 * 10
+    cache = TradeCache(str(tmp_path), max_bytes=2 * segment_bytes)
+
+    cache.write(PAIR, 0, 100, trades(*range(10)))
+    cache.write(PAIR, 100, 200, trades(*range(10)))
+    oldest, newest = cache.segments(PAIR)
+    # reading the oldest makes the newest the least recently used
+    assert cache.read(oldest) is not None
+    cache.write(PAIR, 200, 300, trades(*range(10)))
+
+    assert [s.since_ns for s in cache.segments(PAIR)] == [0, 200]
+    assert cache.size_bytes() == 2 * segment_bytes
+    assert not (tmp_path / newest.file_name).exists()
+    assert cache.read(newest) is None
+
+
+def test_index_is_replaced_whole(tmp_path, monkeypatch):
+    cache = TradeCache(str(tmp_path), max_bytes=10**9)
+    cache.write(PAIR, 0, 100, trades(1))
+    index = (tmp_path / 'index.json').read_text()
+
+    # a crash while the index is saved leaves the previous one
+    replace = os.replace
+
+    def crash(src, dst):
+        if str(dst).endswith('index.json'):
+            raise OSError('disk full')
+        replace(src, dst)
+
+    monkeypatch.setattr('kraken_api.trade_cache.os.replace', crash)
+    with pytest.raises(OSError):
+        cache.write(PAIR, 100, 200, trades(2))
+    monkeypatch.undo()
+
+    assert (tmp_path / 'index.json').read_text() == index
+    assert [s.since_ns for s in TradeCache(str(tmp_path), 10**9).segments(PAIR)] == [0]
+    # the segment itself was complete before it got its name
+    assert not list(tmp_path.glob('**/*.trades.tmp'))
+    assert (tmp_path / 'BTC-USD' / '100_200.trades').exists()
+
+
+def test_reads_are_saved_with_the_next_write_or_on_close(tmp_path):
+    cache = TradeCache(str(tmp_path), max_bytes=10**9)
+    cache.write(PAIR, 0, 100, trades(1))
+    [segment] = cache.segments(PAIR)
+    saved_at = os.path.getmtime(tmp_path / 'index.json')
+    index = (tmp_path / 'index.json').read_text()
+
+    cache.read(segment)
+    assert (tmp_path / 'index.json').read_text() == index
+    assert os.path.getmtime(tmp_path / 'index.json') == saved_at
+
+    cache.close()
+    [reloaded] = TradeCache(str(tmp_path), 10**9).segments(PAIR)
+    assert reloaded.last_used_at == segment.last_used_at
+
+
+class FakeSession:
+    """
+    The Trades endpoint as a requests session: four trades per millisecond, served
+    a few at a time after `since` like Kraken does
+    """
+
+    def __init__(self, start_ms: int, n_ms: int, page_size: int = 3):
+        self.page_size = page_size
+        self.requests = 0
+        self.trades_ns = [
+            ms * MS + offset_ns
+            for ms in range(start_ms, start_ms + n_ms)
+            for offset_ns in (100_000, 350_000, 600_000, 850_000)
+        ]
+
+    def get(self, url, params, headers, timeout):
+        self.requests += 1
+        since_ns = int(params['since'])
+        page = [ns for ns in self.trades_ns if ns > since_ns][: self.page_size]
+        # past the last trade the cursor is caught up with the present, like the
+        # real endpoint far enough in the past
+        last_ns = page[-1] if len(page) == self.page_size else 10**19
+        result = {
+            PAIR: [
+                ['100.0', '0.1', ns / 1e9, 'b', 'l', '', trade_id]
+                for trade_id, ns in enumerate(self.trades_ns)
+                if ns in page
+            ],
+            'last': str(last_ns),
+        }
+
+        class Response:
+            status_code = 200
+            text = json.dumps({'error': [], 'result': result})
+
+        return Response()
+
+
+def backfill(
+    session: FakeSession,
+    since_ns: int,
+    until_ns: int,
+    cache: Optional[TradeCache] = None,
+) -> List[tuple]:
+    if cache is None:
+        api = KrakenRestAPISinglePair(
+            PAIR,
+            1,
+            session=session,
+            since_timestamp_ns=since_ns,
+            until_timestamp_ns=until_ns,
+        )
+    else:
+        api = CachedKrakenRestAPISinglePair(
+            cache,
+            PAIR,
+            1,
+            since_timestamp_ns=since_ns,
+            until_timestamp_ns=until_ns,
+            segment_max_trades=5,
+            session=session,
+        )
+    result = []
+    while not api.is_done():
+        result.extend(api.get_trades())
+    return [(t.timestamp_ms, t.trade_id) for t in result]
+
+
+def test_cached_and_downloaded_trades_end_at_the_same_trade(tmp_path):
+    start_ms = 1_731_155_565_000
+    session = FakeSession(start_ms, n_ms=20)
+    # both ends of the ranges in the middle of a millisecond
+    since_ns = (start_ms + 2) * MS + 500_000
+    middle_ns = (start_ms + 9) * MS + 500_000
+    until_ns = (start_ms + 16) * MS + 500_000
+
+    expected = [
+        (ns // MS, trade_id)
+        for trade_id, ns in enumerate(session.trades_ns)
+        if since_ns < ns // MS * MS <= until_ns
+    ]
+    # the plain cursor returns the trades after since_ns, the ones of its
+    # millisecond included, and ends at the same trade
+    downloaded = backfill(session, since_ns, until_ns)
+    assert [t for t in downloaded if t[0] * MS > since_ns] == expected
+    assert downloaded[-1] == expected[-1]
+
+    cache = TradeCache(str(tmp_path), max_bytes=10**9)
+    # the first half cached in segments split inside milliseconds, then the
+    # whole range, served from the cache and the API
+    assert backfill(session, since_ns, middle_ns, cache) == [
+        trade for trade in expected if trade[0] * MS <= middle_ns
+    ]
+    assert backfill(session, since_ns, until_ns, cache) == expected
+
+    # and all of it from the cache
+    requests = session.requests
+    assert backfill(session, since_ns, until_ns, cache) == expected
+    assert session.requests == requests
@@ -0,0 +1,240 @@
+"""
+The live connection against a local fake of Kraken: a websocket server that stalls
+and then replays a few trades on the next connection, and a REST endpoint serving
+the trades missed meanwhile, with the one at the resume point twice, or failing.
+"""
+
+import asyncio
+import json
+import threading
+import time
+from datetime import datetime, timezone
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+from kraken_api.trade import Trade
+from kraken_api.websocket import KrakenWebsocketConnection
+from websockets.asyncio.server import ServerConnection, serve
+
+PAIR = 'BTC/USD'
+TRADE_INTERVAL_MS = 20
+HEARTBEAT_TIMEOUT_SEC = 0.3
+# trades the first connection sends before it goes silent
+TRADES_BEFORE_STALL = 10
+# trades from before the connection sent again when it opens
+REPLAYED_TRADES = 3
+
+
+class FakeKraken:
+    """
+    A market with a trade every TRADE_INTERVAL_MS, behind a websocket server and a
+    REST Trades endpoint
+    """
+
+    def __init__(
+        self,
+        stall_first_connection: bool = True,
+        failed_handshakes: int = 0,
+        rest_fails: bool = False,
+    ):
+        self.stall_first_connection = stall_first_connection
+        self.failed_handshakes = failed_handshakes
+        self.rest_fails = rest_fails
+        self.rest_requests = 0
+        self.start_ms = time.time_ns() // 1_000_000
+        self.connections = 0
+        self.handshakes = 0
+        self.sent_by_websocket: List[int] = []
+        self.sent_by_rest: List[int] = []
+
+    def timestamp_sec(self, trade_id: int) -> float:
+        # half a millisecond in, so the float of the REST API and the datetime of
+        # the websocket round to the same millisecond
+        return (self.start_ms + trade_id * TRADE_INTERVAL_MS + 0.5) / 1000
+
+    def last_trade_id(self) -> int:
+        return (time.time_ns() // 1_000_000 - self.start_ms) // TRADE_INTERVAL_MS
+
+    def rest_trades(self, since_ns: int) -> List[list]:
+        """
+        The trades from `since_ns` on, including the one at `since_ns` itself
+        """
+        trades = []
+        for trade_id in range(self.last_trade_id() + 1):
+            timestamp_sec = self.timestamp_sec(trade_id)
+            if timestamp_sec * 1e9 >= since_ns:
+                trades.append(['100.0', '0.1', timestamp_sec, 'b', 'l', '', trade_id])
+        self.sent_by_rest.extend(trade[6] for trade in trades)
+        return trades
+
+    def websocket_trade(self, trade_id: int) -> dict:
+        timestamp = datetime.fromtimestamp(
+            self.timestamp_sec(trade_id), tz=timezone.utc
+        )
+        return {
+            'symbol': PAIR,
+            'price': 100.0,
+            'qty': 0.1,
+            'timestamp': timestamp.isoformat().replace('+00:00', 'Z'),
+            'trade_id': trade_id,
+        }
+
+    def process_request(self, connection: ServerConnection, request):
+        self.handshakes += 1
+        if self.handshakes <= self.failed_handshakes:
+            return connection.respond(HTTPStatus.SERVICE_UNAVAILABLE, 'Try later\n')
+
+    async def handler(self, ws: ServerConnection):
+        self.connections += 1
+        stall = self.stall_first_connection and self.connections == 1
+
+        await ws.recv()
+        await ws.send(json.dumps({'method': 'subscribe', 'success': True}))
+
+        next_id = max(self.last_trade_id() - REPLAYED_TRADES + 1, 0)
+        sent = 0
+        while True:
+            if stall and sent == TRADES_BEFORE_STALL:
+                # no trades and no heartbeats, but the connection stays open
+                await ws.wait_closed()
+                return
+
+            trade_ids = list(range(next_id, self.last_trade_id() + 1))
+            if trade_ids:
+                await ws.send(
+                    json.dumps(
+                        {
+                            'channel': 'trade',
+                            'type': 'update',
+                            'data': [self.websocket_trade(i) for i in trade_ids],
+                        }
+                    )
+                )
+                self.sent_by_websocket.extend(trade_ids)
+                next_id = trade_ids[-1] + 1
+                sent += len(trade_ids)
+            else:
+                await ws.send(json.dumps({'channel': 'heartbeat'}))
+            await asyncio.sleep(TRADE_INTERVAL_MS / 1000)
+
+
+def serve_rest(kraken: FakeKraken) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            kraken.rest_requests += 1
+            if kraken.rest_fails:
+                self.send_error(HTTPStatus.SERVICE_UNAVAILABLE)
+                return
+
+            query = parse_qs(urlparse(self.path).query)
+            since_ns = int(query['since'][0])
+            trades = kraken.rest_trades(since_ns)
+            last_ns = int(trades[-1][2] * 1e9) if trades else since_ns
+            body = json.dumps(
+                {'error': [], 'result': {PAIR: trades, 'last': str(last_ns)}}
+            ).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def run_connection(
+    kraken: FakeKraken, n_trades: int, **connection_kwargs
+) -> tuple:
+    """
+    Runs a connection against the fake until it emitted `n_trades` trades
+
+    Returns:
+        tuple: the connection and the trades it emitted
+    """
+    rest = serve_rest(kraken)
+    emitted: List[Trade] = []
+    try:
+        async with serve(
+            kraken.handler,
+            '127.0.0.1',
+            0,
+            process_request=kraken.process_request,
+        ) as server:
+            port = server.sockets[0].getsockname()[1]
+            connection = KrakenWebsocketConnection(
+                [PAIR],
+                on_trades=emitted.extend,
+                url=f'ws://127.0.0.1:{port}',
+                rest_url=f'http://127.0.0.1:{rest.server_address[1]}/0/public/Trades',
+                heartbeat_timeout_sec=HEARTBEAT_TIMEOUT_SEC,
+                min_backoff_sec=0.05,
+                rest_requests_per_second=100,
+                **connection_kwargs,
+            )
+            task = asyncio.create_task(connection.run())
+            deadline = time.monotonic() + 10
+            while len(emitted) < n_trades and time.monotonic() < deadline:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+    finally:
+        rest.shutdown()
+        rest.server_close()
+    return connection, emitted
+
+
+def test_stall_is_recovered_without_gap_or_duplicates():
+    kraken = FakeKraken()
+    connection, emitted = asyncio.run(run_connection(kraken, n_trades=60))
+
+    trade_ids = [trade.trade_id for trade in emitted]
+    assert len(trade_ids) >= 60
+    assert trade_ids == list(range(trade_ids[0], trade_ids[0] + len(trade_ids)))
+    timestamps = [trade.timestamp_ms for trade in emitted]
+    assert timestamps == sorted(timestamps)
+
+    assert kraken.connections == 2
+    assert connection.reconnects == 1
+    assert connection.last_recovery_sec is not None
+    # the trades of the stall came from the REST API, and some came twice
+    missed = set(kraken.sent_by_rest) - set(kraken.sent_by_websocket)
+    assert missed and missed <= set(trade_ids)
+    assert len(kraken.sent_by_websocket) + len(kraken.sent_by_rest) > len(trade_ids)
+
+
+def test_failed_first_connect_is_not_a_reconnect():
+    kraken = FakeKraken(stall_first_connection=False, failed_handshakes=2)
+    connection, emitted = asyncio.run(run_connection(kraken, n_trades=20))
+
+    assert kraken.handshakes == 3
+    assert len(emitted) >= 20
+    assert connection.reconnects == 0
+    # nothing was emitted before, so there is no gap to backfill
+    assert kraken.sent_by_rest == []
+    assert connection.last_recovery_sec is None
+
+
+def test_stream_resumes_with_a_gap_while_rest_keeps_failing():
+    kraken = FakeKraken(rest_fails=True)
+    connection, emitted = asyncio.run(
+        run_connection(kraken, n_trades=60, gap_backfill_timeout_sec=0.5)
+    )
+
+    # the live trades were held back for the backfill until it gave up, then went
+    # out in order, after a single jump over the missed ones
+    trade_ids = [trade.trade_id for trade in emitted]
+    assert len(trade_ids) >= 60
+    jumps = [b - a for a, b in zip(trade_ids, trade_ids[1:]) if b - a != 1]
+    assert len(jumps) == 1 and jumps[0] > 1
+
+    assert connection.reconnects == 1
+    assert connection.gaps == 1
+    assert kraken.rest_requests > 1
@@ -0,0 +1,84 @@
+"""
+How the sharded connection deals the pairs to its shards, and the backlog of a
+shard dropping and counting trades once the producer falls behind.
+"""
+
+import queue
+import threading
+import time
+
+import pytest
+from kraken_api.trade import Trade
+from kraken_api.websocket_sharded import ShardBacklog, split_pairs
+
+PAIRS = ['BTC/USD', 'ETH/USD', 'SOL/USD', 'XRP/USD', 'ADA/USD', 'DOT/USD', 'LTC/USD']
+
+
+def batch(n_trades: int) -> list:
+    return [Trade('BTC/USD', 100.0, 0.1, 1_000 + i, i) for i in range(n_trades)]
+
+
+def test_pairs_are_dealt_round_robin():
+    assert split_pairs(PAIRS, 3) == [
+        ['BTC/USD', 'XRP/USD', 'LTC/USD'],
+        ['ETH/USD', 'ADA/USD'],
+        ['SOL/USD', 'DOT/USD'],
+    ]
+
+
+@pytest.mark.parametrize('n_shards', [0, 1, 2, 3, 7, 20])
+def test_every_pair_is_on_one_shard_and_no_shard_is_empty(n_shards):
+    shards = split_pairs(PAIRS, n_shards)
+
+    assert len(shards) == max(1, min(n_shards, len(PAIRS)))
+    assert all(shards)
+    assert sorted(pair for shard in shards for pair in shard) == sorted(PAIRS)
+    # the shards differ by one pair at most
+    assert max(map(len, shards)) - min(map(len, shards)) <= 1
+
+
+def test_full_backlog_drops_and_counts_the_new_batches():
+    backlog = ShardBacklog(shard_id=0, max_batches=2)
+
+    backlog.put(batch(3))
+    backlog.put(batch(4))
+    backlog.put(batch(5))
+    backlog.put(batch(6))
+
+    assert backlog.batches.qsize() == 2
+    assert backlog.dropped_trades == 11
+    # the batches kept are the first ones, in order
+    assert [len(backlog.batches.get_nowait()) for _ in range(2)] == [3, 4]
+
+    # room again, the batches go in and the count stays
+    backlog.put(batch(1))
+    assert backlog.batches.qsize() == 1
+    assert backlog.dropped_trades == 11
+
+
+def test_backlog_fills_up_behind_a_full_shared_queue():
+    shared = queue.Queue(maxsize=1)
+    backlog = ShardBacklog(shard_id=0, max_batches=2)
+    threading.Thread(target=backlog.forward, args=(shared,), daemon=True).start()
+
+    # one batch in the shared queue, one waiting on it in the forwarding thread,
+    # two in the backlog, and the rest dropped without blocking the caller
+    started_at = time.monotonic()
+    for _ in range(6):
+        backlog.put(batch(2))
+        time.sleep(0.05)
+    assert time.monotonic() - started_at < 1
+
+    assert backlog.batches.qsize() == 2
+    assert backlog.dropped_trades == 4
+
+    # the producer catches up and gets every batch that was not dropped
+    forwarded = []
+    deadline = time.monotonic() + 5
+    while len(forwarded) < 4 and time.monotonic() < deadline:
+        try:
+            forwarded.append(shared.get(timeout=0.1))
+        except queue.Empty:
+            pass
+    assert len(forwarded) == 4
+    assert backlog.batches.qsize() == 0